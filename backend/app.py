@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from collections.abc import Iterator
 import logging
 import os
 import warnings
@@ -25,14 +26,22 @@ from flask import (
     json,
     jsonify,
     request,
+    Response,
+    stream_with_context,
 )
 from flask_cors import CORS
 from pydantic import ValidationError
-import requests
 import sentry_sdk
 
-from models import ApiPayload
-from trip_service import compute_emissions
+from batch_service import BATCH_MAX_SIZE, compute_batch_emissions
+import http_client
+from matrix_service import compute_emissions_matrix, MATRIX_MAX_SIZE
+from metrics import measure_stage, render_metrics
+from models import ApiPayload, MatrixApiPayload
+from profiling import profile_request, PROFILING_HEADER
+from static_datasets import DATASET_LOAD_TIMES
+from task_pool import compute_deadline, current_deadline
+from trip_service import compute_emissions, stream_emissions
 
 
 # Load the environment variables
@@ -57,12 +66,30 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+for dataset_path, (source, load_time) in DATASET_LOAD_TIMES.items():
+    logger.info(
+        "Static dataset %s loaded from %s in %.3fs", dataset_path, source, load_time
+    )
+
+
+@app.before_request
+def set_request_deadline():
+    """Stop retrying the requests to the providers at the request deadline."""
+    current_deadline.set(compute_deadline())
+
 
 @app.route("/health", methods=["GET"])
 def health():
     return {"message": "backend initialized"}
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Expose the metrics of the backend to Prometheus (see metrics.py)."""
+    content, content_type = render_metrics()
+    return Response(content, content_type=content_type)
+
+
 @app.route("/compute-emissions", methods=["POST"])
 def compute_emissions_endpoint():
     """Compute emissions and geometries for one or two trips.
@@ -96,7 +123,158 @@ def compute_emissions_endpoint():
         json.dumps(payload.model_dump(), ensure_ascii=False),
     )
 
-    return compute_emissions(payload)
+    # Opt-in profiling of the request, see profiling.py
+    with profile_request(request.get_data(), request.headers.get(PROFILING_HEADER)):
+        with measure_stage("compute_emissions"):
+            results = compute_emissions(payload)
+
+        with measure_stage("json_serialization"):
+            return jsonify(results)
+
+
+@app.route("/compute-emissions/stream", methods=["POST"])
+def compute_emissions_stream_endpoint():
+    """Compute emissions and geometries, streaming each trip as soon as it is ready.
+
+    Takes the same payload as /compute-emissions. The response is
+    newline-delimited JSON: one event per line, ending with a summary event
+    (see trip_service.stream_emissions).
+
+    """
+    try:
+        payload = ApiPayload.model_validate(request.get_json())
+    except ValidationError as exc:
+        logger.warning("Invalid payload received: %s", exc.errors())
+        return jsonify(
+            {
+                "error": "Invalid payload",
+                "details": exc.errors(),
+            }
+        ), 400
+
+    logger.info(
+        "compute_emissions_stream_request payload=%s",
+        json.dumps(payload.model_dump(), ensure_ascii=False),
+    )
+
+    def generate_events() -> Iterator[str]:
+        for event in stream_emissions(payload):
+            yield json.dumps(event) + "\n"
+
+    return Response(
+        stream_with_context(generate_events()),
+        mimetype="application/x-ndjson",
+        # Events must not be buffered by a reverse proxy
+        headers={"X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/compute-emissions/batch", methods=["POST"])
+def compute_emissions_batch_endpoint():
+    """Compute emissions and geometries for a batch of payloads.
+
+    The request body is {"items": [...]}, each item being a /compute-emissions
+    payload. Legs shared by several items are only computed once (see
+    batch_service).
+
+    Returns:
+        JSON response containing:
+            - results: For each item, either its "trips", "geometries" and
+              number of alternative direct trips not computed ("skipped"),
+              or an "error" (with "details" for invalid items).
+            - legs: Number of legs of the batch, and of distinct legs
+              computed.
+
+    """
+    body = request.get_json(silent=True)
+    items = body.get("items") if isinstance(body, dict) else None
+
+    if not isinstance(items, list) or not items:
+        return jsonify(
+            {
+                "error": "Invalid payload",
+                "details": "items must be a non-empty list of payloads",
+            }
+        ), 400
+
+    if len(items) > BATCH_MAX_SIZE:
+        return jsonify(
+            {
+                "error": "Batch too large",
+                "details": f"a batch contains at most {BATCH_MAX_SIZE} items",
+            }
+        ), 413
+
+    # Invalid items are reported without failing the rest of the batch
+    results: list[dict | None] = []
+    payloads: list[ApiPayload] = []
+    for item in items:
+        try:
+            payloads.append(ApiPayload.model_validate(item))
+            results.append(None)
+        except ValidationError as exc:
+            results.append({"error": "Invalid payload", "details": exc.errors()})
+
+    logger.info(
+        "compute_emissions_batch_request items=%s valid=%s",
+        len(items),
+        len(payloads),
+    )
+
+    batch = compute_batch_emissions(payloads)
+    payload_results = iter(batch["results"])
+
+    return jsonify(
+        {
+            "results": [result or next(payload_results) for result in results],
+            "legs": batch["legs"],
+        }
+    )
+
+
+@app.route("/compute-emissions/matrix", methods=["POST"])
+def compute_emissions_matrix_endpoint():
+    """Compute emissions between every origin and every destination.
+
+    The request payload contains "origins" and "destinations" (trip points),
+    and optionally "transport-means" (car, bus and plane by default) and
+    "passengers-nb". Cells are computed from distances only, so the response
+    contains no geometries (see matrix_service).
+
+    Returns:
+        JSON response containing, for each transport mean, the matrix of the
+        emissions ("kg_co2_eq") and path length ("path_length") of each
+        origin (rows) and destination (columns), null when unreachable or,
+        for planes, too close (see parameters.PLANE_MIN_DISTANCE).
+
+    """
+    try:
+        payload = MatrixApiPayload.model_validate(request.get_json())
+    except ValidationError as exc:
+        logger.warning("Invalid payload received: %s", exc.errors())
+        return jsonify(
+            {
+                "error": "Invalid payload",
+                "details": exc.errors(),
+            }
+        ), 400
+
+    if max(len(payload.origins), len(payload.destinations)) > MATRIX_MAX_SIZE:
+        return jsonify(
+            {
+                "error": "Matrix too large",
+                "details": f"a matrix has at most {MATRIX_MAX_SIZE} origins and destinations",
+            }
+        ), 413
+
+    logger.info(
+        "compute_emissions_matrix_request origins=%s destinations=%s transport_means=%s",
+        len(payload.origins),
+        len(payload.destinations),
+        payload.transport_means,
+    )
+
+    return jsonify(compute_emissions_matrix(payload))
 
 
 @app.route("/send-mail", methods=["POST"])
@@ -130,7 +308,12 @@ def send_mail():
             "api-key": EMAIL_API_SERVICE_KEY,
         }
 
-        response = requests.post(EMAIL_API_SERVICE_URL, json=data, headers=headers)
+        response = http_client.post(
+            "brevo",
+            EMAIL_API_SERVICE_URL,
+            json=data,
+            headers=headers,
+        )
         response.raise_for_status()
         return jsonify({"status": "success", "message": "Email sent"}), 200
 
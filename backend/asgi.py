@@ -0,0 +1,146 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""ASGI app computing emissions with the asyncio pipeline (see trip_service_async).
+
+It serves the same /compute-emissions endpoint as the Flask app, and is run
+with an ASGI server:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+
+from contextlib import asynccontextmanager
+import dataclasses
+import json
+import logging
+import os
+import warnings
+
+from dotenv import load_dotenv
+from pydantic import ValidationError
+import sentry_sdk
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from http_client import close_async_clients
+from metrics import measure_stage, render_metrics
+from models import ApiPayload
+from task_pool import compute_deadline, current_deadline
+from trip_service_async import compute_emissions_async
+
+
+# Load the environment variables
+load_dotenv()
+warnings.filterwarnings("ignore")
+
+# add sentry for monitoring (optional)
+sentry_sdk.init(
+    dsn=os.getenv("SENTRY_DSN"),
+)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s %(name)s - %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+
+def to_jsonable(o: object) -> object:
+    """Serialize the dataclasses of the results, as the Flask app does."""
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class EmissionsJSONResponse(JSONResponse):
+    """JSON response serializing dataclasses, with sorted keys like Flask."""
+
+    def render(self, content: object) -> bytes:
+        """Serialize the content of the response."""
+        return json.dumps(content, default=to_jsonable, sort_keys=True).encode("utf-8")
+
+
+async def health(_request: Request) -> JSONResponse:
+    return JSONResponse({"message": "backend initialized"})
+
+
+async def metrics(_request: Request) -> Response:
+    """Expose the metrics of the backend to Prometheus (see metrics.py)."""
+    content, content_type = render_metrics()
+    return Response(content, headers={"Content-Type": content_type})
+
+
+async def compute_emissions_endpoint(request: Request) -> JSONResponse:
+    """Compute emissions and geometries for one or two trips.
+
+    See app.compute_emissions_endpoint.
+
+    """
+    try:
+        payload = ApiPayload.model_validate(await request.json())
+    except ValidationError as exc:
+        logger.warning("Invalid payload received: %s", exc.errors())
+        return JSONResponse(
+            {
+                "error": "Invalid payload",
+                "details": json.loads(exc.json()),
+            },
+            status_code=400,
+        )
+
+    logger.info(
+        "compute_emissions_request payload=%s",
+        json.dumps(payload.model_dump(), ensure_ascii=False),
+    )
+
+    # Retries of the provider requests stop at the deadline (see http_client)
+    current_deadline.set(compute_deadline())
+
+    with measure_stage("compute_emissions"):
+        results = await compute_emissions_async(payload)
+
+    with measure_stage("json_serialization"):
+        return EmissionsJSONResponse(results)
+
+
+@asynccontextmanager
+async def lifespan(_app: Starlette):
+    yield
+    await close_async_clients()
+
+
+app = Starlette(
+    routes=[
+        Route("/health", health, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route(
+            "/compute-emissions",
+            compute_emissions_endpoint,
+            methods=["POST"],
+        ),
+    ],
+    middleware=[
+        # comment this on deployment
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"]),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,329 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Emissions of batches of trips, computing each distinct leg only once.
+
+Batches of trips (e.g. the business trips of a company) often share legs:
+the legs of all the trips of a batch are deduplicated before being computed,
+then their results are used by every trip containing them. The batches are
+configured with environment variables:
+
+    BATCH_DEADLINE_SECONDS: time budget of a batch
+    BATCH_DIRECT_TRIPS_SHARE: share of the budget reserved for the
+        alternative direct trips
+    BATCH_MAX_SIZE: maximum number of payloads of a batch
+    BATCH_MAX_CONCURRENCY: maximum number of legs of a batch computed at once
+
+A batch is computed within the request, by a single worker. Its time budget
+must thus stay below the gunicorn worker timeout (--timeout, 30 seconds by
+default): legs not computed within the budget are reported as errors of
+their payloads, instead of the worker being killed. The alternative direct
+trips are computed once the legs are, within the end of the budget reserved
+for them: the ones not computed are counted in the results of their payloads.
+"""
+
+from concurrent.futures import Future
+import dataclasses
+import logging
+import os
+from typing import Any, Literal
+
+from models import (
+    ApiPayload,
+    StepData,
+    Trip,
+    TripResult,
+    TripStep,
+    TripStepGeometry,
+    TripStepResult,
+)
+from task_pool import (
+    compute_deadline,
+    current_deadline,
+    run_bounded_tasks,
+)
+from trip_service import (
+    build_step_error_message,
+    compute_step_emissions,
+    list_direct_trips,
+    STEP_ERROR_TRANSPORT_MEANS,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+BATCH_DEADLINE = float(os.getenv("BATCH_DEADLINE_SECONDS", "25"))
+"""Time budget of a batch, below the default gunicorn worker timeout. In seconds."""
+
+BATCH_DIRECT_TRIPS_SHARE = float(os.getenv("BATCH_DIRECT_TRIPS_SHARE", "0.2"))
+"""Share of BATCH_DEADLINE reserved for the alternative direct trips, computed
+once the legs are, so that slow legs do not leave them no time."""
+
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", str(max(int(BATCH_DEADLINE), 1))))
+"""Maximum number of payloads of a batch, one per second of BATCH_DEADLINE by
+default so that a batch of simple trips with no cached route fits in it."""
+
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+"""Maximum number of legs of a batch computed at the same time."""
+
+TripName = Literal["MAIN_TRIP", "SECOND_TRIP"]
+
+LegKey = tuple[
+    str,
+    tuple[float, float],
+    tuple[float, float],
+    int | None,
+    str | None,
+]
+"""Transport mean, departure and arrival coordinates, number of passengers and
+ferry options: the inputs of a step computation.
+
+The trip name is not part of the key, so a leg shared by the main and the
+second trip is computed once (see gather_trip_legs)."""
+
+
+def get_leg_key(
+    departure_coordinates: tuple[float, float],
+    arrival: TripStep,
+) -> LegKey:
+    return (
+        arrival.transport_mean,
+        departure_coordinates,
+        (arrival.lon, arrival.lat),
+        arrival.passengers_nb,
+        arrival.ferry_options,
+    )
+
+
+def list_trip_legs(
+    trip_name: TripName,
+    trip: Trip,
+) -> list[tuple[LegKey, tuple]]:
+    """List the legs of a trip, with the arguments of compute_step_emissions.
+
+    Returns:
+        The key and the step computation arguments of each leg, in the order
+        of the steps.
+
+    """
+    departures = [trip.departure, *trip.steps[:-1]]
+
+    return [
+        (
+            get_leg_key((departure.lon, departure.lat), arrival),
+            (trip_name, trip, idx, (departure.lon, departure.lat), arrival),
+        )
+        for idx, (departure, arrival) in enumerate(zip(departures, trip.steps))
+    ]
+
+
+def compute_batch_emissions(payloads: list[ApiPayload]) -> dict[str, Any]:
+    """Compute emissions and geometries for a batch of payloads.
+
+    Each payload gets the same trips as with trip_service.compute_emissions,
+    but legs and alternative direct trips shared by several payloads are
+    only computed once. A payload whose trips cannot be computed, or not
+    before the share of BATCH_DEADLINE left to the legs, gets an error
+    without failing the rest of the batch.
+
+    Args:
+        payloads: Validated API payloads.
+
+    Returns:
+        A dictionary containing:
+            - results: For each payload, either a dictionary with "trips" and
+              "geometries" (see compute_emissions) and the number of
+              alternative direct trips not computed ("skipped" key), or a
+              dictionary with an "error" message.
+            - legs: Number of legs of the batch, and of distinct legs
+              computed.
+
+    """
+    deadline = compute_deadline(BATCH_DEADLINE)
+    # The requests to the providers are not retried past the batch deadline
+    current_deadline.set(deadline)
+    # The end of the budget is reserved for the alternative direct trips
+    legs_deadline = compute_deadline(BATCH_DEADLINE * (1 - BATCH_DIRECT_TRIPS_SHARE))
+
+    payloads_legs = [
+        {
+            trip_name: list_trip_legs(trip_name, trip)
+            for trip_name, trip in (
+                ("MAIN_TRIP", payload.main_trip),
+                ("SECOND_TRIP", payload.second_trip),
+            )
+            if trip
+        }
+        for payload in payloads
+    ]
+
+    # The first occurrence of each leg is computed
+    legs: dict[LegKey, tuple] = {}
+    for payload_legs in payloads_legs:
+        for trip_legs in payload_legs.values():
+            for key, args in trip_legs:
+                legs.setdefault(key, (compute_step_emissions, args))
+
+    legs_nb = sum(
+        len(trip_legs)
+        for payload_legs in payloads_legs
+        for trip_legs in payload_legs.values()
+    )
+    logger.info(
+        "Batch of %s payloads: %s distinct legs of %s",
+        len(payloads),
+        len(legs),
+        legs_nb,
+    )
+
+    leg_results = run_bounded_tasks(legs, BATCH_MAX_CONCURRENCY, legs_deadline)
+
+    results: list[dict[str, Any]] = []
+    for payload_legs in payloads_legs:
+        try:
+            trips, geometries = zip(
+                *(
+                    gather_trip_legs(trip_name, trip_legs, leg_results)
+                    for trip_name, trip_legs in payload_legs.items()
+                )
+            )
+        except ValueError as err:
+            results.append({"error": str(err)})
+        else:
+            results.append(
+                {
+                    "trips": list(trips),
+                    "geometries": [
+                        geometry
+                        for trip_geometries in geometries
+                        for geometry in trip_geometries
+                    ],
+                    "skipped": 0,
+                }
+            )
+
+    add_batch_direct_trips(payloads, results, deadline)
+
+    return {
+        "results": results,
+        "legs": {"total": legs_nb, "computed": len(legs)},
+    }
+
+
+def gather_trip_legs(
+    trip_name: TripName,
+    trip_legs: list[tuple[LegKey, tuple]],
+    leg_results: dict[LegKey, Future[TripStepResult]],
+) -> tuple[TripResult, list[TripStepGeometry]]:
+    """Aggregate the computed legs of a trip, see trip_service.gather_trip_steps.
+
+    A leg may have been computed for the other trip of the payload, or of
+    another payload: its geometries are labelled with trip_name.
+
+    Raises:
+        ValueError:
+            If a route cannot be computed for one of the trip steps, or if a
+            step is not computed before the deadline.
+
+    """
+    emissions_data: list[StepData] = []
+    geometries: list[TripStepGeometry] = []
+
+    for idx, (key, (*_, arrival)) in enumerate(trip_legs):
+        future = leg_results.get(key)
+        if future is None:
+            raise ValueError(
+                f"step n°{idx + 1} took too long to compute, please try again later."
+            )
+
+        err = future.exception()
+        if err is not None:
+            # The leg may have been computed as another step of another trip
+            if (
+                isinstance(err, ValueError)
+                and arrival.transport_mean not in STEP_ERROR_TRANSPORT_MEANS
+            ):
+                raise ValueError(str(err)) from err
+            raise ValueError(
+                build_step_error_message(idx, arrival.transport_mean)
+            ) from err
+
+        results = future.result()
+        emissions_data.append(results.step_data)
+        geometries.extend(
+            dataclasses.replace(geometry, trip_type=trip_name)
+            for geometry in results.geometries
+        )
+
+    return TripResult(name=trip_name, steps=emissions_data), geometries
+
+
+def add_batch_direct_trips(
+    payloads: list[ApiPayload],
+    results: list[dict[str, Any]],
+    deadline: float,
+):
+    """Add the alternative direct trips of the simple trips of a batch.
+
+    Alternatives shared by several payloads are computed once, see
+    trip_service.compute_direct_trips_emissions. The ones that fail or are
+    not computed before the deadline are counted in the "skipped" key of
+    the results of their payloads.
+
+    """
+    payloads_direct_trips = [
+        list_direct_trips(payload.main_trip, result["trips"][0].steps[0].path_length)
+        if not payload.second_trip
+        and len(payload.main_trip.steps) == 1
+        and "error" not in result
+        else []
+        for payload, result in zip(payloads, results)
+    ]
+
+    direct_trips = {
+        (compute_alternative, args): (compute_alternative, args)
+        for payload_direct_trips in payloads_direct_trips
+        for compute_alternative, args in payload_direct_trips
+    }
+    if not direct_trips:
+        return
+
+    direct_trips_results = run_bounded_tasks(
+        direct_trips,
+        BATCH_MAX_CONCURRENCY,
+        deadline,
+    )
+
+    for payload_direct_trips, result in zip(payloads_direct_trips, results):
+        for key in payload_direct_trips:
+            future = direct_trips_results.get(key)
+            if future is None:
+                result["skipped"] += 1
+                continue
+            if future.exception() is not None:
+                logger.error(
+                    "Direct trip %s failed",
+                    key[0].__name__,
+                    exc_info=future.exception(),
+                )
+                result["skipped"] += 1
+                continue
+
+            trips, geometries = future.result()
+            result["trips"].extend(trips)
+            result["geometries"].extend(geometries)
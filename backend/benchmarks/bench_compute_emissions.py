@@ -0,0 +1,232 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark compute_emissions end to end, offline.
+
+The responses of the providers are recorded once per scenario (this requires
+network access), then replayed so that the benchmark only measures the
+backend. Scenarios that were not recorded are skipped, and scenarios sending
+requests that were not recorded fail:
+
+    python -m benchmarks.bench_compute_emissions --record
+    python -m benchmarks.bench_compute_emissions --iterations 20
+
+The route cache is disabled so that every run goes through the routing, and
+the rate limits and retries of the providers are disabled when replaying. The in-memory
+caches of the worker are warmed by a first untimed run. The peak memory
+allocated by Python during a run is measured by an additional run traced
+with tracemalloc.
+"""
+
+import argparse
+from dataclasses import asdict, dataclass
+import json
+import logging
+import os
+from pathlib import Path
+import time
+import tracemalloc
+from typing import get_args
+import warnings
+
+import numpy as np
+
+from benchmarks.replay import (
+    load_fixture,
+    RecordingAdapter,
+    ReplayAdapter,
+    save_fixture,
+    use_adapter,
+)
+from benchmarks.scenarios import SCENARIOS
+from http_client import Provider
+from models import ApiPayload
+import route_cache
+from trip_service import compute_emissions
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_ITERATIONS = 10
+"""Default number of timed runs of each scenario."""
+
+
+@dataclass
+class ScenarioBenchmark:
+    """Durations and memory of the runs of a scenario."""
+
+    scenario: str
+    iterations: int
+    p50_ms: float
+    p95_ms: float
+    max_ms: float
+    peak_memory_kib: float
+    """Peak memory allocated by Python during a run."""
+
+
+def record_scenario(scenario: str):
+    """Record the responses of the providers for a scenario."""
+    adapter = RecordingAdapter()
+    with use_adapter(adapter):
+        compute_emissions(ApiPayload.model_validate(SCENARIOS[scenario]))
+
+    save_fixture(scenario, adapter.responses)
+    logger.info("%s: %s responses recorded", scenario, len(adapter.responses))
+
+
+def benchmark_scenario(scenario: str, iterations: int) -> ScenarioBenchmark:
+    """Run a scenario with its recorded responses, see the module docstring.
+
+    Raises:
+        FileNotFoundError: If the scenario was never recorded.
+        LookupError: If the scenario sends requests that were not recorded.
+
+    """
+    payload = ApiPayload.model_validate(SCENARIOS[scenario])
+    adapter = ReplayAdapter(load_fixture(scenario))
+
+    with use_adapter(adapter):
+        compute_emissions(payload)
+
+        # The requests changed since the recording: the timings would measure
+        # the handling of unreachable providers instead of the backend
+        if adapter.missing:
+            msg = (
+                f"{scenario}: {len(adapter.missing)} requests were not recorded, "
+                "record the scenario again: "
+                f"python -m benchmarks.bench_compute_emissions --record {scenario}"
+            )
+            raise LookupError(msg)
+
+        durations = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            compute_emissions(payload)
+            durations.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        try:
+            compute_emissions(payload)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    p50, p95, max_duration = np.percentile(durations, [50, 95, 100]) * 1000
+    return ScenarioBenchmark(
+        scenario=scenario,
+        iterations=iterations,
+        p50_ms=round(float(p50), 2),
+        p95_ms=round(float(p95), 2),
+        max_ms=round(float(max_duration), 2),
+        peak_memory_kib=round(peak_memory / 1024, 1),
+    )
+
+
+def print_benchmarks(benchmarks: list[ScenarioBenchmark]):
+    print(
+        f"{'scenario':<20} {'p50 (ms)':>10} {'p95 (ms)':>10} {'max (ms)':>10} "
+        f"{'peak (KiB)':>12}"
+    )
+    for benchmark in benchmarks:
+        print(
+            f"{benchmark.scenario:<20} {benchmark.p50_ms:>10.2f} "
+            f"{benchmark.p95_ms:>10.2f} {benchmark.max_ms:>10.2f} "
+            f"{benchmark.peak_memory_kib:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore")
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s - %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark compute_emissions with recorded provider responses."
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        metavar="scenario",
+        help=f"scenarios to run among {', '.join(SCENARIOS)}, all by default",
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="record the responses of the providers instead (requires network)",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=DEFAULT_ITERATIONS,
+        help="number of timed runs of each scenario",
+    )
+    parser.add_argument("--output", type=Path, help="JSON file of the results")
+    args = parser.parse_args()
+
+    # Not validated with choices, an empty list is rejected by argparse
+    unknown_scenarios = set(args.scenarios) - set(SCENARIOS)
+    if unknown_scenarios:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown_scenarios))}")
+    scenarios = args.scenarios or list(SCENARIOS)
+
+    route_cache.route_cache = None
+
+    if args.record:
+        logging.getLogger(__name__).setLevel(logging.INFO)
+        for scenario in scenarios:
+            record_scenario(scenario)
+    else:
+        # Replayed providers have no rate limit (see http_client.get_token_bucket),
+        # and are not retried: a request that was not recorded fails at once
+        for provider in get_args(Provider):
+            os.environ.setdefault(f"HTTP_{provider.upper()}_RATE_LIMIT", "0")
+            os.environ.setdefault(f"HTTP_{provider.upper()}_MAX_RETRIES", "0")
+
+        benchmarks = []
+        failures = []
+        for scenario in scenarios:
+            try:
+                benchmarks.append(benchmark_scenario(scenario, args.iterations))
+            except FileNotFoundError:
+                logger.warning(
+                    "%s: skipped, no recorded responses. Record them first (requires "
+                    "network): python -m benchmarks.bench_compute_emissions --record %s",
+                    scenario,
+                    scenario,
+                )
+            except LookupError as err:
+                failures.append(str(err))
+
+        if not benchmarks and not failures:
+            raise SystemExit(
+                "No scenario recorded, record them first (requires network): "
+                "python -m benchmarks.bench_compute_emissions --record"
+            )
+
+        if benchmarks:
+            print_benchmarks(benchmarks)
+        if args.output:
+            args.output.write_text(
+                json.dumps([asdict(benchmark) for benchmark in benchmarks], indent=2)
+            )
+
+        if failures:
+            raise SystemExit("\n".join(failures))
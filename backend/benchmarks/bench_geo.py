@@ -0,0 +1,331 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks of the geographic hot paths, with a regression gate.
+
+The country split of routes of increasing length and number of countries,
+the maritime routing between a fixed set of sea ports and the great-circle
+routes are timed, and their results saved as a JSON baseline. A later run is
+compared to the baseline, to check a change before it ships:
+
+    python -m benchmarks.bench_geo run --output baseline.json
+    # ... change the code ...
+    python -m benchmarks.bench_geo run --output current.json
+    python -m benchmarks.bench_geo compare baseline.json current.json
+
+The comparison exits with an error when a benchmark is slower than its
+baseline by more than the threshold. The routes recorded for the end-to-end
+benchmarks (see bench_compute_emissions) are also split by country.
+"""
+
+import argparse
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+import functools
+import json
+from pathlib import Path
+import platform
+import sys
+import time
+import warnings
+
+import numpy as np
+from shapely.geometry import LineString
+
+from benchmarks.replay import FIXTURES_DIR
+from geo_routing_maritime import (
+    build_maritime_mesh,
+    build_maritime_network,
+    compute_maritime_shortest_path,
+)
+from geo_split_path_by_country import split_path_by_country
+from parameters import GEOD
+from transport_plane import compute_great_circle_geometry, compute_great_circle_route
+from transport_train import TRAIN_COUNTRY_SPLIT_CONFIG
+from utils import m_to_km
+
+
+DEFAULT_ITERATIONS = 5
+"""Default number of timed runs of each benchmark."""
+
+DEFAULT_THRESHOLD = 0.2
+"""Default relative slowdown above which a benchmark is a regression."""
+
+SPLIT_ROUTES = {
+    "paris_lyon": ([(2.35, 48.86), (4.84, 45.76)], 200),
+    "paris_berlin": ([(2.35, 48.86), (6.96, 50.94), (13.40, 52.52)], 1000),
+    "lisbon_warsaw": (
+        [(-9.14, 38.72), (-3.70, 40.42), (2.35, 48.86), (13.40, 52.52), (21.01, 52.23)],
+        5000,
+    ),
+    "lisbon_istanbul": (
+        [
+            (-9.14, 38.72),
+            (2.17, 41.39),
+            (7.69, 45.07),
+            (16.37, 48.21),
+            (19.04, 47.50),
+            (26.10, 44.43),
+            (28.98, 41.01),
+        ],
+        20000,
+    ),
+}
+"""Waypoints and number of points of the synthetic routes split by country."""
+
+SEA_ROUTES = {
+    "marseille_ajaccio": ((5.37, 43.30), (8.74, 41.92)),
+    "genoa_tunis": ((8.93, 44.41), (10.18, 36.81)),
+    "piraeus_heraklion": ((23.64, 37.94), (25.14, 35.34)),
+    "dover_rotterdam": ((1.31, 51.13), (4.48, 51.92)),
+}
+"""Departure and arrival coordinates of the maritime benchmarks."""
+
+FLIGHTS = {
+    "paris_london": ((2.35, 48.86), (-0.13, 51.51)),
+    "paris_athens": ((2.35, 48.86), (23.73, 37.98)),
+    "paris_sydney": ((2.35, 48.86), (151.21, -33.87)),
+}
+"""Departure and arrival coordinates of the great-circle benchmarks."""
+
+
+@dataclass(frozen=True)
+class GeoBenchmark:
+    """Function timed by a benchmark."""
+
+    name: str
+    run: Callable[[], object]
+    setup: Callable[[], object] | None = None
+    """Called before each run, without being timed (e.g. to clear a cache)."""
+
+
+@dataclass
+class BenchmarkResult:
+    """Durations of the runs of a benchmark."""
+
+    median_ms: float
+    min_ms: float
+    iterations: int
+
+
+def build_synthetic_route(
+    waypoints: list[tuple[float, float]],
+    points_nb: int,
+) -> LineString:
+    """Build a winding route through waypoints, like the routes of the providers."""
+    distances = np.linspace(0, len(waypoints) - 1, points_nb)
+    lons = np.interp(distances, range(len(waypoints)), [lon for lon, _ in waypoints])
+    lats = np.interp(distances, range(len(waypoints)), [lat for _, lat in waypoints])
+    # Small deterministic detours, so that consecutive segments are not aligned
+    lats += 0.02 * np.sin(np.arange(points_nb) / 3)
+    return LineString(np.column_stack([lons, lats]))
+
+
+def load_recorded_routes() -> dict[str, LineString]:
+    """Load the routes found in the recorded provider responses, if any."""
+    routes = {}
+
+    for fixture_path in sorted(FIXTURES_DIR.glob("*.json")):
+        responses = json.loads(fixture_path.read_text())
+        for idx, response in enumerate(responses.values()):
+            try:
+                coordinates = json.loads(response["content"])["routes"][0]["geometry"][
+                    "coordinates"
+                ]
+            except (ValueError, KeyError, IndexError, TypeError):
+                continue
+            if len(coordinates) >= 2:
+                routes[f"{fixture_path.stem}_{idx}"] = LineString(coordinates)
+
+    return routes
+
+
+def build_split_benchmark(name: str, path: LineString) -> GeoBenchmark:
+    return GeoBenchmark(
+        name=f"split_path_by_country[{name}]",
+        run=functools.partial(
+            split_path_by_country,
+            path,
+            m_to_km(GEOD.geometry_length(path)),
+            TRAIN_COUNTRY_SPLIT_CONFIG,
+            "MAIN_TRIP",
+        ),
+    )
+
+
+def list_benchmarks() -> list[GeoBenchmark]:
+    benchmarks = [
+        build_split_benchmark(name, build_synthetic_route(waypoints, points_nb))
+        for name, (waypoints, points_nb) in SPLIT_ROUTES.items()
+    ]
+    benchmarks.extend(
+        build_split_benchmark(f"recorded_{name}", path)
+        for name, path in load_recorded_routes().items()
+    )
+
+    for name, (departure, arrival) in SEA_ROUTES.items():
+        benchmarks.extend(
+            GeoBenchmark(
+                name=f"{function.__name__}[{name}]",
+                run=functools.partial(function, departure, arrival),
+            )
+            for function in (
+                build_maritime_mesh,
+                build_maritime_network,
+                compute_maritime_shortest_path,
+            )
+        )
+
+    benchmarks.extend(
+        GeoBenchmark(
+            name=f"compute_great_circle_route[{name}]",
+            run=functools.partial(compute_great_circle_route, departure, arrival),
+            setup=compute_great_circle_geometry.cache_clear,
+        )
+        for name, (departure, arrival) in FLIGHTS.items()
+    )
+
+    return benchmarks
+
+
+def run_benchmark(benchmark: GeoBenchmark, iterations: int) -> BenchmarkResult:
+    """Time the runs of a benchmark, after a first untimed run loading the datasets."""
+    durations = []
+
+    for idx in range(iterations + 1):
+        if benchmark.setup is not None:
+            benchmark.setup()
+        start = time.perf_counter()
+        benchmark.run()
+        if idx > 0:
+            durations.append(time.perf_counter() - start)
+
+    return BenchmarkResult(
+        median_ms=round(float(np.median(durations)) * 1000, 3),
+        min_ms=round(min(durations) * 1000, 3),
+        iterations=iterations,
+    )
+
+
+def run_benchmarks(iterations: int, pattern: str | None = None) -> dict:
+    """Run the benchmarks whose name contains the pattern, all by default.
+
+    Returns:
+        The baseline: the environment of the run and the result of each
+        benchmark.
+
+    """
+    results = {}
+    for benchmark in list_benchmarks():
+        if pattern and pattern not in benchmark.name:
+            continue
+        results[benchmark.name] = run_benchmark(benchmark, iterations)
+        print(
+            f"{benchmark.name:<60} {results[benchmark.name].median_ms:>10.3f} ms",
+        )
+
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": {name: asdict(result) for name, result in results.items()},
+    }
+
+
+def compare_baselines(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """Compare the median durations of two runs.
+
+    Args:
+        baseline: Reference run, see run_benchmarks.
+        current: Run to check.
+        threshold: Relative slowdown above which a benchmark is a regression,
+            e.g. 0.2 for 20% slower.
+
+    Returns:
+        The names of the benchmarks slower than their baseline by more than
+        the threshold.
+
+    """
+    regressions = []
+
+    for name, result in current["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            print(f"{name:<60} {'new':>10}")
+            continue
+
+        ratio = result["median_ms"] / reference["median_ms"]
+        regression = ratio > 1 + threshold
+        print(
+            f"{name:<60} {reference['median_ms']:>10.3f} -> "
+            f"{result['median_ms']:>10.3f} ms ({ratio - 1:+.0%})"
+            f"{'  REGRESSION' if regression else ''}"
+        )
+        if regression:
+            regressions.append(name)
+
+    return regressions
+
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of the geographic hot paths."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument(
+        "--iterations",
+        type=int,
+        default=DEFAULT_ITERATIONS,
+        help="number of timed runs of each benchmark",
+    )
+    run_parser.add_argument(
+        "--filter",
+        help="only run the benchmarks whose name contains this text",
+    )
+    run_parser.add_argument("--output", type=Path, help="JSON file of the results")
+
+    compare_parser = subparsers.add_parser(
+        "compare",
+        help="compare a run to a baseline",
+    )
+    compare_parser.add_argument("baseline", type=Path, help="JSON file of reference")
+    compare_parser.add_argument("current", type=Path, help="JSON file to check")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="relative slowdown flagged as a regression (0.2 for 20%%)",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        baseline = run_benchmarks(args.iterations, args.filter)
+        if args.output:
+            args.output.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+    else:
+        regressions = compare_baselines(
+            json.loads(args.baseline.read_text()),
+            json.loads(args.current.read_text()),
+            args.threshold,
+        )
+        if regressions:
+            print(f"{len(regressions)} regressions above {args.threshold:.0%}")
+            sys.exit(1)
@@ -0,0 +1,162 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Record the responses of the external providers, and replay them offline.
+
+The adapters are mounted on the sessions of http_client, so the backend code
+runs unchanged: a RecordingAdapter sends the requests to the providers and
+keeps their responses, then a ReplayAdapter answers the same requests from
+the recorded fixtures, without any network access.
+"""
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+import json
+from pathlib import Path
+import threading
+from typing import Any, get_args
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from http_client import get_session, Provider
+
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+"""Directory of the recorded responses, one JSON file per scenario."""
+
+RECORDED_HEADERS = ("Content-Type", "Retry-After")
+"""Response headers kept in the fixtures."""
+
+
+def get_request_key(request: requests.PreparedRequest) -> str:
+    """Identify a request by its method, URL and body."""
+    body = request.body or ""
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    return f"{request.method} {request.url} {body}"
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Send the requests to the providers, and record their responses."""
+
+    def __init__(self) -> None:
+        """Initialize the adapter with no recorded response."""
+        super().__init__()
+        self.responses: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def send(
+        self, request: requests.PreparedRequest, **kwargs: object
+    ) -> requests.Response:
+        """Send a request, and record its response."""
+        response = super().send(request, **kwargs)
+
+        with self._lock:
+            self.responses[get_request_key(request)] = {
+                "status": response.status_code,
+                "headers": {
+                    header: response.headers[header]
+                    for header in RECORDED_HEADERS
+                    if header in response.headers
+                },
+                "content": response.content.decode("utf-8"),
+            }
+
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answer the requests with recorded responses, without network access."""
+
+    def __init__(self, responses: dict[str, dict[str, Any]]) -> None:
+        """Initialize the adapter with recorded responses, see RecordingAdapter."""
+        super().__init__()
+        self.responses = responses
+        self.missing: set[str] = set()
+
+    def send(
+        self, request: requests.PreparedRequest, **_kwargs: object
+    ) -> requests.Response:
+        """Answer a request with its recorded response.
+
+        Raises:
+            requests.ConnectionError: If no response was recorded for the
+                request, as if the provider could not be reached.
+
+        """
+        key = get_request_key(request)
+        recorded = self.responses.get(key)
+        if recorded is None:
+            self.missing.add(key)
+            raise requests.ConnectionError(
+                f"No recorded response for {request.method} {request.url}",
+                request=request,
+            )
+
+        response = requests.Response()
+        response.status_code = recorded["status"]
+        response.headers = CaseInsensitiveDict(recorded["headers"])
+        response._content = recorded["content"].encode("utf-8")  # noqa: SLF001
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        """Nothing to release, no connection is ever opened."""
+
+
+@contextmanager
+def use_adapter(adapter: BaseAdapter) -> Iterator[None]:
+    """Send the requests of every provider session through an adapter."""
+    sessions = [get_session(provider) for provider in get_args(Provider)]
+    previous_adapters = [dict(session.adapters) for session in sessions]
+
+    for session in sessions:
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    try:
+        yield
+    finally:
+        for session, adapters in zip(sessions, previous_adapters):
+            session.adapters.clear()
+            session.adapters.update(adapters)
+
+
+def load_fixture(name: str) -> dict[str, dict[str, Any]]:
+    """Load the recorded responses of a scenario.
+
+    Raises:
+        FileNotFoundError: If the scenario was never recorded.
+
+    """
+    fixture_path = FIXTURES_DIR / f"{name}.json"
+    if not fixture_path.exists():
+        raise FileNotFoundError(
+            f"{fixture_path} not found, the scenario must be recorded first"
+        )
+    return json.loads(fixture_path.read_text())
+
+
+def save_fixture(name: str, responses: dict[str, dict[str, Any]]):
+    """Save the recorded responses of a scenario."""
+    FIXTURES_DIR.mkdir(parents=True, exist_ok=True)
+    (FIXTURES_DIR / f"{name}.json").write_text(
+        json.dumps(responses, indent=1, sort_keys=True)
+    )
@@ -0,0 +1,94 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Representative payloads of /compute-emissions, used by the benchmarks."""
+
+from typing import Any
+
+
+Point = tuple[float, float]
+
+PARIS = (2.3522, 48.8566)
+LYON = (4.8357, 45.7640)
+MARSEILLE = (5.3698, 43.2965)
+AJACCIO = (8.7369, 41.9192)
+NICE = (7.2620, 43.7102)
+CALVI = (8.7570, 42.5670)
+BERLIN = (13.4050, 52.5200)
+MUNICH = (11.5820, 48.1351)
+NEW_YORK = (-74.0060, 40.7128)
+
+
+def build_step(
+    point: Point,
+    transport_mean: str,
+    passengers_nb: int | None = None,
+    ferry_option: str | None = None,
+) -> dict[str, Any]:
+    return {
+        "location": "",
+        "lon": point[0],
+        "lat": point[1],
+        "transport-mean": transport_mean,
+        "passengers-nb": passengers_nb,
+        "ferry-option": ferry_option,
+    }
+
+
+def build_trip(departure: Point, steps: list[dict[str, Any]]) -> dict[str, Any]:
+    return {
+        "departure": {"location": "", "lon": departure[0], "lat": departure[1]},
+        "steps": steps,
+    }
+
+
+SCENARIOS: dict[str, dict[str, Any]] = {
+    "train": {
+        "main-trip": build_trip(PARIS, [build_step(LYON, "train")]),
+    },
+    "train_cross_border": {
+        "main-trip": build_trip(PARIS, [build_step(BERLIN, "train")]),
+    },
+    "ecar": {
+        "main-trip": build_trip(PARIS, [build_step(MUNICH, "ecar", passengers_nb=2)]),
+    },
+    "ferry": {
+        "main-trip": build_trip(
+            MARSEILLE,
+            [build_step(AJACCIO, "ferry", ferry_option="cabin")],
+        ),
+    },
+    "sail": {
+        "main-trip": build_trip(NICE, [build_step(CALVI, "sail")]),
+    },
+    "plane": {
+        "main-trip": build_trip(PARIS, [build_step(NEW_YORK, "plane")]),
+    },
+    "multi_step": {
+        "main-trip": build_trip(
+            PARIS,
+            [
+                build_step(LYON, "train"),
+                build_step(MARSEILLE, "bus"),
+                build_step(AJACCIO, "ferry", ferry_option="none"),
+            ],
+        ),
+        "second-trip": build_trip(PARIS, [build_step(AJACCIO, "plane")]),
+    },
+}
+"""Payloads of the benchmark scenarios, by name. Single-step trips also get
+the alternative direct trips, like on the website."""
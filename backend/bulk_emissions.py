@@ -0,0 +1,311 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compute the emissions of large files of trips, without going through the API.
+
+    python bulk_emissions.py trips.csv results/ --processes 8
+
+The input file (CSV or Parquet) contains one row per leg, and the legs of a
+trip are consecutive rows sharing the same trip_id:
+
+    trip_id, departure_lon, departure_lat, arrival_lon, arrival_lat,
+    transport_mean, [passengers_nb], [ferry_option]
+
+passengers_nb is required for car and ecar legs, and the departure of a leg
+which is not the first one of its trip is ignored: legs start from the
+arrival of the previous leg.
+
+The input is read in chunks, and the trips of each chunk are computed in a
+pool of worker processes, each one keeping its datasets and caches loaded.
+The results of each chunk are written to a Parquet file of the output
+directory, with one row per leg. Chunks already written are skipped, so an
+interrupted run is resumed by running the same command again.
+"""
+
+import argparse
+from collections.abc import Iterator
+import json
+import logging
+import multiprocessing
+from pathlib import Path
+import time
+from typing import Any
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pydantic import ValidationError
+
+from geo_railway_index import load_railway_index
+from geo_routing_maritime import build_land_index, load_maritime_graph
+from models import Trip
+from trip_service import compute_custom_trip_emissions
+
+
+logger = logging.getLogger(__name__)
+
+
+BULK_CHUNK_SIZE = 1000
+"""Default number of input rows read at once."""
+
+BULK_TASK_CHUNK_SIZE = 8
+"""Number of trips sent at once to a worker process."""
+
+CHECKPOINT_FILENAME = "_checkpoint.json"
+"""Run settings, ignored when the output directory is read as a Parquet dataset."""
+
+RESULT_SCHEMA = pa.schema(
+    [
+        ("trip_id", pa.string()),
+        ("step", pa.int32()),
+        ("transport_mean", pa.string()),
+        ("path_length_km", pa.float64()),
+        ("kg_co2_eq", pa.float64()),
+        ("error", pa.string()),
+    ]
+)
+"""Schema of the results: one row per leg, or a single row with the error of
+a trip which cannot be computed."""
+
+TripRows = tuple[str, list[dict[str, Any]]]
+"""Trip id and input rows of a trip."""
+
+
+def read_input_chunks(input_path: Path, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Read a CSV or Parquet file of legs by chunks of rows."""
+    if input_path.suffix == ".parquet":
+        for batch in pq.ParquetFile(input_path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(input_path, chunksize=chunk_size)
+
+
+def group_trips(chunks: Iterator[pd.DataFrame]) -> Iterator[list[TripRows]]:
+    """Group the consecutive legs of each trip, chunk by chunk.
+
+    A trip whose legs span two chunks is yielded with the first one, so the
+    trips of each chunk only depend on the chunk size.
+
+    Yields:
+        The trips starting in each input chunk.
+
+    """
+    pending: list[TripRows] = []
+
+    for chunk in chunks:
+        trips: list[TripRows] = []
+
+        for row in chunk.astype(object).where(chunk.notna(), None).to_dict("records"):
+            trip_id = str(row["trip_id"])
+            if trips and trips[-1][0] == trip_id:
+                trips[-1][1].append(row)
+            elif not trips and pending and pending[-1][0] == trip_id:
+                pending[-1][1].append(row)
+            else:
+                trips.append((trip_id, [row]))
+
+        # The last trip of the chunk may continue in the next chunk
+        if trips:
+            if pending:
+                yield pending
+            pending = trips
+
+    if pending:
+        yield pending
+
+
+def build_trip(rows: list[dict[str, Any]]) -> Trip:
+    """Build a trip from its input rows.
+
+    Raises:
+        ValidationError: If the rows do not describe a valid trip.
+
+    """
+    return Trip.model_validate(
+        {
+            "departure": {
+                "location": "",
+                "lon": rows[0]["departure_lon"],
+                "lat": rows[0]["departure_lat"],
+            },
+            "steps": [
+                {
+                    "location": "",
+                    "lon": row["arrival_lon"],
+                    "lat": row["arrival_lat"],
+                    "transport-mean": row["transport_mean"],
+                    "passengers-nb": row.get("passengers_nb"),
+                    "ferry-option": row.get("ferry_option"),
+                }
+                for row in rows
+            ],
+        }
+    )
+
+
+def compute_bulk_trip(trip_rows: TripRows) -> list[dict[str, Any]]:
+    """Compute the emissions of a trip, in a worker process.
+
+    Returns:
+        The result rows of the trip, see RESULT_SCHEMA.
+
+    """
+    trip_id, rows = trip_rows
+
+    try:
+        trip_result, _ = compute_custom_trip_emissions(
+            "MAIN_TRIP",
+            build_trip(rows),
+        )
+    except (ValueError, ValidationError) as err:
+        error = str(err)
+    except Exception as err:
+        # An unexpected error must not stop the processing of the file
+        logger.exception("Trip %s failed", trip_id)
+        error = f"{type(err).__name__}: {err}"
+    else:
+        return [
+            {
+                "trip_id": trip_id,
+                "step": idx,
+                "transport_mean": step.transport,
+                "path_length_km": step.path_length,
+                "kg_co2_eq": sum(part.kg_co2_eq for part in step.emissions),
+                "error": None,
+            }
+            for idx, step in enumerate(trip_result.steps)
+        ]
+
+    return [
+        {
+            "trip_id": trip_id,
+            "step": None,
+            "transport_mean": None,
+            "path_length_km": None,
+            "kg_co2_eq": None,
+            "error": error,
+        }
+    ]
+
+
+def init_worker():
+    """Load the datasets and indexes of a worker process before its first trip."""
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s %(levelname)s %(process)d %(name)s - %(message)s",
+    )
+    load_maritime_graph()
+    build_land_index()
+    load_railway_index()
+
+
+def check_checkpoint(output_dir: Path, input_path: Path, chunk_size: int):
+    """Check that a run can be resumed in the output directory.
+
+    Raises:
+        ValueError: If the output directory was used for another input file
+            or another chunk size.
+
+    """
+    checkpoint_path = output_dir / CHECKPOINT_FILENAME
+    checkpoint = {"input": str(input_path.resolve()), "chunk_size": chunk_size}
+
+    if checkpoint_path.exists():
+        previous_checkpoint = json.loads(checkpoint_path.read_text())
+        if previous_checkpoint != checkpoint:
+            raise ValueError(
+                f"{output_dir} contains the results of another run: {previous_checkpoint}"
+            )
+    else:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        checkpoint_path.write_text(json.dumps(checkpoint))
+
+
+def write_part(rows: list[dict[str, Any]], part_path: Path):
+    """Write the results of a chunk, atomically so that a part is never partial."""
+    tmp_path = part_path.with_suffix(".tmp")
+    pq.write_table(pa.Table.from_pylist(rows, schema=RESULT_SCHEMA), tmp_path)
+    tmp_path.replace(part_path)
+
+
+def compute_bulk_emissions(
+    input_path: Path,
+    output_dir: Path,
+    processes: int | None = None,
+    chunk_size: int = BULK_CHUNK_SIZE,
+):
+    """Compute the emissions of the trips of a file, see the module docstring.
+
+    Args:
+        input_path: CSV or Parquet file of legs.
+        output_dir: Directory of the results, one Parquet file per chunk.
+        processes: Number of worker processes, the number of CPUs by default.
+        chunk_size: Number of input rows read at once.
+
+    """
+    check_checkpoint(output_dir, input_path, chunk_size)
+
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        for chunk_idx, trips in enumerate(
+            group_trips(read_input_chunks(input_path, chunk_size))
+        ):
+            part_path = output_dir / f"part-{chunk_idx:06d}.parquet"
+            if part_path.exists():
+                logger.info("Chunk %s already computed", chunk_idx)
+                continue
+
+            start = time.perf_counter()
+            rows = [
+                row
+                for trip_rows in pool.imap(
+                    compute_bulk_trip,
+                    trips,
+                    chunksize=BULK_TASK_CHUNK_SIZE,
+                )
+                for row in trip_rows
+            ]
+            write_part(rows, part_path)
+
+            logger.info(
+                "Chunk %s: %s trips computed in %.1fs",
+                chunk_idx,
+                len(trips),
+                time.perf_counter() - start,
+            )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s - %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Compute the emissions of a CSV or Parquet file of trips."
+    )
+    parser.add_argument("input", type=Path, help="CSV or Parquet file of legs")
+    parser.add_argument("output", type=Path, help="directory of the results")
+    parser.add_argument("--processes", type=int, help="number of worker processes")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=BULK_CHUNK_SIZE,
+        help="number of input rows read at once",
+    )
+    args = parser.parse_args()
+
+    compute_bulk_emissions(args.input, args.output, args.processes, args.chunk_size)
@@ -0,0 +1,226 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Local index of railway points, used to snap coordinates onto railways offline.
+
+The index is built from an OpenStreetMap extract containing railway ways,
+for instance filtered with osmium:
+
+    osmium tags-filter europe-latest.osm.pbf w/railway=rail -o static/railways.osm.pbf
+    python geo_railway_index.py static/railways.osm.pbf
+
+The vertices of the `railway=rail` ways are thinned on a regular grid and
+stored as a compact coordinate array, with their 3D unit vectors computed
+offline. Both are loaded memory-mapped, and the KD-tree is built on the
+unit vectors without copying them, so their pages are shared by the worker
+processes through the page cache. Each worker still builds the indices and
+nodes of its KD-tree, about 21 bytes per point (about 60 MB for the few
+million points of a Europe extract), unless the app is preloaded before the
+workers are forked (gunicorn --preload).
+
+The area covered by the extract is stored with the points, as the cells of a
+coarse grid containing railway points: coordinates outside of these cells
+are not answered by the index, so that the next provider is used (see
+transport_train.RAILWAY_POINT_PROVIDERS).
+"""
+
+from dataclasses import dataclass
+from functools import cache
+import logging
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+import pyogrio
+from scipy.spatial import cKDTree
+import shapely
+
+from models import ProviderUnavailableError
+
+
+logger = logging.getLogger(__name__)
+
+
+RAILWAY_INDEX_DIR = Path("static/compiled/railway_index")
+
+RAILWAY_GRID_STEP = 0.001
+"""Step of the grid used to thin railway vertices. In degrees (about 100 m)."""
+
+RAILWAY_COVERAGE_STEP = 0.25
+"""Step of the grid of the cells covered by the index. In degrees (about 25 km)."""
+
+EARTH_RADIUS_KM = 6371
+
+
+@dataclass(frozen=True)
+class RailwayIndex:
+    """Railway points indexed in a KD-tree."""
+
+    points: np.ndarray
+    """Coordinates of the railway points as (longitude, latitude), shape (n, 2)."""
+    tree: cKDTree
+    """KD-tree of the railway points, as 3D unit vectors."""
+    coverage_cells: np.ndarray
+    """Sorted keys of the grid cells containing railway points (see get_coverage_cells)."""
+
+
+def to_unit_vectors(coordinates: np.ndarray) -> np.ndarray:
+    """Convert (longitude, latitude) coordinates to 3D unit vectors.
+
+    Euclidean distances between unit vectors increase with great-circle
+    distances, so they can be indexed in a KD-tree.
+
+    """
+    lon, lat = np.radians(coordinates).T
+    return np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+
+
+def get_coverage_cells(coordinates: np.ndarray) -> np.ndarray:
+    """Keys of the cells of the coverage grid containing (longitude, latitude) coordinates."""
+    rows_nb = round(180 / RAILWAY_COVERAGE_STEP) + 1
+    lon, lat = np.asarray(coordinates, dtype=np.float64).T
+    columns = np.floor((lon + 180) / RAILWAY_COVERAGE_STEP).astype(np.int64)
+    rows = np.floor((lat + 90) / RAILWAY_COVERAGE_STEP).astype(np.int64)
+    return columns * rows_nb + rows
+
+
+def build_railway_index(osm_extract_path: str | Path) -> np.ndarray:
+    """Extract the railway points of an OpenStreetMap extract.
+
+    Args:
+        osm_extract_path: OpenStreetMap extract (.osm.pbf or .osm).
+
+    Returns:
+        The railway points as (longitude, latitude), shape (n, 2).
+
+    """
+    railways = pyogrio.read_dataframe(
+        osm_extract_path,
+        layer="lines",
+        columns=["railway"],
+        where="railway = 'rail'",
+    )
+    coordinates = shapely.get_coordinates(railways.geometry.to_numpy())
+
+    # Keep one vertex per grid cell
+    cells = np.round(coordinates / RAILWAY_GRID_STEP).astype(np.int64)
+    _, kept = np.unique(cells, axis=0, return_index=True)
+    return coordinates[np.sort(kept)].astype(np.float32)
+
+
+def save_railway_index(points: np.ndarray, directory: Path = RAILWAY_INDEX_DIR):
+    """Save the railway points, their unit vectors and the cells they cover."""
+    directory.mkdir(parents=True, exist_ok=True)
+    np.save(directory / "points.npy", points)
+    np.save(
+        directory / "unit_vectors.npy",
+        to_unit_vectors(points.astype(np.float64)),
+    )
+    np.save(directory / "coverage_cells.npy", np.unique(get_coverage_cells(points)))
+
+
+@cache
+def load_railway_index(directory: Path = RAILWAY_INDEX_DIR) -> RailwayIndex | None:
+    """Load the railway index, once per process.
+
+    Returns:
+        The railway index, or None if it has not been built.
+
+    """
+    start = time.perf_counter()
+
+    try:
+        points = np.load(directory / "points.npy", mmap_mode="r")
+        unit_vectors = np.load(directory / "unit_vectors.npy", mmap_mode="r")
+        coverage_cells = np.load(directory / "coverage_cells.npy")
+    except FileNotFoundError:
+        logger.warning("No railway index, run geo_railway_index.py")
+        return None
+
+    index = RailwayIndex(
+        points=points,
+        # The float64 memory-mapped unit vectors are used without any copy
+        tree=cKDTree(unit_vectors, copy_data=False),
+        coverage_cells=coverage_cells,
+    )
+
+    logger.info(
+        "Loaded railway index (%s points) in %.3fs",
+        len(points),
+        time.perf_counter() - start,
+    )
+    return index
+
+
+def find_nearest_railway_point(
+    coordinates: tuple[float, float],
+    max_distance_km: float,
+) -> tuple[float, float] | None:
+    """Find the nearest railway point using the local railway index.
+
+    Args:
+        coordinates: Coordinates as (longitude, latitude).
+        max_distance_km: Maximum distance of the railway point.
+
+    Coordinates are covered by the index when their cell of the coverage
+    grid contains railway points of the extract: outside of the extract, or
+    in areas without any railway in it, the index cannot tell whether there
+    is a railway nearby.
+
+    Returns:
+        Coordinates of the nearest railway point as (longitude, latitude),
+        or None if there is no railway within max_distance_km.
+
+    Raises:
+        ProviderUnavailableError:
+            If the index has not been built or does not cover the coordinates.
+
+    """
+    railway_index = load_railway_index()
+    if railway_index is None:
+        raise ProviderUnavailableError("No railway index")
+
+    cell = get_coverage_cells(np.array([coordinates]))[0]
+    cell_idx = np.searchsorted(railway_index.coverage_cells, cell)
+    if (
+        cell_idx == len(railway_index.coverage_cells)
+        or railway_index.coverage_cells[cell_idx] != cell
+    ):
+        raise ProviderUnavailableError(
+            f"{coordinates} is not covered by the railway index"
+        )
+
+    # Chord length between unit vectors matching the maximum distance
+    max_chord = 2 * np.sin(max_distance_km / EARTH_RADIUS_KM / 2)
+    _, nearest = railway_index.tree.query(
+        to_unit_vectors(np.array([coordinates]))[0],
+        distance_upper_bound=max_chord,
+    )
+    if nearest == len(railway_index.points):
+        return None
+
+    railway_lon, railway_lat = railway_index.points[nearest]
+    return float(railway_lon), float(railway_lat)
+
+
+if __name__ == "__main__":
+    railway_points = build_railway_index(sys.argv[1])
+    save_railway_index(railway_points)
+    print(f"{len(railway_points)} railway points saved to {RAILWAY_INDEX_DIR}")
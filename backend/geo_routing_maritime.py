@@ -15,13 +15,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from dataclasses import dataclass
 from functools import lru_cache
-from itertools import pairwise
+import hashlib
+import heapq
+from itertools import count, pairwise
+import logging
+import math
+import os
+from pathlib import Path
+import time
+from typing import get_args, Literal
 
 import geopandas as gpd
-import momepy
 import networkx as nx
 import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+import shapely
+from shapely import STRtree
 from shapely.geometry import (
     CAP_STYLE,
     LineString,
@@ -30,7 +42,12 @@ from shapely.geometry import (
 from shapely.geometry.base import BaseGeometry
 from shapely.ops import nearest_points, unary_union
 
-from parameters import train_intensity
+from metrics import measured_stage, observe_maritime_search
+from parameters import GEOD, train_intensity
+from utils import m_to_km
+
+
+logger = logging.getLogger(__name__)
 
 
 PANAMA_CANAL = LineString(
@@ -61,6 +78,82 @@ SEARCH_MARGIN = 30
 LINE_EXTENSION_FACTOR = 0.001
 """Small geometric extension applied to maritime segments to avoid disconnected routing graph edges."""
 
+# Global maritime graph parameters
+GLOBAL_MESH_STEP = 1.5
+"""Spacing between two lines of the global maritime mesh. In degrees."""
+GLOBAL_MESH_LATITUDE_RANGE = (-80, 85)
+"""Latitudes covered by the global maritime mesh. In degrees."""
+MARITIME_GRAPH_PATH = Path("static/compiled/maritime_graph.npz")
+"""Location of the prebuilt global maritime graph (see build_global_maritime_network)."""
+SNAP_RADIUS = 1.5 * GLOBAL_MESH_STEP
+"""Maximum distance between a coastline point and the graph nodes it is connected to. In degrees."""
+LAND_CROSSING_TOLERANCE = 1e-6
+"""Maximum length of a connection to the maritime graph lying over land. In degrees."""
+MARITIME_GRAPH_TOLERANCE = 0.05
+"""Maximum relative excess length of a route computed on the global maritime graph,
+compared to the same route computed on a mesh built for the request."""
+MARITIME_REFERENCE_ROUTES = {
+    "le_havre_new_york": ((0.11, 49.49), (-74.0, 40.7)),
+    "genoa_barcelona": ((8.93, 44.41), (2.17, 41.38)),
+    "genoa_tunis": ((8.93, 44.41), (10.18, 36.81)),
+    "kiel_oslo": ((10.14, 54.32), (10.75, 59.91)),
+    "helsinki_stockholm": ((24.94, 60.17), (18.07, 59.33)),
+    "rotterdam_singapore": ((4.48, 51.92), (103.8, 1.26)),
+}
+"""Departure and arrival coordinates of the routes used to check the global
+maritime graph (see check_maritime_graph)."""
+
+GraphBackend = Literal["networkx", "scipy"]
+SearchAlgorithm = Literal["dijkstra", "astar"]
+
+MARITIME_GRAPH_BACKEND: GraphBackend = os.getenv("MARITIME_GRAPH_BACKEND", "scipy")
+"""Graph library used to find maritime shortest paths, "scipy" or "networkx" (see find_shortest_path)."""
+MARITIME_SEARCH_ALGORITHM: SearchAlgorithm = os.getenv(
+    "MARITIME_SEARCH_ALGORITHM", "astar"
+)
+"""Shortest-path algorithm used with the "networkx" backend, "astar" or "dijkstra" (see find_shortest_path_networkx)."""
+
+if MARITIME_GRAPH_BACKEND not in get_args(GraphBackend):
+    msg = f"Unknown MARITIME_GRAPH_BACKEND: {MARITIME_GRAPH_BACKEND}"
+    raise ValueError(msg)
+if MARITIME_SEARCH_ALGORITHM not in get_args(SearchAlgorithm):
+    msg = f"Unknown MARITIME_SEARCH_ALGORITHM: {MARITIME_SEARCH_ALGORITHM}"
+    raise ValueError(msg)
+
+
+@dataclass(frozen=True)
+class MaritimeNetwork:
+    """Navigable maritime network stored as arrays.
+
+    Nodes are the endpoints of the network segments. Edges are undirected:
+    when several segments connect the same pair of nodes, only the shortest
+    one is kept.
+    """
+
+    nodes: np.ndarray
+    """Coordinates of the nodes, shape (n_nodes, 2)."""
+    edge_nodes: np.ndarray
+    """Nodes of each edge (lowest node index first), shape (n_edges, 2)."""
+    edge_lengths: np.ndarray
+    """Planar length of each edge. In degrees."""
+    edge_segments: np.ndarray
+    """Geometry of each edge."""
+    edge_keys: np.ndarray
+    """Sorted keys of the edges (see get_edge_keys), used to find the edges of a path."""
+
+
+@dataclass(frozen=True)
+class MaritimeGraph:
+    """Prebuilt global maritime routing graph."""
+
+    network: MaritimeNetwork
+    graph: nx.Graph | None
+    """NetworkX graph of the network, only built for the "networkx" backend."""
+    nodes_tree: STRtree
+    coast_node_indices: np.ndarray
+    """Nodes located on the coastline, used as entry/exit points."""
+    coast_nodes_tree: STRtree
+
 
 @lru_cache(maxsize=1)
 def build_coast_geometry() -> tuple[BaseGeometry, list[BaseGeometry]]:
@@ -140,6 +233,7 @@ def extend_line(line: LineString, extend_start=False):
     return LineString([new_start_point, *line.coords[1:], new_end_point])
 
 
+@measured_stage("build_maritime_mesh")
 def build_maritime_mesh(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
@@ -179,7 +273,19 @@ def build_maritime_mesh(
     for lat in np.linspace(lat_min, lat_max, MESH_RESOLUTION):
         mesh_segments.append(LineString([(lon_min, lat), (lon_max, lat)]))
 
-    # Remove land intersections to keep only navigable sea segments.
+    return remove_land_from_mesh(mesh_segments, land_geometries)
+
+
+def remove_land_from_mesh(
+    mesh_segments: list[LineString],
+    land_geometries: gpd.GeoDataFrame,
+) -> list[LineString]:
+    """Remove land intersections to keep only navigable sea segments.
+
+    The remaining segments are slightly extended to improve graph
+    connectivity between adjacent edges.
+
+    """
     navigable_segments = gpd.overlay(
         gpd.GeoDataFrame(geometry=gpd.GeoSeries(mesh_segments)),
         land_geometries[["geometry"]],
@@ -239,6 +345,7 @@ def build_direct_sea_connection(
     return unary_union(sea_connection.geometry)
 
 
+@measured_stage("build_maritime_network")
 def build_maritime_network(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
@@ -297,18 +404,676 @@ def build_maritime_network(
     )
 
 
+def build_global_maritime_network(
+    land_geometries: gpd.GeoDataFrame = train_intensity,
+) -> list[LineString]:
+    """Build a navigable maritime network covering the whole world.
+
+    The network is composed of:
+        - coast lines, split at each of their vertices so that every vertex
+          of the coastline can be used as an entry or exit point
+        - canal connections
+        - a global sea mesh, with one line every GLOBAL_MESH_STEP degrees
+          along meridians, parallels and both diagonals
+
+    Diagonals make the mesh 8-connected: a path on the mesh is at most 8%
+    longer than the straight line, instead of 41% with meridians and
+    parallels only. Routes are checked against the meshes built for each
+    request with check_maritime_graph.
+
+    Building it takes a few seconds, so it is done once with
+    `python geo_routing_maritime.py` and saved with save_maritime_graph.
+
+    Returns:
+        The list of navigable maritime segments, split at their intersections.
+
+    """
+    _, coast_segments = build_coast_geometry()
+    coast_edges = [
+        LineString(edge)
+        for coast_segment in coast_segments
+        for edge in pairwise(coast_segment.coords)
+    ]
+
+    lat_min, lat_max = GLOBAL_MESH_LATITUDE_RANGE
+    mesh_segments = [
+        LineString([(lon, lat_min), (lon, lat_max)])
+        for lon in np.arange(-180, 180 + GLOBAL_MESH_STEP / 2, GLOBAL_MESH_STEP)
+    ]
+    mesh_segments.extend(
+        LineString([(-180, lat), (180, lat)])
+        for lat in np.arange(lat_min, lat_max + GLOBAL_MESH_STEP / 2, GLOBAL_MESH_STEP)
+    )
+    # Diagonals going through the mesh nodes, lat = lon + offset and
+    # lat = -lon + offset, clipped to the mesh bounds
+    for offset in np.arange(
+        lat_min - 180,
+        lat_max + 180 + GLOBAL_MESH_STEP / 2,
+        GLOBAL_MESH_STEP,
+    ):
+        for direction in (1, -1):
+            lon_start, lon_end = sorted(
+                [direction * (lat_min - offset), direction * (lat_max - offset)]
+            )
+            lon_start, lon_end = max(lon_start, -180), min(lon_end, 180)
+            if lon_end > lon_start:
+                mesh_segments.append(
+                    LineString(
+                        [
+                            (lon_start, direction * lon_start + offset),
+                            (lon_end, direction * lon_end + offset),
+                        ]
+                    )
+                )
+    sea_mesh_segments = remove_land_from_mesh(mesh_segments, land_geometries)
+
+    maritime_network = unary_union(
+        [
+            *coast_edges,
+            *sea_mesh_segments,
+            *MARITIME_CANALS,
+        ]
+    )
+    return list(shapely.get_parts(maritime_network))
+
+
+def compute_land_hash(land_geometries: gpd.GeoDataFrame = train_intensity) -> str:
+    """Hash of the land geometries, used to detect outdated maritime graphs."""
+    wkb_geometries = shapely.to_wkb(land_geometries.geometry.to_numpy())
+    return hashlib.sha256(b"".join(wkb_geometries)).hexdigest()
+
+
+def get_edge_keys(u: np.ndarray, v: np.ndarray, n_nodes: int) -> np.ndarray:
+    """Unique integer key of the undirected edges between nodes u and v."""
+    return np.minimum(u, v).astype(np.int64) * n_nodes + np.maximum(u, v)
+
+
+def index_maritime_network(segments) -> MaritimeNetwork:
+    """Convert maritime segments into an array-based network.
+
+    Segment endpoints are extracted with vectorized shapely functions and
+    deduplicated with numpy to get the network nodes.
+
+    Args:
+        segments: LineString geometries of the network, split at their
+            intersections.
+
+    Returns:
+        The corresponding MaritimeNetwork.
+
+    """
+    segments = np.asarray(segments, dtype=object)
+    n_segments = len(segments)
+
+    endpoints = np.concatenate(
+        [
+            shapely.get_coordinates(shapely.get_point(segments, 0)),
+            shapely.get_coordinates(shapely.get_point(segments, -1)),
+        ]
+    )
+    nodes, endpoint_nodes = np.unique(endpoints, axis=0, return_inverse=True)
+    endpoint_nodes = endpoint_nodes.reshape(-1)
+    u, v = endpoint_nodes[:n_segments], endpoint_nodes[n_segments:]
+
+    # Drop loops and keep the shortest segment between each pair of nodes
+    edge_keys = get_edge_keys(u, v, len(nodes))
+    lengths = shapely.length(segments)
+    candidates = np.flatnonzero(u != v)
+    candidates = candidates[np.lexsort((lengths[candidates], edge_keys[candidates]))]
+    edges = candidates[np.unique(edge_keys[candidates], return_index=True)[1]]
+
+    return MaritimeNetwork(
+        nodes=nodes,
+        edge_nodes=np.stack([np.minimum(u, v)[edges], np.maximum(u, v)[edges]], 1),
+        edge_lengths=lengths[edges],
+        edge_segments=segments[edges],
+        edge_keys=edge_keys[edges],
+    )
+
+
+def build_networkx_graph(network: MaritimeNetwork) -> nx.Graph:
+    """Build the NetworkX graph of a maritime network.
+
+    Nodes are the node indices of the network and edges are weighted by
+    their "length".
+
+    """
+    graph = nx.Graph()
+    graph.add_nodes_from(range(len(network.nodes)))
+    graph.add_weighted_edges_from(
+        zip(
+            network.edge_nodes[:, 0].tolist(),
+            network.edge_nodes[:, 1].tolist(),
+            network.edge_lengths.tolist(),
+        ),
+        weight="length",
+    )
+    return graph
+
+
+def save_maritime_graph(
+    network_segments: list[LineString],
+    path: Path = MARITIME_GRAPH_PATH,
+):
+    """Serialize a maritime network to a compressed numpy archive.
+
+    The archive stores the coordinates of the segments, the nodes located on
+    the coastline, and the parameters used to build the network so that an
+    outdated graph is never loaded.
+
+    """
+    coordinates, segment_indices = shapely.get_coordinates(
+        network_segments,
+        return_index=True,
+    )
+
+    coast_geometry, _ = build_coast_geometry()
+    network = index_maritime_network(network_segments)
+    coast_node_indices = np.flatnonzero(
+        shapely.dwithin(shapely.points(network.nodes), coast_geometry, 1e-9)
+    )
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(
+        path,
+        coordinates=coordinates,
+        segment_indices=segment_indices,
+        coast_node_indices=coast_node_indices,
+        land_hash=compute_land_hash(),
+        mesh_step=GLOBAL_MESH_STEP,
+    )
+
+
+@lru_cache(maxsize=1)
+def load_maritime_graph(path: Path = MARITIME_GRAPH_PATH) -> MaritimeGraph | None:
+    """Load the prebuilt global maritime graph.
+
+    The graph is loaded once per process and cached.
+
+    Returns:
+        The maritime graph, or None if it has not been built or is outdated.
+        Maritime routes are then computed with a mesh built for each request.
+
+    """
+    start = time.perf_counter()
+
+    try:
+        archive = np.load(path)
+    except FileNotFoundError:
+        logger.warning("No prebuilt maritime graph, run geo_routing_maritime.py")
+        return None
+
+    if (
+        str(archive["land_hash"]) != compute_land_hash()
+        or archive["mesh_step"] != GLOBAL_MESH_STEP
+        or "coast_node_indices" not in archive
+    ):
+        logger.warning(
+            "Prebuilt maritime graph is outdated, run geo_routing_maritime.py"
+        )
+        return None
+
+    network = index_maritime_network(
+        shapely.linestrings(
+            archive["coordinates"],
+            indices=archive["segment_indices"],
+        )
+    )
+    coast_node_indices = archive["coast_node_indices"]
+
+    logger.info(
+        "Loaded maritime graph (%s nodes, %s edges) in %.3fs",
+        len(network.nodes),
+        len(network.edge_keys),
+        time.perf_counter() - start,
+    )
+
+    return MaritimeGraph(
+        network=network,
+        graph=(
+            build_networkx_graph(network)
+            if MARITIME_GRAPH_BACKEND == "networkx"
+            else None
+        ),
+        nodes_tree=STRtree(shapely.points(network.nodes)),
+        coast_node_indices=coast_node_indices,
+        coast_nodes_tree=STRtree(
+            shapely.points(network.nodes[coast_node_indices]),
+        ),
+    )
+
+
+@lru_cache(maxsize=1)
+def build_land_index(land_geometries=train_intensity) -> tuple[STRtree, np.ndarray]:
+    """Build a spatial index over the land geometries.
+
+    Invalid geometries are fixed with a zero-width buffer and all geometries
+    are prepared. The result is cached after the first computation.
+
+    Returns:
+        A tuple containing:
+            - The STRtree of the land geometries
+            - The array of indexed land geometries
+
+    """
+    geometries = land_geometries.geometry.to_numpy().copy()
+    invalid = ~shapely.is_valid(geometries)
+    geometries[invalid] = shapely.buffer(geometries[invalid], 0)
+    shapely.prepare(geometries)
+    return STRtree(geometries), geometries
+
+
+def compute_land_crossing_lengths(lines: list[LineString]) -> np.ndarray:
+    """Compute the length of each line that lies over land. In degrees."""
+    land_tree, land_geometries = build_land_index()
+    line_indices, land_indices = land_tree.query(lines, predicate="intersects")
+
+    crossing_lengths = np.zeros(len(lines))
+    np.add.at(
+        crossing_lengths,
+        line_indices,
+        shapely.length(
+            shapely.intersection(
+                np.asarray(lines, dtype=object)[line_indices],
+                land_geometries[land_indices],
+            )
+        ),
+    )
+    return crossing_lengths
+
+
+def connect_to_maritime_graph(
+    coordinates: tuple[float, float],
+    maritime_graph: MaritimeGraph,
+) -> tuple[Point, dict[int, float]]:
+    """Snap a point onto the prebuilt maritime graph.
+
+    The point is first connected to the nearest coastline point. This coastline
+    point is then connected to:
+        - the nearest coastline node of the graph
+        - every node within SNAP_RADIUS that can be reached without crossing land
+
+    Returns:
+        A tuple containing:
+            - The nearest coastline point
+            - The graph nodes the coastline point is connected to, with the
+              length of the connection
+
+    """
+    coast_geometry, _ = build_coast_geometry()
+    coast_point = nearest_points(Point(coordinates), coast_geometry)[1]
+
+    nearest_coast_node = maritime_graph.coast_node_indices[
+        maritime_graph.coast_nodes_tree.query_nearest(coast_point)[0]
+    ]
+    nearby_nodes = maritime_graph.nodes_tree.query(
+        coast_point,
+        predicate="dwithin",
+        distance=SNAP_RADIUS,
+    )
+    candidate_nodes = [nearest_coast_node, *nearby_nodes]
+
+    connections = [
+        LineString([coast_point, maritime_graph.network.nodes[node]])
+        for node in candidate_nodes
+    ]
+    crossing_lengths = compute_land_crossing_lengths(connections)
+
+    connected_nodes = {}
+    for i, (node, connection) in enumerate(zip(candidate_nodes, connections)):
+        if i > 0 and crossing_lengths[i] > LAND_CROSSING_TOLERANCE:
+            continue
+        connected_nodes[int(node)] = connection.length
+
+    return coast_point, connected_nodes
+
+
+def find_direct_sea_route(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> BaseGeometry | None:
+    """Find a direct maritime route between two points, if any.
+
+    Departure and arrival are connected to their nearest coastline point. When
+    the straight line between these two coastline points does not cross land,
+    it is the shortest maritime route and no network needs to be built.
+
+    Returns:
+        The route going through both coastline points, or None if the direct
+        line crosses land.
+
+    """
+    coast_geometry, _ = build_coast_geometry()
+    departure_coast_point, arrival_coast_point = (
+        nearest_points(Point(coordinates), coast_geometry)[1]
+        for coordinates in (departure_coords, arrival_coords)
+    )
+
+    direct_line = LineString([departure_coast_point, arrival_coast_point])
+    if compute_land_crossing_lengths([direct_line])[0] > LAND_CROSSING_TOLERANCE:
+        return None
+
+    return unary_union(
+        [
+            LineString([departure_coords, departure_coast_point]),
+            direct_line,
+            LineString([arrival_coast_point, arrival_coords]),
+        ]
+    )
+
+
+def find_shortest_path_networkx(
+    graph: nx.Graph,
+    nodes: np.ndarray,
+    source_costs: dict[int, float],
+    target_costs: dict[int, float],
+    goal: tuple[float, float],
+    algorithm: SearchAlgorithm = MARITIME_SEARCH_ALGORITHM,
+) -> list[int]:
+    """Find the shortest path between a set of sources and a set of targets.
+
+    Shortest-path search using edge "length" weights, where each
+    source has an initial cost and each target a final cost.
+
+    Two algorithms are available:
+        - "dijkstra": plain Dijkstra search
+        - "astar": A* search, using the straight-line distance to the goal
+          as heuristic. Edge lengths are planar lengths in degrees and the
+          cost of reaching the goal from a target is at least their
+          distance, so the heuristic is admissible and the path found is
+          the same as with Dijkstra.
+
+    The number of expanded nodes is logged and recorded in the
+    lowtrip_maritime_search_expanded_nodes metric, to compare both
+    algorithms.
+
+    Args:
+        graph: Maritime graph.
+        nodes: Coordinates of the graph nodes.
+        source_costs: Initial cost of each source node.
+        target_costs: Final cost of each target node.
+        goal: Point the targets are connected to, used by the A* heuristic.
+        algorithm: Search algorithm.
+
+    Returns:
+        The sequence of nodes of the shortest path.
+
+    Raises:
+        nx.NetworkXNoPath:
+            If no target can be reached from the sources.
+
+    """
+    goal_lon, goal_lat = goal
+    node_coordinates = nodes.tolist()
+
+    def heuristic(node: int) -> float:
+        if algorithm == "dijkstra":
+            return 0
+        lon, lat = node_coordinates[node]
+        return math.hypot(lon - goal_lon, lat - goal_lat)
+
+    counter = count()
+    heap = [
+        (cost + heuristic(node), next(counter), node)
+        for node, cost in source_costs.items()
+    ]
+    heapq.heapify(heap)
+
+    best_costs = dict(source_costs)
+    predecessors = dict.fromkeys(source_costs)
+    visited = set()
+
+    best_total_cost = float("inf")
+    best_target = None
+
+    while heap:
+        estimated_cost, _, node = heapq.heappop(heap)
+        if node in visited:
+            continue
+        if estimated_cost >= best_total_cost:
+            break
+        visited.add(node)
+
+        cost = best_costs[node]
+        if node in target_costs and cost + target_costs[node] < best_total_cost:
+            best_total_cost = cost + target_costs[node]
+            best_target = node
+
+        for neighbor, edge_data in graph.adj[node].items():
+            neighbor_cost = cost + edge_data["length"]
+            if neighbor_cost < best_costs.get(neighbor, float("inf")):
+                best_costs[neighbor] = neighbor_cost
+                predecessors[neighbor] = node
+                heapq.heappush(
+                    heap,
+                    (neighbor_cost + heuristic(neighbor), next(counter), neighbor),
+                )
+
+    logger.info(
+        "Maritime %s search expanded %s nodes out of %s",
+        algorithm,
+        len(visited),
+        graph.number_of_nodes(),
+    )
+    observe_maritime_search(algorithm, len(visited))
+
+    if best_target is None:
+        raise nx.NetworkXNoPath("No maritime path found")
+
+    node_path = [best_target]
+    while predecessors[node_path[-1]] is not None:
+        node_path.append(predecessors[node_path[-1]])
+    return node_path[::-1]
+
+
+def find_shortest_path_scipy(
+    network: MaritimeNetwork,
+    source_costs: dict[int, float],
+    target_costs: dict[int, float],
+) -> list[int]:
+    """Find the shortest path between a set of sources and a set of targets.
+
+    The network is converted into a CSR adjacency matrix, with an extra
+    virtual node linked to each source (weighted by the source cost) and an
+    extra virtual node linked from each target (weighted by the target cost).
+    The shortest path between the two virtual nodes is then computed with
+    scipy.sparse.csgraph Dijkstra implementation.
+
+    Returns:
+        The sequence of nodes of the shortest path.
+
+    Raises:
+        nx.NetworkXNoPath:
+            If no target can be reached from the sources.
+
+    """
+    n_nodes = len(network.nodes)
+    virtual_source, virtual_target = n_nodes, n_nodes + 1
+
+    sources, source_weights = zip(*source_costs.items())
+    targets, target_weights = zip(*target_costs.items())
+    u, v = network.edge_nodes[:, 0], network.edge_nodes[:, 1]
+
+    # Zero weights would be considered as missing edges
+    weights = np.maximum(
+        np.concatenate(
+            [
+                network.edge_lengths,
+                network.edge_lengths,
+                source_weights,
+                target_weights,
+            ]
+        ),
+        np.finfo(float).tiny,
+    )
+    adjacency = csr_matrix(
+        (
+            weights,
+            (
+                np.concatenate([u, v, [virtual_source] * len(sources), targets]),
+                np.concatenate([v, u, sources, [virtual_target] * len(targets)]),
+            ),
+        ),
+        shape=(n_nodes + 2, n_nodes + 2),
+    )
+
+    distances, predecessors = dijkstra(
+        adjacency,
+        indices=virtual_source,
+        return_predecessors=True,
+    )
+    if np.isinf(distances[virtual_target]):
+        raise nx.NetworkXNoPath("No maritime path found")
+
+    node_path = []
+    node = predecessors[virtual_target]
+    while node != virtual_source:
+        node_path.append(int(node))
+        node = predecessors[node]
+    return node_path[::-1]
+
+
+@measured_stage("maritime_shortest_path")
+def find_shortest_path(
+    network: MaritimeNetwork,
+    source_costs: dict[int, float],
+    target_costs: dict[int, float],
+    goal: tuple[float, float],
+    graph: nx.Graph | None = None,
+) -> list[int]:
+    """Find the shortest path on a maritime network with the configured backend.
+
+    Args:
+        network: Maritime network.
+        source_costs: Initial cost of each source node.
+        target_costs: Final cost of each target node.
+        goal: Point the targets are connected to.
+        graph: NetworkX graph of the network, built if needed and not provided.
+
+    Returns:
+        The sequence of nodes of the shortest path.
+
+    """
+    if MARITIME_GRAPH_BACKEND == "scipy":
+        return find_shortest_path_scipy(network, source_costs, target_costs)
+
+    return find_shortest_path_networkx(
+        graph if graph is not None else build_networkx_graph(network),
+        network.nodes,
+        source_costs,
+        target_costs,
+        goal,
+    )
+
+
+def get_path_geometries(
+    network: MaritimeNetwork,
+    node_path: list[int],
+) -> np.ndarray:
+    """Get the geometry of each edge of a path."""
+    node_path = np.asarray(node_path)
+    path_keys = get_edge_keys(node_path[:-1], node_path[1:], len(network.nodes))
+    return network.edge_segments[np.searchsorted(network.edge_keys, path_keys)]
+
+
+def compute_maritime_shortest_path_on_graph(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+    maritime_graph: MaritimeGraph,
+):
+    """Compute the shortest maritime route on the prebuilt maritime graph.
+
+    Departure and arrival are snapped onto the graph (see
+    connect_to_maritime_graph), and the shortest path between the
+    departure and arrival connections is computed using edge length weights.
+
+    Returns:
+        A Shapely geometry representing the shortest maritime route.
+
+    """
+    departure_coast_point, departure_nodes = connect_to_maritime_graph(
+        departure_coords,
+        maritime_graph,
+    )
+    arrival_coast_point, arrival_nodes = connect_to_maritime_graph(
+        arrival_coords,
+        maritime_graph,
+    )
+
+    network = maritime_graph.network
+    node_path = find_shortest_path(
+        network,
+        source_costs=departure_nodes,
+        target_costs=arrival_nodes,
+        goal=(arrival_coast_point.x, arrival_coast_point.y),
+        graph=maritime_graph.graph,
+    )
+
+    return unary_union(
+        [
+            LineString(
+                [departure_coords, departure_coast_point, network.nodes[node_path[0]]]
+            ),
+            *get_path_geometries(network, node_path),
+            LineString(
+                [network.nodes[node_path[-1]], arrival_coast_point, arrival_coords]
+            ),
+        ]
+    )
+
+
+def compute_maritime_shortest_path_on_mesh(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+):
+    """Compute the shortest maritime route on a mesh built for the request.
+
+    A navigable maritime network is built between the departure and arrival
+    coordinates (see build_maritime_network), and the shortest path between
+    them is computed using edge length weights.
+
+    Returns:
+        A Shapely geometry representing the shortest maritime route.
+
+    """
+    maritime_network = index_maritime_network(
+        build_maritime_network(departure_coords, arrival_coords).geometry,
+    )
+
+    # Departure and arrival are endpoints of the shore connections
+    departure_node, arrival_node = (
+        int(np.argmin(np.sum((maritime_network.nodes - coords) ** 2, axis=1)))
+        for coords in (departure_coords, arrival_coords)
+    )
+
+    # Compute the shortest path on the maritime graph using edge length as weight.
+    # Output: a sequence of nodes (A -> B -> C -> D)
+    node_path = find_shortest_path(
+        maritime_network,
+        source_costs={departure_node: 0},
+        target_costs={arrival_node: 0},
+        goal=arrival_coords,
+    )
+
+    # Merge the edges of the shortest path into a single continuous Geometry
+    return unary_union(get_path_geometries(maritime_network, node_path))
+
+
 def compute_maritime_shortest_path(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
 ):
     """Compute the shortest maritime route between two geographic points.
 
-    This function builds a navigable maritime network between the departure
-    and arrival coordinates, converts it into a NetworkX graph, and computes
-    the shortest path using edge length weights.
+    When the straight line between the coastline points closest to departure
+    and arrival stays at sea, this line is returned directly (see
+    find_direct_sea_route).
+
+    When the prebuilt global maritime graph is available, the route is
+    computed on it (see compute_maritime_shortest_path_on_graph).
 
-    The resulting route is reconstructed as a single merged geometry by
-    combining the geometries of all edges along the shortest path.
+    Otherwise, the route is computed on a mesh built for the request (see
+    compute_maritime_shortest_path_on_mesh).
 
     Args:
         departure_coords: Departure coordinates as (longitude, latitude).
@@ -318,29 +1083,71 @@ def compute_maritime_shortest_path(
         A Shapely geometry representing the shortest maritime route.
 
     """
-    maritime_network = build_maritime_network(departure_coords, arrival_coords)
+    direct_route = find_direct_sea_route(departure_coords, arrival_coords)
+    if direct_route is not None:
+        return direct_route
 
-    maritime_graph = momepy.gdf_to_nx(
-        maritime_network,
-        approach="primal",
-        multigraph=False,
-    )
+    maritime_graph = load_maritime_graph()
+    if maritime_graph is not None:
+        return compute_maritime_shortest_path_on_graph(
+            departure_coords,
+            arrival_coords,
+            maritime_graph,
+        )
 
-    # Compute the shortest path on the maritime graph using edge length as weight.
-    # Output: a sequence of nodes (A -> B -> C -> D)
-    node_path = nx.shortest_path(
-        maritime_graph,
-        source=departure_coords,
-        target=arrival_coords,
-        weight="mm_len",
-    )
+    return compute_maritime_shortest_path_on_mesh(departure_coords, arrival_coords)
+
+
+def check_maritime_graph(maritime_graph: MaritimeGraph) -> list[str]:
+    """Check the routes of the global maritime graph against per-request meshes.
 
-    # Extract the geometry of each pair of consecutive nodes in the shortest path
-    edge_geometries = []
-    for u, v in pairwise(node_path):
-        edge_data = maritime_graph.get_edge_data(u, v)
-        if edge_data and "geometry" in edge_data:
-            edge_geometries.append(edge_data["geometry"])
+    Each of the MARITIME_REFERENCE_ROUTES is computed on the global maritime
+    graph and on a mesh built for the route. The global graph route must not
+    be more than MARITIME_GRAPH_TOLERANCE longer. It can be shorter, the
+    global mesh being finer and 8-connected.
 
-    # Merge the edges into a single continuous Geometry
-    return unary_union(edge_geometries)
+    Returns:
+        The description of the routes exceeding the tolerance.
+
+    """
+    failures = []
+    for name, (departure_coords, arrival_coords) in MARITIME_REFERENCE_ROUTES.items():
+        graph_route = compute_maritime_shortest_path_on_graph(
+            departure_coords,
+            arrival_coords,
+            maritime_graph,
+        )
+        mesh_route = compute_maritime_shortest_path_on_mesh(
+            departure_coords,
+            arrival_coords,
+        )
+        graph_length = m_to_km(GEOD.geometry_length(graph_route))
+        mesh_length = m_to_km(GEOD.geometry_length(mesh_route))
+
+        excess = graph_length / mesh_length - 1
+        logger.info(
+            "Maritime route %s: %.0f km on the global graph, %.0f km on the mesh "
+            "(%+.1f%%)",
+            name,
+            graph_length,
+            mesh_length,
+            100 * excess,
+        )
+        if excess > MARITIME_GRAPH_TOLERANCE:
+            failures.append(
+                f"{name}: {graph_length:.0f} km instead of {mesh_length:.0f} km"
+            )
+    return failures
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    save_maritime_graph(build_global_maritime_network())
+    print(f"Maritime graph saved to {MARITIME_GRAPH_PATH}")
+
+    failures = check_maritime_graph(load_maritime_graph())
+    if failures:
+        raise SystemExit(
+            "Maritime routes longer than the per-request mesh by more than "
+            f"{MARITIME_GRAPH_TOLERANCE:.0%}:\n" + "\n".join(failures)
+        )
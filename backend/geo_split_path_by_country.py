@@ -15,11 +15,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import geopandas as gpd
+from dataclasses import dataclass
+from functools import cache, reduce
+
+import numpy as np
 import pandas as pd
-from shapely import ops
+import shapely
+from shapely import ops, STRtree
 from shapely.geometry import LineString, MultiLineString
+from shapely.geometry.base import BaseGeometry
 
+from metrics import measured_stage
 from models import (
     CountryRouteSegment,
     CountrySplitConfig,
@@ -34,6 +40,66 @@ from utils import (
 )
 
 
+LINE_GEOMETRY_TYPES = {"LineString", "MultiLineString"}
+
+
+@dataclass(frozen=True)
+class CountryIndex:
+    """Spatial index over the country dataset of a CountrySplitConfig."""
+
+    tree: STRtree
+    geometries: np.ndarray
+    iso_codes: np.ndarray
+    names: np.ndarray
+    emission_factors: np.ndarray
+
+
+@cache
+def build_country_index(country_split_config: CountrySplitConfig) -> CountryIndex:
+    """Build the spatial index used to split routes by country.
+
+    Invalid country polygons are repaired with a zero-width buffer (as
+    gpd.overlay does) and all geometries are prepared, so that only the
+    countries crossed by a route have to be intersected with it.
+
+    The index is built once per configuration and cached.
+
+    """
+    dataset = country_split_config.dataset
+
+    geometries = dataset.geometry.to_numpy().copy()
+    invalid = ~shapely.is_valid(geometries)
+    geometries[invalid] = shapely.buffer(geometries[invalid], 0)
+    shapely.prepare(geometries)
+
+    return CountryIndex(
+        tree=STRtree(geometries),
+        geometries=geometries,
+        iso_codes=dataset[country_split_config.iso_column].to_numpy(),
+        names=dataset["NAME"].to_numpy(),
+        emission_factors=dataset[
+            country_split_config.emission_factor_column
+        ].to_numpy(),
+    )
+
+
+def explode_lines(geometry: BaseGeometry) -> list[LineString]:
+    """Return the LineString parts of a geometry, dropping points and empty parts."""
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type == "GeometryCollection":
+        return [
+            line
+            for part in shapely.get_parts(geometry)
+            if part.geom_type in LINE_GEOMETRY_TYPES
+            for line in explode_lines(part)
+        ]
+    if geometry.geom_type not in LINE_GEOMETRY_TYPES:
+        return []
+    return list(shapely.get_parts(geometry))
+
+
+@measured_stage("split_path_by_country")
 def split_path_by_country(
     path: LineString,
     real_path_length: float,
@@ -48,6 +114,10 @@ def split_path_by_country(
     factors are then attached to each segment depending on the transport
     method.
 
+    Only the countries returned by the spatial index of the dataset (see
+    build_country_index) are intersected with the route, and the unmatched
+    part of the route is computed from these same candidates.
+
     Unmatched route parts (typically sea crossings, bridges, or tunnels)
     can optionally be reassigned to the nearest country when their length
     exceeds the sea_threshold.
@@ -68,76 +138,69 @@ def split_path_by_country(
             - A list of TripStepGeometry for frontend trip rendering.
 
     """
-    gdf = gpd.GeoSeries(
+    country_index = build_country_index(country_split_config)
+
+    # Split by geometry, only against the countries crossed by the route
+    candidates = np.sort(country_index.tree.query(path, predicate="intersects"))
+    candidate_geometries = country_index.geometries[candidates]
+
+    # (country index, route part) pairs, in dataset order
+    matched_parts = [
+        (country, line)
+        for country, intersection in zip(
+            candidates,
+            shapely.intersection(path, candidate_geometries),
+        )
+        for line in explode_lines(intersection)
+    ]
+    unmatched_geometry = reduce(
+        lambda geometry, country: geometry.difference(country),
+        candidate_geometries,
         path,
-        crs="epsg:4326",
-    )
-
-    # Split by geometry
-    gdf.name = "geometry"
-    intersections = gpd.overlay(
-        gpd.GeoDataFrame(gdf, geometry="geometry", crs="epsg:4326"),
-        country_split_config.dataset,
-        how="intersection",
-    )
-    unmatched_segments = gpd.overlay(
-        gpd.GeoDataFrame(gdf, geometry="geometry", crs="epsg:4326"),
-        country_split_config.dataset,
-        how="difference",
     )
 
     # Check if the unmatched data is significant
-    if unmatched_segments.length.sum() < kilometer_to_degree(sea_threshold):
-        segments_to_aggregate = intersections.explode()
-
-    else:
+    if unmatched_geometry.length >= kilometer_to_degree(sea_threshold):
         # In case we have bridges / tunnels across sea:
-        if unmatched_segments.geometry.iloc[0].geom_type == "MultiLineString":
-            sea_segments = gpd.GeoDataFrame(
-                list(unmatched_segments.geometry.iloc[0].geoms),
+        # filter depending is the gap is long enough to be taken into account
+        # and join with nearest country
+        sea_segments = [
+            segment
+            for segment in shapely.get_parts(unmatched_geometry)
+            if segment.length > kilometer_to_degree(sea_threshold)
+        ]
+        if sea_segments:
+            segment_idx, country_idx = country_index.tree.query_nearest(
+                sea_segments,
+            )
+            matched_parts.extend(
+                (country, line)
+                for segment, country in sorted(zip(segment_idx, country_idx))
+                for line in explode_lines(sea_segments[segment])
             )
-        else:
-            sea_segments = gpd.GeoDataFrame(list(unmatched_segments.geometry.values))
-
-        sea_segments.columns = ["geometry"]
-        sea_segments = sea_segments.set_geometry("geometry", crs="epsg:4326")
-
-        # Filter depending is the gap is long enough to be taken into account and join with nearest country
-        nearest_country_segments = sea_segments[
-            sea_segments.length > kilometer_to_degree(sea_threshold)
-        ].sjoin_nearest(
-            country_split_config.dataset,
-            how="left",
-        )
-
-        segments_to_aggregate = pd.concat(
-            [
-                intersections.explode(),
-                nearest_country_segments.explode(),
-            ]
-        )
 
     # Aggregation per country and combining geometries
-    aggregated_segments = segments_to_aggregate.groupby(
-        country_split_config.iso_column,
-    ).agg(
-        NAME=("NAME", "first"),
-        EF=(country_split_config.emission_factor_column, "first"),
-        geometry=(
-            "geometry",
-            lambda x: ops.linemerge(MultiLineString(x.values)),
-        ),
-    )
-
-    raw_segments = [
-        CountryRouteSegment(
-            country_name=row["NAME"],
-            emission_factor=row["EF"] / 1000,  # conversion in kg
-            geometry=row["geometry"],
-            path_length_km=m_to_km(GEOD.geometry_length(row["geometry"])),
+    parts_by_country: dict[str, list[tuple[int, LineString]]] = {}
+    for country, line in matched_parts:
+        iso_code = country_index.iso_codes[country]
+        if pd.isna(iso_code):
+            continue
+        parts_by_country.setdefault(iso_code, []).append((country, line))
+
+    raw_segments = []
+    for iso_code in sorted(parts_by_country):
+        country_parts = parts_by_country[iso_code]
+        first_country = country_parts[0][0]
+        geometry = ops.linemerge(MultiLineString([line for _, line in country_parts]))
+        raw_segments.append(
+            CountryRouteSegment(
+                country_name=country_index.names[first_country],
+                emission_factor=country_index.emission_factors[first_country]
+                / 1000,  # conversion in kg
+                geometry=geometry,
+                path_length_km=m_to_km(GEOD.geometry_length(geometry)),
+            ),
         )
-        for _, row in aggregated_segments.iterrows()
-    ]
 
     total_length = sum(segment.path_length_km for segment in raw_segments)
     scale_factor = real_path_length / total_length
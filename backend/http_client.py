@@ -0,0 +1,569 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Shared HTTP client for the external providers.
+
+Each provider gets its own `requests.Session`, so connections are kept alive
+and reused between requests instead of opening a new TCP+TLS connection for
+every call. Every request has a connect and a read timeout, so that a stalled
+provider cannot block a worker indefinitely.
+
+The async functions (request_async, get_async, post_async) do the same with
+an `httpx.AsyncClient` per provider and event loop.
+
+Requests to each provider are rate limited with a token bucket, so that
+bursts of requests stay just below the limits of the public APIs. Requests
+answered with a 429 or 5xx gateway error, or which could not connect, are
+retried with an exponential backoff with jitter, or after the delay of the
+Retry-After header. Retries stop at the deadline of the current request
+(see task_pool.current_deadline).
+
+Timeouts, rate limits and retries can be configured per provider with
+environment variables, e.g.:
+
+    HTTP_OVERPASS_CONNECT_TIMEOUT=5
+    HTTP_OVERPASS_READ_TIMEOUT=65
+    HTTP_OVERPASS_RATE_LIMIT=1
+    HTTP_OVERPASS_MAX_RETRIES=2
+"""
+
+import asyncio
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from functools import cache
+import logging
+import os
+import random
+import threading
+import time
+from typing import Literal
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import observe_external_call
+from task_pool import get_remaining_time
+
+
+logger = logging.getLogger(__name__)
+
+
+Provider = Literal["signal", "overpass", "osrm", "openrouteservice", "brevo"]
+
+
+@dataclass(frozen=True)
+class ProviderSettings:
+    """HTTP settings of an external provider."""
+
+    connect_timeout: float
+    """Maximum time to establish a connection. In seconds."""
+    read_timeout: float
+    """Maximum time to wait for data from the provider. In seconds."""
+    pool_maxsize: int = 10
+    """Maximum number of connections kept alive with the provider."""
+    max_connections: int = 100
+    """Maximum number of concurrent connections of the async client."""
+    rate_limit: float | None = None
+    """Maximum number of requests per second, not limited if None."""
+    burst: int = 1
+    """Number of requests which can be sent at once, within the rate limit."""
+    max_retries: int = 2
+    """Maximum number of retries of a failed request."""
+
+
+DEFAULT_PROVIDER_SETTINGS: dict[Provider, ProviderSettings] = {
+    "signal": ProviderSettings(
+        connect_timeout=5,
+        read_timeout=30,
+        rate_limit=5,
+        burst=10,
+    ),
+    # Overpass queries have a server-side timeout of 60 seconds, and the
+    # public instance only runs a couple of queries per client at once
+    "overpass": ProviderSettings(
+        connect_timeout=5,
+        read_timeout=65,
+        rate_limit=1,
+        burst=2,
+    ),
+    "osrm": ProviderSettings(connect_timeout=5, read_timeout=30),
+    "openrouteservice": ProviderSettings(connect_timeout=5, read_timeout=30),
+    # Emails must not be sent twice
+    "brevo": ProviderSettings(connect_timeout=5, read_timeout=15, max_retries=0),
+}
+
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+"""Status codes of the responses retried, the provider being overloaded."""
+
+RETRY_BACKOFF_BASE = 0.5
+"""Maximum delay before the first retry, doubled at each retry. In seconds."""
+
+RETRY_BACKOFF_MAX = 10
+"""Maximum delay between two retries, without Retry-After header. In seconds."""
+
+
+@cache
+def get_provider_settings(provider: Provider) -> ProviderSettings:
+    """Get the HTTP settings of a provider.
+
+    Default settings can be overridden with the HTTP_<PROVIDER>_CONNECT_TIMEOUT,
+    HTTP_<PROVIDER>_READ_TIMEOUT, HTTP_<PROVIDER>_POOL_MAXSIZE,
+    HTTP_<PROVIDER>_MAX_CONNECTIONS, HTTP_<PROVIDER>_RATE_LIMIT (0 for no
+    limit), HTTP_<PROVIDER>_BURST and HTTP_<PROVIDER>_MAX_RETRIES environment
+    variables.
+
+    """
+    defaults = DEFAULT_PROVIDER_SETTINGS[provider]
+    prefix = f"HTTP_{provider.upper()}"
+    rate_limit = float(os.getenv(f"{prefix}_RATE_LIMIT", defaults.rate_limit or 0))
+
+    return ProviderSettings(
+        connect_timeout=float(
+            os.getenv(f"{prefix}_CONNECT_TIMEOUT", defaults.connect_timeout)
+        ),
+        read_timeout=float(os.getenv(f"{prefix}_READ_TIMEOUT", defaults.read_timeout)),
+        pool_maxsize=int(os.getenv(f"{prefix}_POOL_MAXSIZE", defaults.pool_maxsize)),
+        max_connections=int(
+            os.getenv(f"{prefix}_MAX_CONNECTIONS", defaults.max_connections)
+        ),
+        rate_limit=rate_limit or None,
+        burst=int(os.getenv(f"{prefix}_BURST", defaults.burst)),
+        max_retries=int(os.getenv(f"{prefix}_MAX_RETRIES", defaults.max_retries)),
+    )
+
+
+class TokenBucket:
+    """Token bucket limiting the rate of the requests, shared by all threads.
+
+    Each request takes a token, and tokens are added back at a constant rate
+    up to the capacity of the bucket. When the bucket is empty, requests
+    reserve the next tokens and wait for them, so that waiting requests are
+    sent at the rate limit, one after the other.
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        """Initialize a full bucket.
+
+        Args:
+            rate: Number of tokens added per second.
+            capacity: Maximum number of tokens of the bucket.
+
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float = float("inf")) -> float | None:
+        """Reserve a token.
+
+        Args:
+            max_wait: Maximum time to wait for the token. In seconds.
+
+        Returns:
+            The time to wait before using the token, in seconds, or None if
+            it is longer than max_wait (the token is then not reserved).
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated_at) * self.rate,
+            )
+            self._updated_at = now
+
+            wait = max((1 - self._tokens) / self.rate, 0)
+            if wait > max_wait:
+                return None
+
+            self._tokens -= 1
+            return wait
+
+
+@cache
+def get_token_bucket(provider: Provider) -> TokenBucket | None:
+    """Get the token bucket of a provider, None if it is not rate limited."""
+    settings = get_provider_settings(provider)
+    if settings.rate_limit is None:
+        return None
+    return TokenBucket(settings.rate_limit, settings.burst)
+
+
+def reserve_request(provider: Provider) -> float | None:
+    """Reserve a request to a provider within its rate limit.
+
+    Returns:
+        The time to wait before sending the request, in seconds, or None if
+        the request cannot be sent before the deadline of the current request.
+
+    """
+    token_bucket = get_token_bucket(provider)
+    if token_bucket is None:
+        return 0
+    return token_bucket.reserve(max_wait=get_remaining_time())
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a Retry-After header, either a number of seconds or an HTTP date.
+
+    Returns:
+        The delay before retrying in seconds, None if missing or invalid.
+
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def compute_retry_delay(
+    provider: Provider,
+    attempt: int,
+    retry_after: str | None,
+) -> float | None:
+    """Compute the delay before retrying a failed request.
+
+    The delay is given by the Retry-After header if any, otherwise it is
+    drawn at random up to an exponential backoff (the "full jitter"
+    strategy), so that the retries of concurrent requests are spread.
+
+    Args:
+        provider: External provider the request was sent to.
+        attempt: Number of the failed attempt, 0 for the first one.
+        retry_after: Retry-After header of the response, if any.
+
+    Returns:
+        The delay before retrying in seconds, or None if the request must
+        not be retried: no retries left, or no time left before the deadline
+        of the current request.
+
+    """
+    if attempt >= get_provider_settings(provider).max_retries:
+        return None
+
+    delay = parse_retry_after(retry_after)
+    if delay is None:
+        # Jitter does not need a secure random generator
+        delay = random.uniform(  # noqa: S311
+            0,
+            min(RETRY_BACKOFF_BASE * 2**attempt, RETRY_BACKOFF_MAX),
+        )
+
+    if delay >= get_remaining_time():
+        return None
+
+    logger.warning(
+        "Retrying request to %s in %.1fs (attempt %s)",
+        provider,
+        delay,
+        attempt + 1,
+    )
+    return delay
+
+
+@cache
+def get_session(provider: Provider) -> requests.Session:
+    """Get the session of a provider, with its own connection pool.
+
+    Sessions are created on first use, so each gunicorn worker process gets its
+    own connections.
+
+    """
+    settings = get_provider_settings(provider)
+
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.pool_maxsize)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def request(
+    provider: Provider,
+    method: str,
+    url: str,
+    headers: dict[str, str] | None = None,
+    data: str | None = None,
+    json: dict | None = None,
+) -> requests.Response:
+    """Send an HTTP request to a provider, within its rate limit and with retries.
+
+    Args:
+        provider: External provider the request is sent to.
+        method: HTTP method.
+        url: Requested URL.
+        headers: Request headers.
+        data: Request body.
+        json: Request body, serialized to JSON.
+
+    Returns:
+        The provider response, which is the failed response of the last
+        attempt if no retry succeeded.
+
+    Raises:
+        requests.RequestException:
+            If the provider could not be reached or did not answer in time,
+            or if the rate limit does not allow sending the request before
+            the deadline of the current request.
+
+    """
+    attempt = 0
+    while True:
+        wait = reserve_request(provider)
+        if wait is None:
+            logger.warning("Rate limit of %s reached until the deadline", provider)
+            raise requests.Timeout(f"Rate limit of {provider} reached")
+        if wait:
+            time.sleep(wait)
+
+        try:
+            response = send_request(provider, method, url, headers, data, json)
+        except requests.ConnectionError:
+            delay = compute_retry_delay(provider, attempt, None)
+            if delay is None:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            delay = compute_retry_delay(
+                provider,
+                attempt,
+                response.headers.get("Retry-After"),
+            )
+            if delay is None:
+                return response
+
+        time.sleep(delay)
+        attempt += 1
+
+
+def send_request(
+    provider: Provider,
+    method: str,
+    url: str,
+    headers: dict[str, str] | None = None,
+    data: str | None = None,
+    json: dict | None = None,
+) -> requests.Response:
+    """Send a single HTTP request to a provider, see request."""
+    settings = get_provider_settings(provider)
+    status = "error"
+    start = time.perf_counter()
+
+    try:
+        response = get_session(provider).request(
+            method,
+            url,
+            headers=headers,
+            data=data,
+            json=json,
+            timeout=(settings.connect_timeout, settings.read_timeout),
+        )
+    except requests.Timeout:
+        logger.warning("Request to %s timed out", provider)
+        raise
+    except requests.ConnectionError:
+        logger.warning("Could not connect to %s", provider)
+        raise
+    else:
+        status = response.status_code
+        return response
+    finally:
+        observe_external_call(provider, status, time.perf_counter() - start)
+
+
+def get(
+    provider: Provider,
+    url: str,
+    headers: dict[str, str] | None = None,
+) -> requests.Response:
+    """Send a GET request to a provider (see request)."""
+    return request(provider, "GET", url, headers=headers)
+
+
+def post(
+    provider: Provider,
+    url: str,
+    headers: dict[str, str] | None = None,
+    data: str | None = None,
+    json: dict | None = None,
+) -> requests.Response:
+    """Send a POST request to a provider (see request)."""
+    return request(provider, "POST", url, headers=headers, data=data, json=json)
+
+
+_async_clients: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop,
+    dict[Provider, httpx.AsyncClient],
+] = weakref.WeakKeyDictionary()
+
+
+def get_async_client(provider: Provider) -> httpx.AsyncClient:
+    """Get the async client of a provider for the running event loop.
+
+    Async clients cannot be shared between event loops, so each event loop
+    gets its own clients.
+
+    """
+    loop_clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+
+    if provider not in loop_clients:
+        settings = get_provider_settings(provider)
+        loop_clients[provider] = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                settings.read_timeout,
+                connect=settings.connect_timeout,
+            ),
+            limits=httpx.Limits(
+                max_connections=settings.max_connections,
+                max_keepalive_connections=settings.pool_maxsize,
+            ),
+        )
+
+    return loop_clients[provider]
+
+
+async def close_async_clients():
+    """Close the async clients of the running event loop."""
+    for client in _async_clients.pop(asyncio.get_running_loop(), {}).values():
+        await client.aclose()
+
+
+async def request_async(
+    provider: Provider,
+    method: str,
+    url: str,
+    headers: dict[str, str] | None = None,
+    data: str | None = None,
+    json: dict | None = None,
+) -> httpx.Response:
+    """Send an HTTP request to a provider without blocking the event loop.
+
+    See request.
+
+    Raises:
+        httpx.TransportError:
+            If the provider could not be reached or did not answer in time,
+            or if the rate limit does not allow sending the request before
+            the deadline of the current request.
+
+    """
+    attempt = 0
+    while True:
+        wait = reserve_request(provider)
+        if wait is None:
+            logger.warning("Rate limit of %s reached until the deadline", provider)
+            raise httpx.PoolTimeout(f"Rate limit of {provider} reached")
+        if wait:
+            await asyncio.sleep(wait)
+
+        try:
+            response = await send_request_async(
+                provider,
+                method,
+                url,
+                headers,
+                data,
+                json,
+            )
+        except (httpx.ConnectError, httpx.ConnectTimeout):
+            delay = compute_retry_delay(provider, attempt, None)
+            if delay is None:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+            delay = compute_retry_delay(
+                provider,
+                attempt,
+                response.headers.get("Retry-After"),
+            )
+            if delay is None:
+                return response
+
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def send_request_async(
+    provider: Provider,
+    method: str,
+    url: str,
+    headers: dict[str, str] | None = None,
+    data: str | None = None,
+    json: dict | None = None,
+) -> httpx.Response:
+    """Send a single HTTP request to a provider, see request_async."""
+    status = "error"
+    start = time.perf_counter()
+
+    try:
+        response = await get_async_client(provider).request(
+            method,
+            url,
+            headers=headers,
+            content=data,
+            json=json,
+        )
+    except httpx.TimeoutException:
+        logger.warning("Request to %s timed out", provider)
+        raise
+    except httpx.TransportError:
+        logger.warning("Could not connect to %s", provider)
+        raise
+    else:
+        status = response.status_code
+        return response
+    finally:
+        observe_external_call(provider, status, time.perf_counter() - start)
+
+
+async def get_async(
+    provider: Provider,
+    url: str,
+    headers: dict[str, str] | None = None,
+) -> httpx.Response:
+    """Send a GET request to a provider (see request_async)."""
+    return await request_async(provider, "GET", url, headers=headers)
+
+
+async def post_async(
+    provider: Provider,
+    url: str,
+    headers: dict[str, str] | None = None,
+    data: str | None = None,
+    json: dict | None = None,
+) -> httpx.Response:
+    """Send a POST request to a provider (see request_async)."""
+    return await request_async(
+        provider,
+        "POST",
+        url,
+        headers=headers,
+        data=data,
+        json=json,
+    )
@@ -0,0 +1,147 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Emissions between every origin and every destination of two lists of places.
+
+Matrices compare places (e.g. meeting venues against offices) without routing
+each pair: road distances come from OSRM table requests, and plane distances
+are computed for all pairs at once. The emissions of each cell are computed
+with the emission factors of each transport mean, without geometries.
+
+    MATRIX_MAX_SIZE: maximum number of origins, and of destinations
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from models import (
+    BusStepData,
+    CarStepData,
+    MatrixApiPayload,
+    MatrixTransportMean,
+    PlaneStepData,
+)
+from parameters import PLANE_MIN_DISTANCE
+from transport_car import (
+    compute_bus_step_data,
+    compute_car_step_data,
+    find_road_distances,
+)
+from transport_plane import compute_great_circle_distances, compute_plane_step_data
+
+
+logger = logging.getLogger(__name__)
+
+
+MATRIX_MAX_SIZE = int(os.getenv("MATRIX_MAX_SIZE", "100"))
+
+MatrixCell = dict[str, float] | None
+"""Emissions ("kg_co2_eq") and path length ("path_length") of a cell, or None
+if the destination cannot be reached from the origin. Plane cells are None
+when the distance is not above PLANE_MIN_DISTANCE, as for the direct trips."""
+
+
+def compute_emissions_matrix(
+    payload: MatrixApiPayload,
+) -> dict[str, list[list[MatrixCell]]]:
+    """Compute the emissions between every origin and every destination.
+
+    Args:
+        payload: Validated matrix API payload.
+
+    Returns:
+        For each requested transport mean, the matrix of the cells of each
+        origin (rows) and destination (columns).
+
+    """
+    origins = np.array([(origin.lon, origin.lat) for origin in payload.origins])
+    destinations = np.array(
+        [(destination.lon, destination.lat) for destination in payload.destinations]
+    )
+
+    distances: dict[MatrixTransportMean, np.ndarray] = {}
+
+    if {"car", "bus"} & set(payload.transport_means):
+        distances["car"] = distances["bus"] = find_road_distances(
+            [tuple(origin) for origin in origins.tolist()],
+            [tuple(destination) for destination in destinations.tolist()],
+        )
+
+    if "plane" in payload.transport_means:
+        # Distances of all the pairs, as a flat list of (origin, destination)
+        origin_coords, destination_coords = np.broadcast_arrays(
+            origins[:, np.newaxis, :],
+            destinations[np.newaxis, :, :],
+        )
+        distances["plane"] = compute_great_circle_distances(
+            origin_coords.reshape(-1, 2),
+            destination_coords.reshape(-1, 2),
+        ).reshape(len(origins), len(destinations))
+
+    return {
+        transport_mean: [
+            [
+                compute_matrix_cell(
+                    transport_mean,
+                    distance,
+                    payload.passengers_nb,
+                )
+                for distance in row.tolist()
+            ]
+            for row in distances[transport_mean]
+        ]
+        for transport_mean in payload.transport_means
+    }
+
+
+def compute_matrix_cell(
+    transport_mean: MatrixTransportMean,
+    distance: float,
+    passengers_nb: int,
+) -> MatrixCell:
+    """Compute the emissions of a cell from its distance, see compute_emissions_matrix."""
+    if np.isnan(distance):
+        return None
+
+    if transport_mean == "plane" and distance <= PLANE_MIN_DISTANCE:
+        return None
+
+    # The origin is the destination
+    if distance == 0:
+        return {"kg_co2_eq": 0.0, "path_length": 0}
+
+    if transport_mean == "car":
+        step_data = compute_car_step_data(distance, passengers_nb)
+    elif transport_mean == "bus":
+        step_data = compute_bus_step_data(distance)
+    else:
+        step_data = compute_plane_step_data(distance)
+
+    return summarize_step(step_data)
+
+
+def summarize_step(
+    step_data: CarStepData | BusStepData | PlaneStepData,
+) -> dict[str, float]:
+    return {
+        "kg_co2_eq": round(
+            sum(emission.kg_co2_eq for emission in step_data.emissions), 2
+        ),
+        "path_length": step_data.path_length,
+    }
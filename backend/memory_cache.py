@@ -0,0 +1,161 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Thread-safe in-memory cache, shared by the threads of a worker process.
+
+The keys are spread over several stripes, each one an LRU cache with its
+own lock, so that threads looking up different keys rarely wait for each
+other (e.g. with gunicorn gthread workers and the task pool).
+"""
+
+from collections import OrderedDict
+from collections.abc import Hashable
+from dataclasses import dataclass
+import math
+import threading
+import time
+from typing import Generic, TypeVar
+
+from metrics import count_cache_eviction, count_cache_lookup
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+DEFAULT_STRIPES_NB = 16
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    """Statistics of a cache since its creation."""
+
+    hits: int
+    misses: int
+    evictions: int
+    """Entries removed because the cache was full or they expired."""
+    size: int
+
+
+class _Stripe(Generic[K, V]):
+    """LRU cache of a part of the keys, with its lock and statistics."""
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self.entries: OrderedDict[K, tuple[V, float]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+class MemoryCache(Generic[K, V]):
+    """Thread-safe LRU cache with an optional time to live.
+
+    The maximum size is split between the stripes, so the least recently
+    used entry is evicted within the stripe of the new entry. Lookups and
+    evictions are also reported to the cache metrics (see metrics.py).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        ttl: float | None = None,
+        stripes_nb: int = DEFAULT_STRIPES_NB,
+    ) -> None:
+        """Initialize an empty cache.
+
+        Args:
+            name: Name of the cache, labelling the metrics.
+            maxsize: Maximum number of entries.
+            ttl: Time after which an entry expires, never by default. In
+                seconds.
+            stripes_nb: Number of stripes, i.e. of locks, of the cache.
+
+        """
+        self.name = name
+        self.ttl = ttl
+        stripes_nb = max(min(stripes_nb, maxsize), 1)
+        self._stripes: list[_Stripe[K, V]] = [
+            _Stripe(maxsize // stripes_nb + (idx < maxsize % stripes_nb))
+            for idx in range(stripes_nb)
+        ]
+
+    def _get_stripe(self, key: K) -> _Stripe[K, V]:
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        """Get the value of a key, or the default value if it is missing or expired."""
+        stripe = self._get_stripe(key)
+
+        expired = False
+        with stripe.lock:
+            entry = stripe.entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                del stripe.entries[key]
+                stripe.evictions += 1
+                entry = None
+                expired = True
+
+            if entry is None:
+                stripe.misses += 1
+            else:
+                stripe.entries.move_to_end(key)
+                stripe.hits += 1
+
+        if expired:
+            count_cache_eviction(self.name, reason="expired")
+        count_cache_lookup(self.name, hit=entry is not None)
+        return default if entry is None else entry[0]
+
+    def set(self, key: K, value: V):
+        """Set the value of a key, evicting the least recently used entry if full."""
+        stripe = self._get_stripe(key)
+        expires_at = math.inf if self.ttl is None else time.monotonic() + self.ttl
+
+        with stripe.lock:
+            stripe.entries[key] = (value, expires_at)
+            stripe.entries.move_to_end(key)
+
+            evictions = 0
+            while len(stripe.entries) > stripe.maxsize:
+                stripe.entries.popitem(last=False)
+                evictions += 1
+            stripe.evictions += evictions
+
+        if evictions:
+            count_cache_eviction(self.name, evictions)
+
+    def clear(self):
+        """Remove all the entries."""
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.entries.clear()
+
+    def stats(self) -> CacheStats:
+        """Get the statistics of the cache, summed over the stripes."""
+        hits = misses = evictions = size = 0
+
+        for stripe in self._stripes:
+            with stripe.lock:
+                hits += stripe.hits
+                misses += stripe.misses
+                evictions += stripe.evictions
+                size += len(stripe.entries)
+
+        return CacheStats(hits=hits, misses=misses, evictions=evictions, size=size)
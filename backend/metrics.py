@@ -0,0 +1,261 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Prometheus metrics of the backend, exposed on /metrics.
+
+Durations are measured for the requests to the external providers (see
+http_client) and for the stages of the computation (see measure_stage), and
+labelled with the transport mean being computed (see transport_mean_context).
+Cache lookups are counted to follow the hit ratio of each cache. The nodes
+expanded by the maritime shortest-path searches are recorded by algorithm.
+
+With several worker processes, the PROMETHEUS_MULTIPROC_DIR environment
+variable must be set to an empty directory shared by the workers, so that
+/metrics aggregates the metrics of all the workers. In-memory LRU caches are
+then not reported.
+"""
+
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import os
+import time
+from typing import (
+    Literal,
+    ParamSpec,
+    TypeVar,
+)
+
+from prometheus_client import (
+    CollectorRegistry,
+    CONTENT_TYPE_LATEST,
+    Counter,
+    generate_latest,
+    Histogram,
+    multiprocess,
+    REGISTRY,
+)
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.registry import Collector
+
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+"""Buckets of the duration histograms. In seconds."""
+
+EXPANDED_NODES_BUCKETS = (100, 300, 1_000, 3_000, 10_000, 30_000, 100_000, 300_000)
+"""Buckets of the histogram of the nodes expanded by the maritime searches."""
+
+current_transport_mean: ContextVar[str] = ContextVar(
+    "current_transport_mean",
+    default="none",
+)
+"""Transport mean being computed, used as a label of the metrics."""
+
+EXTERNAL_CALL_DURATION = Histogram(
+    "lowtrip_external_call_duration_seconds",
+    "Duration of the requests to the external providers.",
+    ["provider", "transport_mean", "status"],
+    buckets=DURATION_BUCKETS,
+)
+
+STAGE_DURATION = Histogram(
+    "lowtrip_stage_duration_seconds",
+    "Duration of the stages of the computation.",
+    ["stage", "transport_mean"],
+    buckets=DURATION_BUCKETS,
+)
+
+MARITIME_SEARCH_EXPANDED_NODES = Histogram(
+    "lowtrip_maritime_search_expanded_nodes",
+    "Nodes expanded by the maritime shortest-path searches.",
+    ["algorithm"],
+    buckets=EXPANDED_NODES_BUCKETS,
+)
+
+CACHE_LOOKUPS = Counter(
+    "lowtrip_cache_lookups_total",
+    "Lookups in the caches, by result (hit or miss).",
+    ["cache", "result"],
+)
+CACHE_EVICTIONS = Counter(
+    "lowtrip_cache_evictions_total",
+    "Entries removed from the in-memory caches, when full or expired.",
+    ["cache", "reason"],
+)
+
+SHARED_CALLS = Counter(
+    "lowtrip_single_flight_shared_calls_total",
+    "Calls answered with the result of an identical call already running.",
+    ["call"],
+)
+
+
+@contextmanager
+def transport_mean_context(transport_mean: str) -> Iterator[None]:
+    """Label the metrics measured in the context with a transport mean."""
+    token = current_transport_mean.set(transport_mean)
+    try:
+        yield
+    finally:
+        current_transport_mean.reset(token)
+
+
+def labelled_transport_mean(
+    transport_mean: str,
+) -> Callable[[Callable[P, T]], Callable[P, T]]:
+    """Label the metrics measured by the decorated function with a transport mean."""
+
+    def decorator(function: Callable[P, T]) -> Callable[P, T]:
+        @functools.wraps(function)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            with transport_mean_context(transport_mean):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def measure_stage(stage: str) -> Iterator[None]:
+    """Measure the duration of a stage of the computation."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(stage, current_transport_mean.get()).observe(
+            time.perf_counter() - start
+        )
+
+
+def measured_stage(stage: str) -> Callable[[Callable[P, T]], Callable[P, T]]:
+    """Measure the duration of the decorated function, see measure_stage."""
+
+    def decorator(function: Callable[P, T]) -> Callable[P, T]:
+        @functools.wraps(function)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+            with measure_stage(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_external_call(provider: str, status: int | str, duration: float):
+    """Record the duration of a request to an external provider.
+
+    Args:
+        provider: Name of the provider.
+        status: HTTP status code of the response, or "error" if there is no
+            response.
+        duration: Duration of the request. In seconds.
+
+    """
+    EXTERNAL_CALL_DURATION.labels(
+        provider,
+        current_transport_mean.get(),
+        str(status),
+    ).observe(duration)
+
+
+def observe_maritime_search(algorithm: str, expanded_nodes: int):
+    """Record the number of nodes expanded by a maritime shortest-path search.
+
+    Args:
+        algorithm: Search algorithm, "dijkstra" or "astar".
+        expanded_nodes: Number of nodes expanded before the path is found.
+
+    """
+    MARITIME_SEARCH_EXPANDED_NODES.labels(algorithm).observe(expanded_nodes)
+
+
+def count_cache_lookup(cache: str, *, hit: bool):
+    """Count a lookup in a cache, as a hit or a miss."""
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def count_cache_eviction(
+    cache: str,
+    evictions: int = 1,
+    reason: Literal["full", "expired"] = "full",
+):
+    """Count entries removed from an in-memory cache, see memory_cache.
+
+    Args:
+        cache: Name of the cache.
+        evictions: Number of entries removed.
+        reason: "full" for the least recently used entries removed to make
+            room, "expired" for the entries removed after their time to live.
+
+    """
+    CACHE_EVICTIONS.labels(cache, reason).inc(evictions)
+
+
+def count_shared_call(call: str):
+    """Count a call answered by an identical call already running, see single_flight."""
+    SHARED_CALLS.labels(call).inc()
+
+
+lru_caches: dict[str, Callable] = {}
+"""Functions cached with functools.lru_cache, reported by name."""
+
+
+def register_lru_cache(name: str, function: Callable):
+    """Report the hits and misses of a function cached with functools.lru_cache."""
+    lru_caches[name] = function
+
+
+class LruCacheCollector(Collector):
+    """Collect the statistics of the registered LRU caches."""
+
+    def collect(self) -> Iterator[CounterMetricFamily]:
+        """Collect the hits and misses of each cache, as the cache lookups."""
+        lookups = CounterMetricFamily(
+            "lowtrip_lru_cache_lookups",
+            "Lookups in the in-memory LRU caches, by result (hit or miss).",
+            labels=["cache", "result"],
+        )
+        for name, function in lru_caches.items():
+            cache_info = function.cache_info()
+            lookups.add_metric([name, "hit"], cache_info.hits)
+            lookups.add_metric([name, "miss"], cache_info.misses)
+        yield lookups
+
+
+REGISTRY.register(LruCacheCollector())
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Render the metrics in the Prometheus text format.
+
+    Returns:
+        The metrics and their content type.
+
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -80,6 +80,26 @@ class ApiPayload(BaseModel):
     )
 
 
+MatrixTransportMean = Literal["car", "bus", "plane"]
+
+
+class MatrixApiPayload(BaseModel):
+    """Pydantic class for the emissions matrix API payload."""
+
+    origins: list[TripPoint] = Field(min_length=1)
+    destinations: list[TripPoint] = Field(min_length=1)
+    transport_means: list[MatrixTransportMean] = Field(
+        default=["car", "bus", "plane"],
+        alias="transport-means",
+        min_length=1,
+    )
+    passengers_nb: int = Field(
+        default=1,
+        ge=1,
+        alias="passengers-nb",
+    )
+
+
 ######################
 # INTERNAL
 ######################
@@ -93,10 +113,13 @@ class RouteResult:
     path_length_km: float
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, eq=False)
 class CountrySplitConfig:
     """Configuration for the function split_path_by_country (depends on the
     means of transport).
+
+    Configurations are compared and hashed by identity, so that the spatial
+    index built for each of them can be cached.
     """
 
     dataset: gpd.GeoDataFrame
@@ -122,6 +145,10 @@ class RouteNotValidError(Exception):
     """Raised when the route found between two coordinates is actually invalid."""
 
 
+class ProviderUnavailableError(Exception):
+    """Raised when a data provider cannot answer, so another one should be used."""
+
+
 ######################
 # OUTPUTS
 ######################
@@ -2,9 +2,10 @@
 ## Global variables ##
 ######################
 
-import geopandas as gpd
 from pyproj import Geod
 
+from static_datasets import load_static_dataset
+
 
 GEOD = Geod(ellps="WGS84")
 
@@ -14,10 +15,10 @@ GEOD = Geod(ellps="WGS84")
 # - China, Japan, USA, India & Russia: Railway Handbook produced by the International
 #   and Environmental Agency and the Union of Railways (2017, https://uic.org/IMG/pdf/handbook_iea-uic_2017_web3.pdf)
 # - other countries: 100gCO2 /p.km by default
-train_intensity = gpd.read_file("static/train_intensity.geojson")
+train_intensity = load_static_dataset("static/train_intensity.geojson")
 
 # Source: Our World in Data (2024) - https://ourworldindata.org/electricity-mix
-carbon_intensity_electricity = gpd.read_file(
+carbon_intensity_electricity = load_static_dataset(
     "static/carbon_intensity_electricity.geojson",
 )
 
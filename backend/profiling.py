@@ -0,0 +1,189 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Opt-in profiling of single requests, to find where a slow request spends its time.
+
+A profiled request runs with cProfile, in the request thread and in the
+task pool threads computing its steps (see task_pool.submit_task). Its
+profile is written to a pstats file named after the hash of its payload,
+which can be read with `python -m pstats` or snakeviz.
+
+Profiling is configured with environment variables:
+
+    PROFILING_DIR: directory of the profiles, profiling is disabled if unset
+    PROFILING_SECRET: key of the signatures of the requests to profile
+    PROFILING_SAMPLE_RATE: fraction of the requests profiled, 0 by default
+
+A request is profiled when its X-Profile-Signature header is the
+HMAC-SHA256 of its body with the secret, e.g.:
+
+    echo -n "$BODY" | openssl dgst -sha256 -hmac "$PROFILING_SECRET"
+"""
+
+from collections.abc import Callable, Iterator
+from contextlib import (
+    AbstractContextManager,
+    contextmanager,
+    nullcontext,
+)
+from contextvars import ContextVar
+import cProfile
+from dataclasses import dataclass, field
+import functools
+import hashlib
+import hmac
+import logging
+import os
+from pathlib import Path
+import pstats
+import random
+import threading
+import time
+from typing import ParamSpec, TypeVar
+
+
+logger = logging.getLogger(__name__)
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+PROFILING_DIR = os.getenv("PROFILING_DIR", "")
+
+PROFILING_SECRET = os.getenv("PROFILING_SECRET", "")
+
+PROFILING_SAMPLE_RATE = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+"""Fraction of the requests profiled without a signature, between 0 and 1."""
+
+PROFILING_HEADER = "X-Profile-Signature"
+
+
+@dataclass
+class RequestProfile:
+    """Profilers of the threads which took part in a request."""
+
+    profilers: list[cProfile.Profile] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add(self, profiler: cProfile.Profile):
+        """Add the profiler of a thread, once it is disabled."""
+        with self.lock:
+            self.profilers.append(profiler)
+
+
+current_profile: ContextVar[RequestProfile | None] = ContextVar(
+    "current_profile",
+    default=None,
+)
+"""Profile of the request being computed, None if it is not profiled."""
+
+
+def is_profiling_requested(body: bytes, signature: str | None) -> bool:
+    """Check if a request is signed for profiling, or sampled."""
+    if signature and PROFILING_SECRET:
+        expected_signature = hmac.new(
+            PROFILING_SECRET.encode(),
+            body,
+            hashlib.sha256,
+        ).hexdigest()
+        if hmac.compare_digest(expected_signature, signature):
+            return True
+        logger.warning("Invalid profiling signature")
+
+    # Sampling does not need a secure random generator
+    return random.random() < PROFILING_SAMPLE_RATE  # noqa: S311
+
+
+def profile_request(
+    body: bytes,
+    signature: str | None,
+) -> AbstractContextManager[None]:
+    """Profile the computation of a request if it is requested, see the module docstring.
+
+    Args:
+        body: Raw body of the request, signed and hashed.
+        signature: Value of the X-Profile-Signature header, if any.
+
+    """
+    if not PROFILING_DIR or not is_profiling_requested(body, signature):
+        return nullcontext()
+
+    return run_request_profile(body)
+
+
+@contextmanager
+def run_request_profile(body: bytes) -> Iterator[None]:
+    request_profile = RequestProfile()
+    token = current_profile.set(request_profile)
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        current_profile.reset(token)
+        request_profile.add(profiler)
+        save_profile(request_profile, body, time.perf_counter() - start)
+
+
+def profiled_task(function: Callable[P, T]) -> Callable[P, T]:
+    """Profile a task of the request being profiled, in its own thread."""
+
+    @functools.wraps(function)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+        request_profile = current_profile.get()
+        if request_profile is None:
+            return function(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            request_profile.add(profiler)
+
+    return wrapper
+
+
+def save_profile(request_profile: RequestProfile, body: bytes, duration: float):
+    """Write the merged profiles of the threads of a request to a pstats file.
+
+    Tasks still running when the request ends (see task_pool.wait_for_tasks)
+    are not included.
+
+    """
+    payload_hash = hashlib.sha256(body).hexdigest()[:16]
+    profile_path = (
+        Path(PROFILING_DIR) / f"{time.strftime('%Y%m%dT%H%M%S')}-{payload_hash}.prof"
+    )
+
+    try:
+        profile_path.parent.mkdir(parents=True, exist_ok=True)
+        with request_profile.lock:
+            stats = pstats.Stats(*request_profile.profilers)
+        stats.dump_stats(profile_path)
+    except OSError:
+        logger.exception("Profile could not be written")
+        return
+
+    logger.info(
+        "Request %s profiled in %s (%.2fs)",
+        payload_hash,
+        profile_path,
+        duration,
+    )
@@ -0,0 +1,335 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Persistent cache of the routes returned by the routing providers.
+
+Routes are stored in a SQLite database (in WAL mode), shared by all the
+workers and kept across restarts and deploys. The cache is configured with
+environment variables:
+
+    ROUTE_CACHE_PATH: database path, the cache is disabled when empty
+    ROUTE_CACHE_TTL_DAYS: number of days a route is kept
+    ROUTE_CACHE_MAX_ENTRIES: maximum number of routes kept
+
+Only found routes are cached: failed requests are always retried.
+"""
+
+import asyncio
+from collections.abc import Callable
+import functools
+import inspect
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+import shapely
+
+from metrics import count_cache_lookup
+from models import RouteResult
+from single_flight import SingleFlight
+
+
+logger = logging.getLogger(__name__)
+
+
+ROUTE_CACHE_PATH = os.getenv("ROUTE_CACHE_PATH", "cache/routes.sqlite3")
+
+ROUTE_CACHE_TTL = float(os.getenv("ROUTE_CACHE_TTL_DAYS", "30")) * 24 * 3600
+"""Time after which a cached route expires. In seconds."""
+
+ROUTE_CACHE_MAX_ENTRIES = int(os.getenv("ROUTE_CACHE_MAX_ENTRIES", "100000"))
+
+ROUTE_CACHE_EVICTION_INTERVAL = 100
+"""Number of writes of a connection between two evictions."""
+
+COORDINATES_PRECISION = 4
+"""Number of decimals of the coordinates in cache keys (about 10 m)."""
+
+SQLITE_BUSY_TIMEOUT = 5
+"""Time to wait for a lock held by another worker. In seconds."""
+
+
+class RouteCache:
+    """SQLite cache of routes, safe to share between threads and processes.
+
+    Each thread of each process uses its own connection to the database.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        ttl: float = ROUTE_CACHE_TTL,
+        max_entries: int = ROUTE_CACHE_MAX_ENTRIES,
+    ) -> None:
+        """Initialize the cache, the database is opened on first use.
+
+        Args:
+            path: Path of the SQLite database.
+            ttl: Time after which a cached route expires. In seconds.
+            max_entries: Maximum number of cached routes.
+
+        """
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get the connection of the current thread, opened on first use."""
+        connection = getattr(self._local, "connection", None)
+
+        # Connections must not be shared with forked worker processes
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS routes (
+                key TEXT PRIMARY KEY,
+                geometry BLOB NOT NULL,
+                path_length_km REAL NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS routes_created_at ON routes (created_at)"
+        )
+        connection.commit()
+
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        self._local.writes = 0
+        return connection
+
+    def get(self, key: str) -> RouteResult | None:
+        """Get a cached route, or None if it is missing or expired."""
+        row = (
+            self._connect()
+            .execute(
+                "SELECT geometry, path_length_km FROM routes"
+                " WHERE key = ? AND created_at > ?",
+                (key, time.time() - self.ttl),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+
+        geometry, path_length_km = row
+        return RouteResult(
+            geometry=shapely.from_wkb(geometry),
+            path_length_km=path_length_km,
+        )
+
+    def set(self, key: str, route: RouteResult):
+        """Cache a route, evicting old routes from time to time."""
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?)",
+                (
+                    key,
+                    shapely.to_wkb(route.geometry),
+                    route.path_length_km,
+                    time.time(),
+                ),
+            )
+
+        self._local.writes += 1
+        if self._local.writes % ROUTE_CACHE_EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove the expired routes and the oldest routes above max_entries."""
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "DELETE FROM routes WHERE created_at <= ?",
+                (time.time() - self.ttl,),
+            )
+            connection.execute(
+                """
+                DELETE FROM routes WHERE key IN (
+                    SELECT key FROM routes
+                    ORDER BY created_at DESC
+                    LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+
+route_cache = RouteCache(ROUTE_CACHE_PATH) if ROUTE_CACHE_PATH else None
+
+route_flights = SingleFlight("route")
+"""Routes being found, shared by the concurrent callers of the same route."""
+
+
+def route_cache_key(
+    provider: str,
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> str:
+    """Cache key of a route, made of the provider and the rounded coordinates."""
+    coordinates = ";".join(
+        f"{round(lon, COORDINATES_PRECISION)},{round(lat, COORDINATES_PRECISION)}"
+        for lon, lat in (departure_coords, arrival_coords)
+    )
+    return f"{provider}:{coordinates}"
+
+
+def disable_route_cache(error: OSError):
+    """Disable the route cache, e.g. when its directory cannot be created."""
+    global route_cache  # noqa: PLW0603
+    logger.warning("Route cache disabled: %s", error)
+    route_cache = None
+
+
+def get_cached_route(key: str) -> RouteResult | None:
+    """Get a route from the cache, logging cache errors."""
+    # The cache may be disabled by another thread
+    cache = route_cache
+    if cache is None:
+        return None
+
+    try:
+        return cache.get(key)
+    except OSError as err:
+        disable_route_cache(err)
+        return None
+    except sqlite3.Error:
+        logger.exception("Route cache could not be read")
+        return None
+
+
+def set_cached_route(key: str, route: RouteResult):
+    """Cache a route, logging cache errors."""
+    cache = route_cache
+    if cache is None:
+        return
+
+    try:
+        cache.set(key, route)
+    except OSError as err:
+        disable_route_cache(err)
+    except sqlite3.Error:
+        logger.exception("Route cache could not be written")
+
+
+def cached_route(provider: str) -> Callable:
+    """Cache the routes found by a routing function.
+
+    The decorated function takes the departure and arrival coordinates and
+    returns a RouteResult. Routes are cached unless the function returns None
+    or raises. Cache errors are logged and never prevent the routing, the
+    cache is disabled when its database cannot be created.
+
+    Coroutine functions are also supported, the cache is then accessed in a
+    separate thread so that the event loop is not blocked.
+
+    Concurrent calls for the same route, i.e. with the same cache key, send a
+    single request to the provider (see single_flight.py).
+
+    Args:
+        provider: Name of the routing provider, part of the cache key.
+
+    """
+
+    def decorator(find_route: Callable) -> Callable:
+        if inspect.iscoroutinefunction(find_route):
+
+            async def find_and_cache_route_async(
+                key: str,
+                departure_coords: tuple[float, float],
+                arrival_coords: tuple[float, float],
+            ) -> RouteResult | None:
+                route = await find_route(departure_coords, arrival_coords)
+
+                if route is not None and route_cache is not None:
+                    await asyncio.to_thread(set_cached_route, key, route)
+
+                return route
+
+            @functools.wraps(find_route)
+            async def async_wrapper(
+                departure_coords: tuple[float, float],
+                arrival_coords: tuple[float, float],
+            ) -> RouteResult | None:
+                key = route_cache_key(provider, departure_coords, arrival_coords)
+
+                if route_cache is not None:
+                    route = await asyncio.to_thread(get_cached_route, key)
+                    count_cache_lookup(f"route_{provider}", hit=route is not None)
+                    if route is not None:
+                        logger.info("Route found in cache for %s", provider)
+                        return route
+
+                return await route_flights.run_async(
+                    key,
+                    find_and_cache_route_async,
+                    key,
+                    departure_coords,
+                    arrival_coords,
+                )
+
+            return async_wrapper
+
+        def find_and_cache_route(
+            key: str,
+            departure_coords: tuple[float, float],
+            arrival_coords: tuple[float, float],
+        ) -> RouteResult | None:
+            route = find_route(departure_coords, arrival_coords)
+
+            if route is not None and route_cache is not None:
+                set_cached_route(key, route)
+
+            return route
+
+        @functools.wraps(find_route)
+        def wrapper(
+            departure_coords: tuple[float, float],
+            arrival_coords: tuple[float, float],
+        ) -> RouteResult | None:
+            key = route_cache_key(provider, departure_coords, arrival_coords)
+
+            if route_cache is not None:
+                route = get_cached_route(key)
+                count_cache_lookup(f"route_{provider}", hit=route is not None)
+                if route is not None:
+                    logger.info("Route found in cache for %s", provider)
+                    return route
+
+            return route_flights.run(
+                key,
+                find_and_cache_route,
+                key,
+                departure_coords,
+                arrival_coords,
+            )
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,171 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Coalescing of identical calls running at the same time.
+
+During traffic spikes, many requests ask for the same popular routes at the
+same moment. With a single flight, only the first caller sends the request
+to the provider: the concurrent callers with the same key wait for its
+result instead of sending duplicate requests.
+"""
+
+import asyncio
+from collections.abc import (
+    Callable,
+    Coroutine,
+    Hashable,
+)
+from concurrent.futures import Future
+from dataclasses import dataclass
+import math
+import threading
+from typing import (
+    Any,
+    ParamSpec,
+    TypeVar,
+)
+
+from metrics import count_shared_call
+from task_pool import get_remaining_time
+
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+@dataclass
+class _AsyncCall:
+    """Call shared between the coroutines of an event loop."""
+
+    task: asyncio.Task
+    waiters: int = 0
+
+
+class SingleFlight:
+    """Share the result of a call between the callers asking for it at the same time.
+
+    The result is only shared while the call runs, it is not cached. If the
+    call raises, the exception is raised to every caller waiting for it.
+    """
+
+    def __init__(self, name: str) -> None:
+        """Initialize the single flight, with no call running.
+
+        Args:
+            name: Name of the calls, labelling the metrics.
+
+        """
+        self.name = name
+        self._calls: dict[Hashable, Future] = {}
+        self._async_calls: dict[
+            tuple[asyncio.AbstractEventLoop, Hashable], _AsyncCall
+        ] = {}
+        self._lock = threading.Lock()
+
+    def run(
+        self,
+        key: Hashable,
+        function: Callable[P, T],
+        *args: P.args,
+        **kwargs: P.kwargs,
+    ) -> T:
+        """Call a function, unless a call with the same key is running.
+
+        The running call is waited for until the deadline of the current
+        request at most (see task_pool.current_deadline).
+
+        Returns:
+            The result of the function, or of the running call with the same
+            key.
+
+        Raises:
+            TimeoutError:
+                If the running call is not done before the request deadline.
+
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._calls[key] = Future()
+
+        if not is_leader:
+            count_shared_call(self.name)
+            remaining_time = get_remaining_time()
+            timeout = None if math.isinf(remaining_time) else max(remaining_time, 0)
+            return future.result(timeout=timeout)
+
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    async def run_async(
+        self,
+        key: Hashable,
+        function: Callable[P, Coroutine[Any, Any, T]],
+        *args: P.args,
+        **kwargs: P.kwargs,
+    ) -> T:
+        """Await a coroutine function, unless a call with the same key is running.
+
+        Calls are only shared within an event loop. The call runs in its own
+        task, so a cancelled caller does not cancel the callers waiting for
+        the same call. The task is only cancelled when all of its callers
+        are.
+
+        """
+        loop = asyncio.get_running_loop()
+        loop_key = (loop, key)
+
+        with self._lock:
+            call = self._async_calls.get(loop_key)
+            is_leader = call is None
+            if is_leader:
+                call = self._async_calls[loop_key] = _AsyncCall(
+                    loop.create_task(function(*args, **kwargs))
+                )
+                call.task.add_done_callback(
+                    lambda _: self._forget_async_call(loop_key, call)
+                )
+            call.waiters += 1
+
+        if not is_leader:
+            count_shared_call(self.name)
+
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters:
+                call.task.cancel()
+
+    def _forget_async_call(
+        self,
+        loop_key: tuple[asyncio.AbstractEventLoop, Hashable],
+        call: _AsyncCall,
+    ) -> None:
+        with self._lock:
+            if self._async_calls.get(loop_key) is call:
+                del self._async_calls[loop_key]
@@ -0,0 +1,120 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compiled binary versions of the static GeoJSON datasets.
+
+Parsing the GeoJSON files is slow and done by every worker at startup, so
+they can be compiled once into GeoParquet files:
+
+    python static_datasets.py
+
+Each compiled file is named after the content hash of its GeoJSON source,
+so a compiled file left behind by an older version of the source is never
+loaded.
+"""
+
+import hashlib
+import logging
+from pathlib import Path
+import time
+
+import geopandas as gpd
+
+
+logger = logging.getLogger(__name__)
+
+
+STATIC_DATASETS = [
+    "static/train_intensity.geojson",
+    "static/carbon_intensity_electricity.geojson",
+]
+
+COMPILED_DATASETS_DIR = Path("static/compiled")
+
+CONTENT_HASH_LENGTH = 16
+
+DATASET_LOAD_TIMES: dict[str, tuple[str, float]] = {}
+"""Source ("compiled" or "geojson") and load time in seconds of each loaded dataset."""
+
+
+def compute_content_hash(path: str | Path) -> str:
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()[:CONTENT_HASH_LENGTH]
+
+
+def get_compiled_dataset_path(geojson_path: str | Path) -> Path:
+    """Path of the compiled dataset matching the current content of a GeoJSON file."""
+    geojson_path = Path(geojson_path)
+    content_hash = compute_content_hash(geojson_path)
+    return COMPILED_DATASETS_DIR / f"{geojson_path.stem}.{content_hash}.parquet"
+
+
+def compile_dataset(geojson_path: str | Path) -> Path:
+    """Compile a GeoJSON dataset into a GeoParquet file.
+
+    Compiled files of previous versions of the dataset are removed.
+
+    Returns:
+        The path of the compiled dataset.
+
+    """
+    geojson_path = Path(geojson_path)
+    compiled_path = get_compiled_dataset_path(geojson_path)
+
+    COMPILED_DATASETS_DIR.mkdir(parents=True, exist_ok=True)
+    for stale_path in COMPILED_DATASETS_DIR.glob(f"{geojson_path.stem}.*.parquet"):
+        if stale_path != compiled_path:
+            stale_path.unlink()
+
+    gpd.read_file(geojson_path).to_parquet(compiled_path)
+    return compiled_path
+
+
+def load_static_dataset(geojson_path: str | Path) -> gpd.GeoDataFrame:
+    """Load a static dataset, from its compiled version when it is up to date.
+
+    Falls back to parsing the GeoJSON file when the compiled dataset is
+    missing, stale or cannot be read.
+
+    """
+    start = time.perf_counter()
+    compiled_path = get_compiled_dataset_path(geojson_path)
+
+    try:
+        dataset = gpd.read_parquet(compiled_path)
+        source = "compiled"
+    except FileNotFoundError:
+        logger.warning(
+            "No up-to-date compiled dataset for %s, run static_datasets.py",
+            geojson_path,
+        )
+        dataset = gpd.read_file(geojson_path)
+        source = "geojson"
+    except Exception:
+        logger.exception("Compiled dataset %s could not be read", compiled_path)
+        dataset = gpd.read_file(geojson_path)
+        source = "geojson"
+
+    load_time = time.perf_counter() - start
+    DATASET_LOAD_TIMES[str(geojson_path)] = (source, load_time)
+    logger.info("Loaded %s from %s in %.3fs", geojson_path, source, load_time)
+
+    return dataset
+
+
+if __name__ == "__main__":
+    for static_dataset in STATIC_DATASETS:
+        print(f"{static_dataset} -> {compile_dataset(static_dataset)}")
@@ -0,0 +1,181 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Bounded thread pool used to compute independent parts of a request concurrently.
+
+Most of the computation time of a request is spent waiting for the routing
+providers, so independent routes are requested concurrently. The pool is
+configured with environment variables:
+
+    TASK_POOL_MAX_WORKERS: maximum number of threads of each worker process
+    REQUEST_DEADLINE_SECONDS: maximum time to wait for the tasks of a request
+
+The deadline of the request being computed is also kept in a context
+variable (see current_deadline), so that the requests to the providers are
+not retried past it.
+"""
+
+from collections.abc import Callable, Hashable
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+import contextvars
+from functools import cache
+import itertools
+import logging
+import os
+import time
+from typing import ParamSpec, TypeVar
+
+from profiling import current_profile, profiled_task
+
+
+logger = logging.getLogger(__name__)
+
+P = ParamSpec("P")
+T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
+
+
+TASK_POOL_MAX_WORKERS = int(os.getenv("TASK_POOL_MAX_WORKERS", "8"))
+
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE_SECONDS", "60"))
+"""Maximum time to wait for the tasks of a request. In seconds."""
+
+current_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "current_deadline",
+    default=None,
+)
+"""Deadline of the request being computed (see compute_deadline), None outside
+of a request, e.g. in the bulk computations."""
+
+
+@cache
+def get_task_pool() -> ThreadPoolExecutor:
+    """Get the task pool of the current process, created on first use."""
+    return ThreadPoolExecutor(
+        max_workers=TASK_POOL_MAX_WORKERS,
+        thread_name_prefix="task",
+    )
+
+
+def submit_task(
+    function: Callable[P, T],
+    *args: P.args,
+    **kwargs: P.kwargs,
+) -> Future[T]:
+    """Run a function in the task pool, in a copy of the current context.
+
+    Context variables (e.g. the transport mean labelling the metrics) are
+    thus available in the task. Tasks of a profiled request are profiled too
+    (see profiling.py).
+
+    """
+    if current_profile.get() is not None:
+        function = profiled_task(function)
+
+    return get_task_pool().submit(
+        contextvars.copy_context().run,
+        function,
+        *args,
+        **kwargs,
+    )
+
+
+def compute_deadline(timeout: float = REQUEST_DEADLINE) -> float:
+    """Deadline of a request starting now, comparable with time.monotonic()."""
+    return time.monotonic() + timeout
+
+
+def get_remaining_time() -> float:
+    """Time left before the deadline of the current request. In seconds."""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return float("inf")
+    return deadline - time.monotonic()
+
+
+def wait_for_tasks(futures: list[Future], deadline: float) -> list[Future]:
+    """Wait for tasks until they are all done or the deadline is reached.
+
+    Tasks that are not done at the deadline are cancelled if they have not
+    started yet, and are no longer waited for otherwise.
+
+    Returns:
+        The tasks that are done, in the order of the input tasks.
+
+    """
+    done, not_done = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+
+    if not_done:
+        logger.warning("%s tasks not done before the request deadline", len(not_done))
+        for future in not_done:
+            future.cancel()
+
+    return [future for future in futures if future in done]
+
+
+def run_bounded_tasks(
+    tasks: dict[K, tuple[Callable[..., T], tuple]],
+    max_concurrency: int,
+    deadline: float,
+) -> dict[K, Future[T]]:
+    """Run tasks in the task pool, with at most max_concurrency tasks at once.
+
+    Large groups of tasks are not submitted at once, so that they do not
+    delay the tasks of the other requests.
+
+    Args:
+        tasks: Function and arguments of each task, by key.
+        max_concurrency: Maximum number of tasks submitted at the same time.
+        deadline: Tasks not done at the deadline are cancelled.
+
+    Returns:
+        The tasks that are done, by key.
+
+    """
+    calls = iter(tasks.items())
+    running: dict[Future[T], K] = {}
+    done_tasks: dict[K, Future[T]] = {}
+
+    def submit_next(count: int) -> None:
+        for key, (function, args) in itertools.islice(calls, count):
+            running[submit_task(function, *args)] = key
+
+    submit_next(max_concurrency)
+
+    while running:
+        done, _ = wait(
+            running,
+            timeout=max(deadline - time.monotonic(), 0),
+            return_when=FIRST_COMPLETED,
+        )
+        if not done:
+            not_done = len(tasks) - len(done_tasks)
+            logger.warning("%s tasks not done before the deadline", not_done)
+            for future in running:
+                future.cancel()
+            break
+
+        for future in done:
+            done_tasks[running.pop(future)] = future
+        submit_next(len(done))
+
+    return done_tasks
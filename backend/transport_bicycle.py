@@ -18,10 +18,12 @@
 from http import HTTPStatus
 import os
 
+import httpx
 import requests
 from shapely.geometry import LineString
 
 from geo_validate_geometry import validate_geometry
+import http_client
 from models import (
     BicycleStepData,
     EmissionPart,
@@ -31,6 +33,7 @@ from models import (
     TripStepResult,
     TripType,
 )
+from route_cache import cached_route
 from utils import m_to_km
 
 
@@ -43,29 +46,25 @@ API_KEY = os.environ.get("BICYCLE_API_KEY")
 OPEN_ROUTE_SERVICE = "https://api.openrouteservice.org/v2/directions/cycling-regular"
 
 
-def find_bicycle_route(
+def build_bicycle_route_url(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
-) -> RouteResult:
-    """Fetches a bicycle route between two geographic coordinates using
-    the OpenRouteService API.
+) -> str:
+    return f"{OPEN_ROUTE_SERVICE}?api_key={API_KEY}&start={departure_coords[0]},{departure_coords[1]}&end={arrival_coords[0]},{arrival_coords[1]}"
 
-    Args:
-        departure_coords: Departure coordinates as (longitude, latitude).
-        arrival_coords: Arrival coordinates as (longitude, latitude).
 
-    Returns:
-        A RouteResult containing the route geometry and path length.
+def parse_bicycle_route_response(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+    response: requests.Response | httpx.Response,
+) -> RouteResult:
+    """Read the bicycle route found by OpenRouteService.
 
     Raises:
         RouteNotFoundError:
-            If no bicycle route could be found.
+            If OpenRouteService did not find a route.
 
     """
-    response = requests.get(
-        f"{OPEN_ROUTE_SERVICE}?api_key={API_KEY}&start={departure_coords[0]},{departure_coords[1]}&end={arrival_coords[0]},{arrival_coords[1]}",
-    )
-
     if response.status_code != HTTPStatus.OK:
         raise RouteNotFoundError(
             f"No bicycle route found between {departure_coords} and {arrival_coords}",
@@ -82,10 +81,67 @@ def find_bicycle_route(
     return RouteResult(geometry=route_geometry, path_length_km=route_length)
 
 
+@cached_route("openrouteservice")
+def find_bicycle_route(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> RouteResult:
+    """Fetches a bicycle route between two geographic coordinates using
+    the OpenRouteService API.
+
+    Args:
+        departure_coords: Departure coordinates as (longitude, latitude).
+        arrival_coords: Arrival coordinates as (longitude, latitude).
+
+    Returns:
+        A RouteResult containing the route geometry and path length.
+
+    Raises:
+        RouteNotFoundError:
+            If no bicycle route could be found.
+
+    """
+    try:
+        response = http_client.get(
+            "openrouteservice",
+            build_bicycle_route_url(departure_coords, arrival_coords),
+        )
+    except requests.RequestException as e:
+        raise RouteNotFoundError(
+            f"OpenRouteService is unreachable, no bicycle route found between {departure_coords} and {arrival_coords}",
+        ) from e
+
+    return parse_bicycle_route_response(departure_coords, arrival_coords, response)
+
+
+@cached_route("openrouteservice")
+async def find_bicycle_route_async(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> RouteResult:
+    """Fetches a bicycle route without blocking the event loop.
+
+    See find_bicycle_route.
+
+    """
+    try:
+        response = await http_client.get_async(
+            "openrouteservice",
+            build_bicycle_route_url(departure_coords, arrival_coords),
+        )
+    except httpx.TransportError as e:
+        raise RouteNotFoundError(
+            f"OpenRouteService is unreachable, no bicycle route found between {departure_coords} and {arrival_coords}",
+        ) from e
+
+    return parse_bicycle_route_response(departure_coords, arrival_coords, response)
+
+
 def compute_bicycle_trip(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
     trip_type: TripType,
+    precomputed_route: RouteResult | None = None,
 ) -> TripStepResult:
     """Computes a bicycle trip between two coordinates.
 
@@ -96,12 +152,14 @@ def compute_bicycle_trip(
         departure_coords: Departure coordinates as (longitude, latitude).
         arrival_coords: Arrival coordinates as (longitude, latitude).
         trip_type: Type of trip to compute.
+        precomputed_route: Optional bicycle route already found between the
+            coordinates.
 
     Returns:
         A ``TripStepResult`` containing the route geometry and emissions data
 
     """
-    result = find_bicycle_route(departure_coords, arrival_coords)
+    result = precomputed_route or find_bicycle_route(departure_coords, arrival_coords)
 
     validate_geometry(departure_coords, arrival_coords, result.geometry)
 
@@ -18,11 +18,14 @@
 from http import HTTPStatus
 import logging
 
+import httpx
+import numpy as np
 import requests
 from shapely.geometry import LineString
 
 from geo_split_path_by_country import split_path_by_country
 from geo_validate_geometry import validate_geometry
+import http_client
 from models import (
     BusStepData,
     CarStepData,
@@ -37,6 +40,7 @@ from models import (
     TripType,
 )
 from parameters import carbon_intensity_electricity
+from route_cache import cached_route
 from utils import m_to_km
 
 
@@ -44,6 +48,13 @@ logger = logging.getLogger(__name__)
 
 
 OSM_ROUTER_URL = "http://router.project-osrm.org/route/v1/driving"
+OSM_TABLE_URL = "http://router.project-osrm.org/table/v1/driving"
+
+OSM_TABLE_MAX_COORDINATES = 100
+"""Maximum number of coordinates of a table request (default of OSRM servers)."""
+
+ROAD_SNAP_DISTANCE_THRESHOLD = 100
+"""Maximum distance between coordinates and the road network. In km."""
 
 
 # Car emissions factors (kgCO2e / km).
@@ -72,6 +83,42 @@ ECAR_COUNTRY_SPLIT_CONFIG = CountrySplitConfig(
 EXTRA_PASSENGER_EMISSION_FACTOR = 0.04
 
 
+def build_route_url(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> str:
+    return f"{OSM_ROUTER_URL}/{departure_coords[0]},{departure_coords[1]};{arrival_coords[0]},{arrival_coords[1]}?overview=simplified&geometries=geojson"
+
+
+def parse_route_response(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+    response: requests.Response | httpx.Response,
+) -> RouteResult:
+    """Read the route found by the routing provider and validate its geometry.
+
+    Raises:
+        RouteNotFoundError:
+            If the routing provider did not find a route.
+
+    """
+    if response.status_code != HTTPStatus.OK:
+        logger.warning("OSM request failed with status code: %s", response.status_code)
+        raise RouteNotFoundError(
+            f"No route by road found between {departure_coords} and {arrival_coords}",
+        )
+
+    route = response.json()["routes"][0]
+    route_geometry = LineString(route["geometry"]["coordinates"])
+
+    validate_geometry(departure_coords, arrival_coords, route_geometry)
+
+    route_length = m_to_km(route["distance"])
+
+    return RouteResult(geometry=route_geometry, path_length_km=route_length)
+
+
+@cached_route("osrm")
 def find_route(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
@@ -94,23 +141,139 @@ def find_route(
     """
     logger.info("Request road route from OSM router")
 
-    response = requests.get(
-        f"{OSM_ROUTER_URL}/{departure_coords[0]},{departure_coords[1]};{arrival_coords[0]},{arrival_coords[1]}?overview=simplified&geometries=geojson",
+    try:
+        response = http_client.get(
+            "osrm",
+            build_route_url(departure_coords, arrival_coords),
+        )
+    except requests.RequestException as e:
+        raise RouteNotFoundError(
+            f"OSM router is unreachable, no route by road found between {departure_coords} and {arrival_coords}",
+        ) from e
+
+    return parse_route_response(departure_coords, arrival_coords, response)
+
+
+@cached_route("osrm")
+async def find_route_async(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> RouteResult:
+    """Find a road route between two coordinates without blocking the event loop.
+
+    See find_route.
+
+    """
+    logger.info("Request road route from OSM router")
+
+    try:
+        response = await http_client.get_async(
+            "osrm",
+            build_route_url(departure_coords, arrival_coords),
+        )
+    except httpx.TransportError as e:
+        raise RouteNotFoundError(
+            f"OSM router is unreachable, no route by road found between {departure_coords} and {arrival_coords}",
+        ) from e
+
+    return parse_route_response(departure_coords, arrival_coords, response)
+
+
+def request_road_distance_table(
+    sources: list[tuple[float, float]],
+    destinations: list[tuple[float, float]],
+) -> np.ndarray:
+    """Request the road distances between sources and destinations at once.
+
+    Args:
+        sources: Source coordinates as (longitude, latitude).
+        destinations: Destination coordinates as (longitude, latitude).
+
+    Returns:
+        Road distances in kilometers, shape (len(sources), len(destinations)),
+        NaN when no route is found.
+
+    Raises:
+        RouteNotFoundError:
+            If the routing provider cannot answer.
+
+    """
+    coordinates = ";".join(f"{lon},{lat}" for lon, lat in [*sources, *destinations])
+    source_indices = ";".join(str(idx) for idx in range(len(sources)))
+    destination_indices = ";".join(
+        str(idx) for idx in range(len(sources), len(sources) + len(destinations))
     )
 
+    try:
+        response = http_client.get(
+            "osrm",
+            f"{OSM_TABLE_URL}/{coordinates}?sources={source_indices}&destinations={destination_indices}&annotations=distance",
+        )
+    except requests.RequestException as e:
+        raise RouteNotFoundError("OSM router is unreachable") from e
+
     if response.status_code != HTTPStatus.OK:
-        logger.warning("OSM request failed with status code: %s", response.status_code)
-        raise RouteNotFoundError(
-            f"No route by road found between {departure_coords} and {arrival_coords}",
+        logger.warning(
+            "OSM table request failed with status code: %s", response.status_code
         )
+        raise RouteNotFoundError("No road distances found")
 
-    route = response.json()["routes"][0]
-    route_geometry = LineString(route["geometry"]["coordinates"])
+    table = response.json()
+    distances = m_to_km(np.array(table["distances"], dtype=float))
 
-    validate_geometry(departure_coords, arrival_coords, route_geometry)
+    # Same check as validate_geometry: coordinates far from any road are unreachable
+    for axis, waypoints in enumerate((table["sources"], table["destinations"])):
+        snap_distances = m_to_km(
+            np.array([waypoint["distance"] for waypoint in waypoints])
+        )
+        not_valid = snap_distances > ROAD_SNAP_DISTANCE_THRESHOLD
+        if axis == 0:
+            distances[not_valid, :] = np.nan
+        else:
+            distances[:, not_valid] = np.nan
+
+    return distances
 
-    route_length = m_to_km(route["distance"])
-    return RouteResult(geometry=route_geometry, path_length_km=route_length)
+
+def find_road_distances(
+    origins: list[tuple[float, float]],
+    destinations: list[tuple[float, float]],
+) -> np.ndarray:
+    """Find the road distances between all origins and destinations.
+
+    The distances are requested by blocks, with as few table requests as
+    possible, instead of one route request per pair.
+
+    Args:
+        origins: Origin coordinates as (longitude, latitude).
+        destinations: Destination coordinates as (longitude, latitude).
+
+    Returns:
+        Road distances in kilometers, shape (len(origins), len(destinations)),
+        NaN when no route is found.
+
+    """
+    destination_block = min(len(destinations), OSM_TABLE_MAX_COORDINATES // 2)
+    origin_block = min(len(origins), OSM_TABLE_MAX_COORDINATES - destination_block)
+    destination_block = OSM_TABLE_MAX_COORDINATES - origin_block
+
+    distances = np.full((len(origins), len(destinations)), np.nan)
+
+    logger.info("Request road distances table from OSM router")
+
+    for i in range(0, len(origins), origin_block):
+        for j in range(0, len(destinations), destination_block):
+            try:
+                distances[i : i + origin_block, j : j + destination_block] = (
+                    request_road_distance_table(
+                        origins[i : i + origin_block],
+                        destinations[j : j + destination_block],
+                    )
+                )
+            except RouteNotFoundError:
+                logger.warning("No road distances found for a block of the table")
+
+    return distances
 
 
 def compute_passenger_adjustment_factor(
@@ -130,6 +293,7 @@ def compute_ecar_trip(
     arrival_coords: tuple[float, float],
     trip_type: TripType,
     passengers_nb=1,
+    precomputed_route: RouteResult | None = None,
 ):
     """Compute an electric car trip between two coordinates.
 
@@ -153,12 +317,14 @@ def compute_ecar_trip(
         arrival_coords: Arrival coordinates as (longitude, latitude).
         trip_type: Type of trip to compute.
         passengers_nb: Number of passengers in the vehicle.
+        precomputed_route: Optional road route already found between the
+            coordinates.
 
     Returns:
         A ``TripStepResult`` containing the route geometry and emissions data.
 
     """
-    result = find_route(departure_coords, arrival_coords)
+    result = precomputed_route or find_route(departure_coords, arrival_coords)
 
     route_length = result.path_length_km
 
@@ -214,6 +380,7 @@ def compute_bus_trip(
     arrival_coords: tuple[float, float],
     trip_type: TripType,
     precomputed_route_length_km: float | None = None,
+    precomputed_route: RouteResult | None = None,
 ) -> TripStepResult:
     """Compute a bus trip between two coordinates.
 
@@ -232,6 +399,8 @@ def compute_bus_trip(
         trip_type: Type of trip to compute.
         precomputed_route_length_km: Optional precomputed route length in
             kilometers used to avoid recomputing the road itinerary.
+        precomputed_route: Optional road route already found between the
+            coordinates.
 
     Returns:
         A ``TripStepResult`` containing the route geometry and emissions data.
@@ -241,7 +410,7 @@ def compute_bus_trip(
         route_length = precomputed_route_length_km
         geometries = []
     else:
-        result = find_route(departure_coords, arrival_coords)
+        result = precomputed_route or find_route(departure_coords, arrival_coords)
 
         route_length = result.path_length_km
         geometries = [
@@ -254,6 +423,21 @@ def compute_bus_trip(
             ),
         ]
 
+    return TripStepResult(
+        step_data=compute_bus_step_data(route_length),
+        geometries=geometries,
+    )
+
+
+def compute_bus_step_data(route_length: float) -> BusStepData:
+    """Compute the emissions of a bus trip from its route length.
+
+    See compute_bus_trip.
+
+    Args:
+        route_length: Route length in kilometers.
+
+    """
     emissions = [
         EmissionPart(
             name="construction",
@@ -269,15 +453,12 @@ def compute_bus_trip(
         ),
     ]
 
-    return TripStepResult(
-        step_data=BusStepData(
-            transport="bus",
-            emissions=emissions,
-            path_length=round(route_length),
-            coeff_upstream=EF_BUS_CONSTRUCTION,
-            coeff_fuel=EF_BUS_FUEL,
-        ),
-        geometries=geometries,
+    return BusStepData(
+        transport="bus",
+        emissions=emissions,
+        path_length=round(route_length),
+        coeff_upstream=EF_BUS_CONSTRUCTION,
+        coeff_fuel=EF_BUS_FUEL,
     )
 
 
@@ -287,6 +468,7 @@ def compute_car_trip(
     trip_type: TripType,
     passengers_nb=1,
     precomputed_route_length_km: float | None = None,
+    precomputed_route: RouteResult | None = None,
 ) -> TripStepResult:
     """Compute a car trip between two coordinates.
 
@@ -311,6 +493,8 @@ def compute_car_trip(
         passengers_nb: Number of passengers in the vehicle.
         precomputed_route_length_km: Optional precomputed route length in
             kilometers used to avoid recomputing the road itinerary.
+        precomputed_route: Optional road route already found between the
+            coordinates.
 
     Returns:
         A ``TripStepResult`` containing the route geometry and emissions data.
@@ -320,7 +504,7 @@ def compute_car_trip(
         route_length = precomputed_route_length_km
         geometries = []
     else:
-        result = find_route(departure_coords, arrival_coords)
+        result = precomputed_route or find_route(departure_coords, arrival_coords)
 
         route_length = result.path_length_km
         geometries = [
@@ -333,6 +517,22 @@ def compute_car_trip(
             ),
         ]
 
+    return TripStepResult(
+        step_data=compute_car_step_data(route_length, passengers_nb),
+        geometries=geometries,
+    )
+
+
+def compute_car_step_data(route_length: float, passengers_nb=1) -> CarStepData:
+    """Compute the emissions of a car trip from its route length.
+
+    See compute_car_trip.
+
+    Args:
+        route_length: Route length in kilometers.
+        passengers_nb: Number of passengers in the vehicle.
+
+    """
     passenger_adjustment_factor = compute_passenger_adjustment_factor(passengers_nb)
     EF_fuel = EF_CAR_FUEL * passenger_adjustment_factor
     EF_construction = EF_CAR_CONSTRUCTION / passengers_nb
@@ -352,16 +552,13 @@ def compute_car_trip(
         ),
     ]
 
-    return TripStepResult(
-        step_data=CarStepData(
-            transport="car",
-            emissions=emissions,
-            passengers_nb=passengers_nb,
-            path_length=round(route_length),
-            coeff_upstream=EF_CAR_CONSTRUCTION,
-            coeff_fuel=EF_CAR_FUEL,
-        ),
-        geometries=geometries,
+    return CarStepData(
+        transport="car",
+        emissions=emissions,
+        passengers_nb=passengers_nb,
+        path_length=round(route_length),
+        coeff_upstream=EF_CAR_CONSTRUCTION,
+        coeff_fuel=EF_CAR_FUEL,
     )
 
 
@@ -369,6 +566,7 @@ def compute_hitch_hiking_trip(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
     trip_type: TripType,
+    precomputed_route: RouteResult | None = None,
 ) -> TripStepResult:
     """Compute a hitchhiking trip between two coordinates.
 
@@ -388,12 +586,14 @@ def compute_hitch_hiking_trip(
         departure_coords: Departure coordinates as (longitude, latitude).
         arrival_coords: Arrival coordinates as (longitude, latitude).
         trip_type: Type of trip to compute.
+        precomputed_route: Optional road route already found between the
+            coordinates.
 
     Returns:
         A ``TripStepResult`` containing the route geometry and emissions data.
 
     """
-    result = find_route(departure_coords, arrival_coords)
+    result = precomputed_route or find_route(departure_coords, arrival_coords)
 
     route_length = result.path_length_km
 
@@ -16,9 +16,13 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from dataclasses import dataclass
+from functools import lru_cache
+import math
 
+import numpy as np
 from shapely.geometry import LineString
 
+from metrics import register_lru_cache
 from models import (
     EmissionPart,
     PlaneStepData,
@@ -43,6 +47,8 @@ class PlaneEmissionFactors:
 # Plane emissions factors (kgCO2e / passenger.km)
 # SHORT < 1000km < MEDIUM < 3500km < LONG
 # Source: ADEME Base Carbone (2024)
+SHORT_HAUL_MAX_DISTANCE = 1000  # km
+MEDIUM_HAUL_MAX_DISTANCE = 3500  # km
 EF_PLANE_SHORT = PlaneEmissionFactors(
     construction=0.00038,
     upstream=0.0242,
@@ -75,8 +81,29 @@ HOLD = 3.81  # kg/p
 CONTRAILS_COEFF = 2
 
 
-# Number of points in plane geometry
-GREAT_CIRCLE_INTERPOLATION_POINTS = 100
+GREAT_CIRCLE_POINT_SPACING = 100
+"""Target distance between two points of plane geometries. In km."""
+
+# Number of points in plane geometry, whatever the distance
+GREAT_CIRCLE_MIN_POINTS = 10
+GREAT_CIRCLE_MAX_POINTS = 200
+
+GREAT_CIRCLE_COORDINATES_PRECISION = 4
+"""Number of decimals of the coordinates of plane geometries (about 10 m)."""
+
+GREAT_CIRCLE_CACHE_SIZE = 2048
+"""Number of plane geometries kept in memory by each worker."""
+
+
+def compute_great_circle_points_nb(route_length: float) -> int:
+    """Number of points of a plane geometry, spaced by GREAT_CIRCLE_POINT_SPACING."""
+    return min(
+        max(
+            math.ceil(route_length / GREAT_CIRCLE_POINT_SPACING) + 1,
+            GREAT_CIRCLE_MIN_POINTS,
+        ),
+        GREAT_CIRCLE_MAX_POINTS,
+    )
 
 
 def compute_great_circle_route(
@@ -87,14 +114,13 @@ def compute_great_circle_route(
 
     A great-circle route represents the shortest path between two points on
     the Earth's surface. The route is computed using geodesic interpolation
-    with pyproj, generating intermediate points along the geodesic.
+    with pyproj, generating intermediate points along the geodesic, about
+    every GREAT_CIRCLE_POINT_SPACING km.
 
     The resulting points are assembled into a LineString geometry suitable
-    for map display and route visualization.
-
-    Special handling is applied for routes crossing the antimeridian
-    (±180° longitude) to avoid invalid map rendering caused by longitude
-    wrapping.
+    for map display and route visualization. Geometries are computed for
+    rounded coordinates, and kept in a LRU cache (see
+    compute_great_circle_geometry).
 
     Args:
         departure_coords: Departure coordinates as (longitude, latitude).
@@ -106,14 +132,56 @@ def compute_great_circle_route(
             - The geodesic distance in kilometers
 
     """
+    _, _, distance = GEOD.inv(
+        float(departure_coords[0]),
+        float(departure_coords[1]),
+        float(arrival_coords[0]),
+        float(arrival_coords[1]),
+    )
+
+    geometry = compute_great_circle_geometry(
+        (
+            round(float(departure_coords[0]), GREAT_CIRCLE_COORDINATES_PRECISION),
+            round(float(departure_coords[1]), GREAT_CIRCLE_COORDINATES_PRECISION),
+        ),
+        (
+            round(float(arrival_coords[0]), GREAT_CIRCLE_COORDINATES_PRECISION),
+            round(float(arrival_coords[1]), GREAT_CIRCLE_COORDINATES_PRECISION),
+        ),
+    )
+
+    return geometry, m_to_km(distance)
+
+
+@lru_cache(maxsize=GREAT_CIRCLE_CACHE_SIZE)
+def compute_great_circle_geometry(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> LineString:
+    """Compute the geometry of the great-circle route between two coordinates.
+
+    Plane geometries only depend on their coordinates, so they are cached.
+    Cache hits and misses are given by compute_great_circle_geometry.cache_info().
+
+    Special handling is applied for routes crossing the antimeridian
+    (±180° longitude) to avoid invalid map rendering caused by longitude
+    wrapping.
+
+    Args:
+        departure_coords: Rounded departure coordinates as (longitude, latitude).
+        arrival_coords: Rounded arrival coordinates as (longitude, latitude).
+
+    """
+    _, _, distance = GEOD.inv(*departure_coords, *arrival_coords)
+
     # Generate intermediate longitude/latitude points along the geodesic route
     # between departure and arrival coordinates.
     geodesic_result = GEOD.inv_intermediate(
-        lon1=float(departure_coords[0]),
-        lat1=float(departure_coords[1]),
-        lon2=float(arrival_coords[0]),
-        lat2=float(arrival_coords[1]),
-        npts=GREAT_CIRCLE_INTERPOLATION_POINTS,
+        lon1=departure_coords[0],
+        lat1=departure_coords[1],
+        lon2=arrival_coords[0],
+        lat2=arrival_coords[1],
+        npts=compute_great_circle_points_nb(m_to_km(distance)),
         initial_idx=0,
         terminus_idx=0,
     )
@@ -134,21 +202,77 @@ def compute_great_circle_route(
             for lon, lat in zip(geodesic_result.lons, geodesic_result.lats)
         ]
 
-    return LineString(coordinates), m_to_km(geodesic_result.dist)
+    return LineString(coordinates)
+
+
+register_lru_cache("great_circle_geometry", compute_great_circle_geometry)
+
+
+def compute_great_circle_distances(
+    departure_coords: np.ndarray,
+    arrival_coords: np.ndarray,
+) -> np.ndarray:
+    """Compute the geodesic distances between many pairs of coordinates at once.
+
+    Args:
+        departure_coords: Departure coordinates as (longitude, latitude),
+            shape (n, 2).
+        arrival_coords: Arrival coordinates as (longitude, latitude),
+            shape (n, 2).
+
+    Returns:
+        The geodesic distances in kilometers, shape (n,).
+
+    """
+    _, _, distances = GEOD.inv(
+        departure_coords[:, 0],
+        departure_coords[:, 1],
+        arrival_coords[:, 0],
+        arrival_coords[:, 1],
+    )
+    return m_to_km(distances)
 
 
 def get_plane_emission_factors(route_length: float):
-    if route_length < 1000:
+    if route_length < SHORT_HAUL_MAX_DISTANCE:
         return EF_PLANE_SHORT
-    if route_length < 3500:
+    if route_length < MEDIUM_HAUL_MAX_DISTANCE:
         return EF_PLANE_MEDIUM
     return EF_PLANE_LONG
 
 
+def select_plane_emission_factor(
+    route_lengths: np.ndarray,
+    factor: str,
+) -> np.ndarray:
+    """Vectorized get_plane_emission_factors, for one of the emission factors.
+
+    Args:
+        route_lengths: Flight distances in kilometers.
+        factor: Name of the emission factor (see PlaneEmissionFactors).
+
+    Returns:
+        The emission factor of each flight.
+
+    """
+    return np.select(
+        [
+            route_lengths < SHORT_HAUL_MAX_DISTANCE,
+            route_lengths < MEDIUM_HAUL_MAX_DISTANCE,
+        ],
+        [
+            getattr(EF_PLANE_SHORT, factor),
+            getattr(EF_PLANE_MEDIUM, factor),
+        ],
+        default=getattr(EF_PLANE_LONG, factor),
+    )
+
+
 def compute_plane_trip(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
     trip_type: TripType,
+    precomputed_route_length_km: float | None = None,
 ) -> TripStepResult:
     """Compute a plane trip between two geographic coordinates.
 
@@ -170,6 +294,8 @@ def compute_plane_trip(
         departure_coords: Departure coordinates as (longitude, latitude).
         arrival_coords: Arrival coordinates as (longitude, latitude).
         trip_type: Type of trip associated with the route geometry.
+        precomputed_route_length_km: Optional precomputed geodesic distance
+            in kilometers, the route geometry is then not computed.
 
     Returns:
         A TripStepResult containing:
@@ -178,11 +304,39 @@ def compute_plane_trip(
             - great-circle route geometry
 
     """
-    plane_geometry, route_length = compute_great_circle_route(
-        departure_coords,
-        arrival_coords,
+    if precomputed_route_length_km is not None:
+        route_length = precomputed_route_length_km
+        geometries = []
+    else:
+        plane_geometry, route_length = compute_great_circle_route(
+            departure_coords,
+            arrival_coords,
+        )
+        geometries = [
+            TripStepGeometry(
+                coordinates=[[list(coord) for coord in plane_geometry.coords]],
+                transport_means="Flight",
+                length=route_length,
+                country_label=None,
+                trip_type=trip_type,
+            ),
+        ]
+
+    return TripStepResult(
+        step_data=compute_plane_step_data(route_length),
+        geometries=geometries,
     )
 
+
+def compute_plane_step_data(route_length: float) -> PlaneStepData:
+    """Compute the emissions of a plane trip from its geodesic distance.
+
+    See compute_plane_trip.
+
+    Args:
+        route_length: Geodesic distance in kilometers, without detour.
+
+    """
     emissions_factors = get_plane_emission_factors(route_length)
     co2_ef = emissions_factors.combustion + emissions_factors.upstream
     non_co2_ef = emissions_factors.combustion * CONTRAILS_COEFF
@@ -190,7 +344,7 @@ def compute_plane_trip(
     # Apply a detour coefficient to approximate real flight paths.
     route_length_with_detour = route_length * DETOUR_COEFF
 
-    step_data = PlaneStepData(
+    return PlaneStepData(
         transport="plane",
         emissions=[
             EmissionPart(
@@ -214,15 +368,69 @@ def compute_plane_trip(
         holding=HOLD,
     )
 
-    return TripStepResult(
-        step_data=step_data,
-        geometries=[
-            TripStepGeometry(
-                coordinates=[[list(coord) for coord in plane_geometry.coords]],
-                transport_means="Flight",
-                length=route_length,
-                country_label=None,
-                trip_type=trip_type,
-            ),
-        ],
+
+@dataclass
+class PlaneEmissionsBatch:
+    """Emissions of a batch of flights, as arrays with one value per flight."""
+
+    path_length: np.ndarray
+    """Geodesic distances, without detour. In km."""
+    kerosene: np.ndarray
+    """Emissions of the kerosene, including upstream and holding. In kgCO2e."""
+    contrails: np.ndarray
+    """Non-CO2 emissions. In kgCO2e."""
+    geometries: list[LineString] | None = None
+    """Great-circle routes, only computed on request."""
+
+    @property
+    def kg_co2_eq(self) -> np.ndarray:
+        """Total emissions of each flight. In kgCO2e."""
+        return self.kerosene + self.contrails
+
+
+def compute_plane_emissions_batch(
+    departure_coords: np.ndarray,
+    arrival_coords: np.ndarray,
+    *,
+    with_geometries: bool = False,
+) -> PlaneEmissionsBatch:
+    """Compute the emissions of many flights at once.
+
+    Emissions are computed as in compute_plane_trip, with array operations
+    instead of one call per flight. Values are not rounded.
+
+    Args:
+        departure_coords: Departure coordinates as (longitude, latitude),
+            shape (n, 2).
+        arrival_coords: Arrival coordinates as (longitude, latitude),
+            shape (n, 2).
+        with_geometries: Whether to compute the great-circle routes, which
+            is much slower than computing the emissions.
+
+    Returns:
+        The emissions of each flight.
+
+    """
+    departure_coords = np.asarray(departure_coords, dtype=float).reshape(-1, 2)
+    arrival_coords = np.asarray(arrival_coords, dtype=float).reshape(-1, 2)
+
+    route_lengths = compute_great_circle_distances(departure_coords, arrival_coords)
+
+    combustion = select_plane_emission_factor(route_lengths, "combustion")
+    upstream = select_plane_emission_factor(route_lengths, "upstream")
+
+    route_lengths_with_detour = route_lengths * DETOUR_COEFF
+
+    geometries = None
+    if with_geometries:
+        geometries = [
+            compute_great_circle_route(departure, arrival)[0]
+            for departure, arrival in zip(departure_coords, arrival_coords)
+        ]
+
+    return PlaneEmissionsBatch(
+        path_length=route_lengths,
+        kerosene=route_lengths_with_detour * (combustion + upstream) + HOLD,
+        contrails=route_lengths_with_detour * combustion * CONTRAILS_COEFF,
+        geometries=geometries,
     )
@@ -15,18 +15,24 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 from http import HTTPStatus
 import logging
+from typing import NoReturn
 
+import httpx
 import requests
-from cachetools import LRUCache
 from shapely.geometry import LineString
 
+import geo_railway_index
 from geo_split_path_by_country import split_path_by_country
 from geo_validate_geometry import validate_geometry
+import http_client
+from memory_cache import MemoryCache
 from models import (
     CountrySplitConfig,
     EmissionPart,
+    ProviderUnavailableError,
     RouteNotFoundError,
     RouteResult,
     TrainStepData,
@@ -34,6 +40,8 @@ from models import (
     TripType,
 )
 from parameters import train_intensity
+from route_cache import cached_route
+from single_flight import SingleFlight
 from utils import m_to_km
 
 
@@ -57,7 +65,13 @@ TRAIN_COUNTRY_SPLIT_CONFIG = CountrySplitConfig(
 SEARCH_PERIMETERS_KM = [5, 20]
 
 
-cache = LRUCache(maxsize=1000)
+cache: MemoryCache[tuple[float, float], tuple[float, float]] = MemoryCache(
+    "railway_point",
+    maxsize=1000,
+)
+"""Railway points found near rounded coordinates (see cache_key)."""
+
+railway_point_flights = SingleFlight("railway_point")
 
 
 def cache_key(coords):
@@ -65,7 +79,75 @@ def cache_key(coords):
     return round(lon, 3), round(lat, 3)
 
 
-def find_nearest_railway_point(
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+
+OVERPASS_HEADERS = {
+    "Content-Type": "text/plain",
+    "User-Agent": "transport-backend/1.0",
+}
+
+
+def build_overpass_railway_query(
+    coordinates: tuple[float, float],
+    search_radius_km: float,
+) -> str:
+    """Build the Overpass query of the railways around coordinates."""
+    search_perimeter_m = int(search_radius_km * 1000)
+    lon, lat = coordinates
+
+    return f"""
+                    [out:json][timeout:60];
+                    (
+                        way(around:{search_perimeter_m},{lat},{lon})["railway"="rail"];
+                    );
+                    out geom;
+                    """
+
+
+def parse_overpass_railway_response(
+    response: requests.Response | httpx.Response,
+    search_radius_km: float,
+) -> tuple[float, float] | None:
+    """Parse the railway point of an Overpass response.
+
+    Returns:
+        Coordinates of the railway point as (longitude, latitude), or None if
+        the request failed or no railway geometry was found.
+
+    Raises:
+        ProviderUnavailableError:
+            If Overpass is overloaded or rate limited.
+
+    """
+    if response.status_code != HTTPStatus.OK:
+        status_code = response.status_code
+        if status_code in {504, 429}:
+            raise ProviderUnavailableError(
+                "Overpass is temporarily overloaded"
+                if status_code == 504
+                else "Overpass rate limit reached"
+            )
+
+        logger.warning(
+            "Overpass request failed (%s): %s",
+            response.status_code,
+            response.text,
+        )
+        return None
+
+    response_json = response.json()
+    if not response_json["elements"]:
+        logger.info(
+            "No railway station found within %s km",
+            search_radius_km,
+        )
+        return None
+
+    new_point = response_json["elements"][0]["geometry"][0]
+    return new_point["lon"], new_point["lat"]
+
+
+def find_nearest_railway_point_overpass(
     coordinates: tuple[float, float],
 ) -> tuple[float, float] | None:
     """Find a nearby railway point using the Overpass API.
@@ -75,12 +157,125 @@ def find_nearest_railway_point(
     railway geometry found within the search perimeter is used as a nearby
     railway point.
 
+    The search radius is progressively increased until a nearby railway point
+    is found or all search perimeters are exhausted.
+
+    Args:
+        coordinates: Coordinates as (longitude, latitude).
+
+    Returns:
+        Coordinates of a nearby railway point as (longitude, latitude),
+        or None if no railway geometry could be found.
+
+    Raises:
+        ProviderUnavailableError:
+            If Overpass is unreachable, overloaded or rate limited.
+
+    """
+    for search_radius_km in SEARCH_PERIMETERS_KM:
+        logger.info("Request nearest railway point from Overpass")
+
+        try:
+            response = http_client.post(
+                "overpass",
+                OVERPASS_URL,
+                headers=OVERPASS_HEADERS,
+                data=build_overpass_railway_query(coordinates, search_radius_km),
+            )
+        except requests.RequestException as e:
+            raise ProviderUnavailableError("Overpass is unreachable") from e
+
+        new_point = parse_overpass_railway_response(response, search_radius_km)
+        if new_point is not None:
+            return new_point
+
+    return None
+
+
+async def find_nearest_railway_point_overpass_async(
+    coordinates: tuple[float, float],
+) -> tuple[float, float] | None:
+    """Find a nearby railway point using the Overpass API without blocking the event loop.
+
+    See find_nearest_railway_point_overpass.
+
+    """
+    for search_radius_km in SEARCH_PERIMETERS_KM:
+        logger.info("Request nearest railway point from Overpass")
+
+        try:
+            response = await http_client.post_async(
+                "overpass",
+                OVERPASS_URL,
+                headers=OVERPASS_HEADERS,
+                data=build_overpass_railway_query(coordinates, search_radius_km),
+            )
+        except httpx.TransportError as e:
+            raise ProviderUnavailableError("Overpass is unreachable") from e
+
+        new_point = parse_overpass_railway_response(response, search_radius_km)
+        if new_point is not None:
+            return new_point
+
+    return None
+
+
+def find_nearest_railway_point_local(
+    coordinates: tuple[float, float],
+) -> tuple[float, float] | None:
+    """Find the nearest railway point using the local railway index.
+
+    See geo_railway_index.find_nearest_railway_point, the railway point is
+    searched within the largest search perimeter.
+
+    """
+    return geo_railway_index.find_nearest_railway_point(
+        coordinates,
+        max_distance_km=max(SEARCH_PERIMETERS_KM),
+    )
+
+
+async def find_nearest_railway_point_local_async(
+    coordinates: tuple[float, float],
+) -> tuple[float, float] | None:
+    """Find the nearest railway point using the local railway index without blocking the event loop.
+
+    See find_nearest_railway_point_local, the index is searched in a separate
+    thread since it is loaded from disk on first use.
+
+    """
+    return await asyncio.to_thread(find_nearest_railway_point_local, coordinates)
+
+
+RAILWAY_POINT_PROVIDERS = [
+    find_nearest_railway_point_local,
+    find_nearest_railway_point_overpass,
+]
+"""Functions used in turn to find nearby railway points.
+
+A provider raises ProviderUnavailableError when it cannot answer, the next
+provider is then used.
+"""
+
+RAILWAY_POINT_PROVIDERS_ASYNC = [
+    find_nearest_railway_point_local_async,
+    find_nearest_railway_point_overpass_async,
+]
+"""Coroutine functions used in turn to find nearby railway points, see
+RAILWAY_POINT_PROVIDERS."""
+
+
+def find_nearest_railway_point(
+    coordinates: tuple[float, float],
+) -> tuple[float, float] | None:
+    """Find a nearby railway point.
+
     Railway geometries are preferred over railway stations because railway
     station tagging is heterogeneous across OpenStreetMap and may include
     subway, tram, or light rail stations that are not routable by Signal.
 
-    The search radius is progressively increased until a nearby railway point
-    is found or all search perimeters are exhausted.
+    The railway point is searched with the first available provider of
+    RAILWAY_POINT_PROVIDERS: the local railway index, then the Overpass API.
 
     The results are also cached since they rarely change, thus reducing load
     on the public Overpass API.
@@ -99,58 +294,74 @@ def find_nearest_railway_point(
     """
     key = cache_key(coordinates)
 
-    if key in cache:
-        return cache[key]
+    railway_point = cache.get(key)
+    if railway_point is not None:
+        return railway_point
 
-    for search_radius_km in SEARCH_PERIMETERS_KM:
-        logger.info("Request nearest railway point from Overpass")
+    # Concurrent searches around the same point send a single request
+    return railway_point_flights.run(key, search_nearest_railway_point, coordinates)
 
-        search_perimeter_m = int(search_radius_km * 1000)
-        lon, lat = coordinates
-
-        response = requests.post(
-            "http://overpass-api.de/api/interpreter",
-            headers={
-                "Content-Type": "text/plain",
-                "User-Agent": "transport-backend/1.0",
-            },
-            data=f"""
-                [out:json][timeout:60];
-                (
-                    way(around:{search_perimeter_m},{lat},{lon})["railway"="rail"];
-                );
-                out geom;
-                """,
-        )
 
-        if response.status_code != HTTPStatus.OK:
-            status_code = response.status_code
-            if status_code in {504, 429}:
-                logger.warning(
-                    "Overpass is temporarily overloaded"
-                    if status_code == 504
-                    else "Overpass rate limit reached"
-                )
-                return None
-
-            logger.warning(
-                "Overpass request failed (%s): %s",
-                response.status_code,
-                response.text,
-            )
+def search_nearest_railway_point(
+    coordinates: tuple[float, float],
+) -> tuple[float, float] | None:
+    """Search a nearby railway point with the providers, and cache it.
+
+    See find_nearest_railway_point.
+
+    """
+    for provider in RAILWAY_POINT_PROVIDERS:
+        try:
+            new_coordinates = provider(coordinates)
+        except ProviderUnavailableError as e:
+            logger.warning("%s is unavailable: %s", provider.__name__, e)
             continue
 
-        response_json = response.json()
-        if not response_json["elements"]:
-            logger.info(
-                "No railway station found within %s km",
-                search_radius_km,
-            )
+        if new_coordinates is not None:
+            cache.set(cache_key(coordinates), new_coordinates)
+        return new_coordinates
+
+    return None
+
+
+async def find_nearest_railway_point_async(
+    coordinates: tuple[float, float],
+) -> tuple[float, float] | None:
+    """Find a nearby railway point without blocking the event loop.
+
+    See find_nearest_railway_point.
+
+    """
+    key = cache_key(coordinates)
+
+    railway_point = cache.get(key)
+    if railway_point is not None:
+        return railway_point
+
+    return await railway_point_flights.run_async(
+        key,
+        search_nearest_railway_point_async,
+        coordinates,
+    )
+
+
+async def search_nearest_railway_point_async(
+    coordinates: tuple[float, float],
+) -> tuple[float, float] | None:
+    """Search a nearby railway point with the providers, and cache it.
+
+    See search_nearest_railway_point.
+
+    """
+    for provider in RAILWAY_POINT_PROVIDERS_ASYNC:
+        try:
+            new_coordinates = await provider(coordinates)
+        except ProviderUnavailableError as e:
+            logger.warning("%s is unavailable: %s", provider.__name__, e)
             continue
 
-        new_point = response_json["elements"][0]["geometry"][0]
-        new_coordinates = new_point["lon"], new_point["lat"]
-        cache[key] = new_coordinates
+        if new_coordinates is not None:
+            cache.set(cache_key(coordinates), new_coordinates)
         return new_coordinates
 
     return None
@@ -189,38 +400,48 @@ def retry_train_routing_with_nearby_points(
     )
 
 
-def request_train_route(
+async def retry_train_routing_with_nearby_points_async(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
 ) -> RouteResult | None:
-    """Request a train route between two coordinates.
+    """Retry train routing using nearby railway points without blocking the event loop.
 
-    The route geometry and path length are retrieved from the Signal
-    railway routing API.
+    See retry_train_routing_with_nearby_points.
 
-    Args:
-        departure_coords: Departure coordinates as (longitude, latitude).
-        arrival_coords: Arrival coordinates as (longitude, latitude).
+    """
+    new_departure_coords = await find_nearest_railway_point_async(departure_coords)
+    if new_departure_coords is None:
+        return None
 
-    Returns:
-        A RouteResult containing the route geometry and path length
-        if routing succeeds, otherwise None.
+    new_arrival_coords = await find_nearest_railway_point_async(arrival_coords)
+    if new_arrival_coords is None:
+        return None
 
-    """
-    logger.info("Request road from Signal")
+    return await request_train_route_async(
+        new_departure_coords,
+        new_arrival_coords,
+    )
 
+
+def build_train_route_url(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> str:
     departure_lon, departure_lat = departure_coords
     arrival_lon, arrival_lat = arrival_coords
 
-    url = (
+    return (
         "https://signal.eu.org/osm/eu/route/v1/train/"
         f"{departure_lon},{departure_lat};"
         f"{arrival_lon},{arrival_lat}"
         "?overview=simplified&geometries=geojson"
     )
 
-    response = requests.get(url)
 
+def parse_train_route_response(
+    response: requests.Response | httpx.Response,
+) -> RouteResult | None:
+    """Read the train route found by Signal, or None if no route was found."""
     if response.status_code != HTTPStatus.OK:
         logger.warning(
             "Signal request failed with status code: %s",
@@ -240,16 +461,138 @@ def request_train_route(
     return RouteResult(geometry=geometry, path_length_km=path_length_km)
 
 
+@cached_route("signal")
+def request_train_route(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> RouteResult | None:
+    """Request a train route between two coordinates.
+
+    The route geometry and path length are retrieved from the Signal
+    railway routing API.
+
+    Args:
+        departure_coords: Departure coordinates as (longitude, latitude).
+        arrival_coords: Arrival coordinates as (longitude, latitude).
+
+    Returns:
+        A RouteResult containing the route geometry and path length
+        if routing succeeds, otherwise None.
+
+    """
+    logger.info("Request road from Signal")
+
+    try:
+        response = http_client.get(
+            "signal",
+            build_train_route_url(departure_coords, arrival_coords),
+        )
+    except requests.RequestException:
+        logger.warning("Signal is unreachable")
+        return None
+
+    return parse_train_route_response(response)
+
+
+@cached_route("signal")
+async def request_train_route_async(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> RouteResult | None:
+    """Request a train route without blocking the event loop.
+
+    See request_train_route.
+
+    """
+    logger.info("Request road from Signal")
+
+    try:
+        response = await http_client.get_async(
+            "signal",
+            build_train_route_url(departure_coords, arrival_coords),
+        )
+    except httpx.TransportError:
+        logger.warning("Signal is unreachable")
+        return None
+
+    return parse_train_route_response(response)
+
+
+def raise_train_route_not_found(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> NoReturn:
+    not_found_message = (
+        f"No train route found between {departure_coords} and {arrival_coords}"
+    )
+    logger.warning(not_found_message)
+    raise RouteNotFoundError(not_found_message)
+
+
+def find_train_route(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> RouteResult:
+    """Find a train route between two coordinates.
+
+    A train route is first requested directly from the railway routing API.
+    If routing fails, nearby railway points are searched around the departure
+    and arrival coordinates and used to retry the routing request.
+
+    Raises:
+        RouteNotFoundError:
+            If no train route could be found.
+
+    """
+    result = request_train_route(departure_coords, arrival_coords)
+
+    if result is None:
+        result = retry_train_routing_with_nearby_points(
+            departure_coords,
+            arrival_coords,
+        )
+
+    if result is None:
+        raise_train_route_not_found(departure_coords, arrival_coords)
+
+    return result
+
+
+async def find_train_route_async(
+    departure_coords: tuple[float, float],
+    arrival_coords: tuple[float, float],
+) -> RouteResult:
+    """Find a train route without blocking the event loop.
+
+    See find_train_route.
+
+    """
+    result = await request_train_route_async(departure_coords, arrival_coords)
+
+    if result is None:
+        result = await retry_train_routing_with_nearby_points_async(
+            departure_coords,
+            arrival_coords,
+        )
+
+    if result is None:
+        raise_train_route_not_found(departure_coords, arrival_coords)
+
+    return result
+
+
 def compute_train_trip(
     departure_coords: tuple[float, float],
     arrival_coords: tuple[float, float],
     trip_type: TripType,
+    precomputed_route: RouteResult | None = None,
 ) -> TripStepResult:
     """Compute a train trip route and associated emissions.
 
     A train route is first requested directly from the railway routing API.
     If routing fails, nearby railway points are searched around the departure
-    and arrival coordinates and used to retry the routing request.
+    and arrival coordinates and used to retry the routing request (see
+    find_train_route).
 
     Once a valid route is obtained, the geometry is split by country in order
     to apply country-specific train emission factors to each segment of the trip.
@@ -259,6 +602,8 @@ def compute_train_trip(
         departure_coords: Departure coordinates as (longitude, latitude).
         arrival_coords: Arrival coordinates as (longitude, latitude).
         trip_type: Type of trip associated with the computed geometries.
+        precomputed_route: Optional train route already found between the
+            coordinates.
 
     Returns:
         A TripStepResult containing:
@@ -271,20 +616,7 @@ def compute_train_trip(
             If no train route could be found.
 
     """
-    result = request_train_route(departure_coords, arrival_coords)
-
-    if result is None:
-        result = retry_train_routing_with_nearby_points(
-            departure_coords,
-            arrival_coords,
-        )
-
-    if result is None:
-        not_found_message = (
-            f"No train route found between {departure_coords} and {arrival_coords}"
-        )
-        logger.warning(not_found_message)
-        raise RouteNotFoundError(not_found_message)
+    result = precomputed_route or find_train_route(departure_coords, arrival_coords)
 
     validate_geometry(departure_coords, arrival_coords, result.geometry)
 
@@ -15,17 +15,29 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from collections.abc import Callable, Iterator
+from concurrent.futures import as_completed, Future
 import logging
-from typing import Literal
+import time
+from typing import Any, Literal
 
+from metrics import labelled_transport_mean, transport_mean_context
 from models import (
     ApiPayload,
+    RouteResult,
     StepData,
     Trip,
     TripResult,
+    TripStep,
     TripStepGeometry,
+    TripStepResult,
 )
 from parameters import PLANE_MIN_DISTANCE
+from task_pool import (
+    compute_deadline,
+    submit_task,
+    wait_for_tasks,
+)
 from transport_bicycle import compute_bicycle_trip
 from transport_car import (
     compute_bus_trip,
@@ -42,6 +54,10 @@ from utils import compute_distance_between_2_points
 logger = logging.getLogger(__name__)
 
 
+STEP_ERROR_TRANSPORT_MEANS = {"train", "bus", "car", "hitchHiking", "ecar"}
+"""Transport means whose step failures are reported with a step error message."""
+
+
 def compute_emissions(payload: ApiPayload):
     """Compute emissions and geometries for the requested trips.
 
@@ -63,17 +79,35 @@ def compute_emissions(payload: ApiPayload):
             - geometries: Route geometries for map rendering.
 
     """
-    main_trip, geometries = compute_custom_trip_emissions(
-        "MAIN_TRIP",
-        payload.main_trip,
+    deadline = compute_deadline()
+
+    # Steps of both trips are computed concurrently
+    main_trip_steps = submit_trip_steps("MAIN_TRIP", payload.main_trip)
+    second_trip_steps = (
+        submit_trip_steps("SECOND_TRIP", payload.second_trip)
+        if payload.second_trip
+        else []
     )
 
+    try:
+        main_trip, geometries = gather_trip_steps(
+            "MAIN_TRIP",
+            main_trip_steps,
+            deadline,
+        )
+    except Exception:
+        # The second trip is not returned without the main trip
+        for future in second_trip_steps:
+            future.cancel()
+        raise
+
     trips = [main_trip]
 
     if payload.second_trip:
-        second_trip_result, second_trip_geometries = compute_custom_trip_emissions(
+        second_trip_result, second_trip_geometries = gather_trip_steps(
             "SECOND_TRIP",
-            payload.second_trip,
+            second_trip_steps,
+            deadline,
         )
         trips.append(second_trip_result)
         geometries.extend(second_trip_geometries)
@@ -82,6 +116,7 @@ def compute_emissions(payload: ApiPayload):
         direct_trips, direct_trips_geometries = compute_direct_trips_emissions(
             payload.main_trip,
             main_trip.steps[0].path_length,
+            deadline,
         )
         trips.extend(direct_trips)
         geometries.extend(direct_trips_geometries)
@@ -92,6 +127,137 @@ def compute_emissions(payload: ApiPayload):
     }
 
 
+def stream_emissions(payload: ApiPayload) -> Iterator[dict[str, Any]]:
+    """Compute emissions and geometries, yielding each trip as soon as it is ready.
+
+    The same trips as compute_emissions are computed, but they are yielded in
+    completion order so that the fastest ones can be displayed first.
+
+    Args:
+        payload: Validated API payload containing the trip definitions.
+
+    Yields:
+        Events, as dictionaries with an "event" key:
+            - "trips": computed trips with their geometries ("trips" and
+              "geometries" keys, as in compute_emissions).
+            - "error": a requested trip cannot be computed ("error" key), no
+              event follows.
+            - "summary": last event, with the names of the computed trips
+              ("trips" key), the number of alternatives skipped at the
+              deadline ("skipped" key) and the computation time ("duration"
+              key, in seconds).
+
+    """
+    start = time.monotonic()
+    deadline = compute_deadline()
+
+    # Steps of both trips are computed concurrently
+    trips_steps = {"MAIN_TRIP": submit_trip_steps("MAIN_TRIP", payload.main_trip)}
+    if payload.second_trip:
+        trips_steps["SECOND_TRIP"] = submit_trip_steps(
+            "SECOND_TRIP",
+            payload.second_trip,
+        )
+
+    trip_names: list[str] = []
+    main_trip_path_length = None
+
+    try:
+        for trip, geometries in gather_trips_as_completed(trips_steps, deadline):
+            if trip.name == "MAIN_TRIP":
+                main_trip_path_length = trip.steps[0].path_length
+            trip_names.append(trip.name)
+            yield {"event": "trips", "trips": [trip], "geometries": geometries}
+    except ValueError as err:
+        yield {"event": "error", "error": str(err)}
+        return
+
+    skipped = 0
+
+    if not payload.second_trip and len(payload.main_trip.steps) == 1:
+        futures = submit_direct_trips(payload.main_trip, main_trip_path_length)
+        try:
+            for future in as_completed(
+                futures,
+                timeout=max(deadline - time.monotonic(), 0),
+            ):
+                direct_trips, direct_trips_geometries = future.result()
+                if direct_trips:
+                    trip_names.extend(trip.name for trip in direct_trips)
+                    yield {
+                        "event": "trips",
+                        "trips": direct_trips,
+                        "geometries": direct_trips_geometries,
+                    }
+        except TimeoutError:
+            skipped = sum(not future.done() for future in futures)
+            logger.warning("%s tasks not done before the request deadline", skipped)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    yield {
+        "event": "summary",
+        "trips": trip_names,
+        "skipped": skipped,
+        "duration": round(time.monotonic() - start, 3),
+    }
+
+
+def gather_trips_as_completed(
+    trips_steps: dict[str, list[Future[TripStepResult]]],
+    deadline: float,
+) -> Iterator[tuple[TripResult, list[TripStepGeometry]]]:
+    """Aggregate the trips submitted with submit_trip_steps as they are completed.
+
+    Args:
+        trips_steps: Tasks computing the steps of each trip, by trip name.
+        deadline: Deadline of the request, see task_pool.compute_deadline.
+
+    Yields:
+        Each trip with its geometries, as soon as all its steps are computed.
+
+    Raises:
+        ValueError:
+            If a route cannot be computed for one of the trip steps, or if a
+            step is not computed before the deadline (see gather_trip_steps).
+
+    """
+    step_trips = {
+        future: trip_name
+        for trip_name, futures in trips_steps.items()
+        for future in futures
+    }
+    remaining_steps = {
+        trip_name: len(futures) for trip_name, futures in trips_steps.items()
+    }
+
+    try:
+        for future in as_completed(
+            step_trips,
+            timeout=max(deadline - time.monotonic(), 0),
+        ):
+            trip_name = step_trips[future]
+            remaining_steps[trip_name] -= 1
+
+            # A failing step fails its trip without waiting for its other steps
+            if remaining_steps[trip_name] and future.exception() is None:
+                continue
+
+            yield gather_trip_steps(trip_name, trips_steps[trip_name], deadline)
+
+    except TimeoutError:
+        # Raises the error of the first step not computed before the deadline
+        for trip_name, futures in trips_steps.items():
+            if remaining_steps[trip_name]:
+                gather_trip_steps(trip_name, futures, deadline)
+        raise
+
+    finally:
+        for future in step_trips:
+            future.cancel()
+
+
 def compute_custom_trip_emissions(
     trip_name: Literal["MAIN_TRIP", "SECOND_TRIP"],
     trip: Trip,
@@ -99,7 +265,8 @@ def compute_custom_trip_emissions(
     """Compute emissions and geometries for a custom trip.
 
     The function computes emissions step by step and aggregates both
-    emissions data and route geometries.
+    emissions data and route geometries. Steps are computed concurrently
+    in the task pool.
 
     Args:
         trip_name: Trip identifier ("MAIN_TRIP" or "SECOND_TRIP").
@@ -114,24 +281,126 @@ def compute_custom_trip_emissions(
         ValueError:
             If a route cannot be computed for one of the trip steps.
 
+    """
+    return gather_trip_steps(
+        trip_name,
+        submit_trip_steps(trip_name, trip),
+        compute_deadline(),
+    )
+
+
+def submit_trip_steps(
+    trip_name: Literal["MAIN_TRIP", "SECOND_TRIP"],
+    trip: Trip,
+) -> list[Future[TripStepResult]]:
+    """Submit the computation of each step of a trip to the task pool.
+
+    Steps are independent: the departure of a step is the arrival of the
+    previous one.
+
+    Returns:
+        The tasks computing each step, in the order of the steps.
+
+    """
+    departures = [trip.departure, *trip.steps[:-1]]
+
+    return [
+        submit_task(
+            compute_step_emissions,
+            trip_name,
+            trip,
+            idx,
+            (departure.lon, departure.lat),
+            arrival,
+        )
+        for idx, (departure, arrival) in enumerate(zip(departures, trip.steps))
+    ]
+
+
+def gather_trip_steps(
+    trip_name: Literal["MAIN_TRIP", "SECOND_TRIP"],
+    futures: list[Future[TripStepResult]],
+    deadline: float,
+) -> tuple[TripResult, list[TripStepGeometry]]:
+    """Aggregate the steps of a trip submitted with submit_trip_steps.
+
+    Steps are gathered by index, so the error raised is the one of the first
+    failing step, as when steps were computed one after another.
+
+    Raises:
+        ValueError:
+            If a route cannot be computed for one of the trip steps, or if a
+            step is not computed before the deadline.
+
     """
     emissions_data: list[StepData] = []
     geometries: list[TripStepGeometry] = []
 
-    departure_coordinates = (trip.departure.lon, trip.departure.lat)
+    try:
+        for idx, future in enumerate(futures):
+            try:
+                results = future.result(timeout=max(deadline - time.monotonic(), 0))
+            except TimeoutError as err:
+                logger.warning("step n°%s not computed before the deadline", idx + 1)
+                raise ValueError(
+                    f"step n°{idx + 1} took too long to compute, please try again later."
+                ) from err
+
+            emissions_data.append(results.step_data)
+            geometries.extend(results.geometries)
+    finally:
+        for future in futures:
+            future.cancel()
+
+    return TripResult(name=trip_name, steps=emissions_data), geometries
+
+
+def build_step_error_message(idx: int, transport_mean: str) -> str:
+    return f"step n°{idx + 1} failed with {transport_mean}, please change mean of transport or locations."
+
+
+def compute_step_emissions(
+    trip_name: Literal["MAIN_TRIP", "SECOND_TRIP"],
+    trip: Trip,
+    idx: int,
+    departure_coordinates: tuple[float, float],
+    arrival: TripStep,
+    precomputed_route: RouteResult | None = None,
+) -> TripStepResult:
+    """Compute emissions and geometries for a step of a custom trip.
+
+    Args:
+        trip_name: Trip identifier ("MAIN_TRIP" or "SECOND_TRIP").
+        trip: Trip containing the step, logged when the step fails.
+        idx: Index of the step in the trip.
+        departure_coordinates: Departure coordinates of the step as
+            (longitude, latitude).
+        arrival: Trip step.
+        precomputed_route: Optional route already found for the step, for
+            transport means using a routing provider.
+
+    Returns:
+        The step result, with its emissions and geometries.
+
+    Raises:
+        ValueError:
+            If a route cannot be computed for the step.
 
-    for idx, arrival in enumerate(trip.steps):
-        arrival_coordinates = (arrival.lon, arrival.lat)
-        transport_mean = arrival.transport_mean
+    """
+    arrival_coordinates = (arrival.lon, arrival.lat)
+    transport_mean = arrival.transport_mean
 
-        error_message = f"step n°{idx + 1} failed with {transport_mean}, please change mean of transport or locations."
+    error_message = build_step_error_message(idx, transport_mean)
 
+    # The metrics measured while computing the step are labelled with its transport mean
+    with transport_mean_context(transport_mean):
         if transport_mean == "train":
             try:
                 results = compute_train_trip(
                     departure_coordinates,
                     arrival_coordinates,
                     trip_name,
+                    precomputed_route=precomputed_route,
                 )
             except Exception as err:
                 logger.warning("step n°%s failed, initial payload: %s", idx + 1, trip)
@@ -143,6 +412,7 @@ def compute_custom_trip_emissions(
                     departure_coordinates,
                     arrival_coordinates,
                     trip_name,
+                    precomputed_route=precomputed_route,
                 )
             except Exception as err:
                 logger.warning("step n°%s failed, initial payload: %s", idx + 1, trip)
@@ -155,6 +425,7 @@ def compute_custom_trip_emissions(
                     arrival_coordinates,
                     trip_name,
                     passengers_nb=arrival.passengers_nb,
+                    precomputed_route=precomputed_route,
                 )
             except Exception as err:
                 logger.warning("step n°%s failed, initial payload: %s", idx + 1, trip)
@@ -166,6 +437,7 @@ def compute_custom_trip_emissions(
                     departure_coordinates,
                     arrival_coordinates,
                     trip_name,
+                    precomputed_route=precomputed_route,
                 )
             except Exception as err:
                 logger.warning("step n°%s failed, initial payload: %s", idx + 1, trip)
@@ -178,6 +450,7 @@ def compute_custom_trip_emissions(
                     arrival_coordinates,
                     trip_name,
                     passengers_nb=arrival.passengers_nb,
+                    precomputed_route=precomputed_route,
                 )
             except Exception as err:
                 logger.warning("step n°%s failed, initial payload: %s", idx + 1, trip)
@@ -188,6 +461,7 @@ def compute_custom_trip_emissions(
                 departure_coordinates,
                 arrival_coordinates,
                 trip_name,
+                precomputed_route=precomputed_route,
             )
 
         elif transport_mean == "plane":
@@ -216,17 +490,17 @@ def compute_custom_trip_emissions(
             logger.warning("Transport mean %s not handled", transport_mean)
             raise ValueError(error_message)
 
-        emissions_data.append(results.step_data)
-        geometries.extend(results.geometries)
-        departure_coordinates = arrival_coordinates
+    return results
 
-    return TripResult(name=trip_name, steps=emissions_data), geometries
+
+DirectTripsResult = tuple[list[TripResult], list[TripStepGeometry]]
 
 
 def compute_direct_trips_emissions(
     requested_trip: Trip,
     main_trip_path_length: float,
-) -> tuple[list[TripResult], list[TripStepGeometry]]:
+    deadline: float,
+) -> DirectTripsResult:
     """Compute alternative direct trips for a simple trip.
 
     Given a trip containing a single transport step, this function computes
@@ -243,24 +517,76 @@ def compute_direct_trips_emissions(
     Road-based transport modes may reuse an already computed route length to
     avoid redundant routing computations.
 
+    The alternatives are independent, so they are computed concurrently in the
+    task pool. Alternatives not computed before the request deadline are
+    skipped.
+
     Args:
         requested_trip: Trip containing exactly one transport step.
         main_trip_path_length: Path length of the original trip, used when
             reusing an already computed road route.
+        deadline: Deadline of the request, see task_pool.compute_deadline.
 
     Returns:
         A tuple containing:
             - Alternative trip results.
             - Associated route geometries.
 
+    """
+    futures = submit_direct_trips(requested_trip, main_trip_path_length)
+
+    trips: list[TripResult] = []
+    geometries: list[TripStepGeometry] = []
+
+    # Results are gathered in submission order to keep a deterministic output
+    for future in wait_for_tasks(futures, deadline):
+        direct_trips, direct_trips_geometries = future.result()
+        trips.extend(direct_trips)
+        geometries.extend(direct_trips_geometries)
+
+    return trips, geometries
+
+
+def submit_direct_trips(
+    requested_trip: Trip,
+    main_trip_path_length: float,
+) -> list[Future[DirectTripsResult]]:
+    """Submit the computation of the alternative direct trips to the task pool.
+
+    See compute_direct_trips_emissions.
+
+    Returns:
+        The tasks computing each alternative, in the order of the results.
+
+    """
+    return [
+        submit_task(compute_alternative, *args)
+        for compute_alternative, args in list_direct_trips(
+            requested_trip,
+            main_trip_path_length,
+        )
+    ]
+
+
+def list_direct_trips(
+    requested_trip: Trip,
+    main_trip_path_length: float,
+) -> list[tuple[Callable[..., DirectTripsResult], tuple]]:
+    """List the alternative direct trips to compute for a simple trip.
+
+    See compute_direct_trips_emissions.
+
+    Returns:
+        The function computing each alternative with its arguments, in the
+        order of the results.
+
     """
     departure_coordinates = (requested_trip.departure.lon, requested_trip.departure.lat)
     arrival = requested_trip.steps[0]
     arrival_coordinates = (arrival.lon, arrival.lat)
     transport_mean = arrival.transport_mean
 
-    trips: list[TripResult] = []
-    geometries: list[TripStepGeometry] = []
+    direct_trips = []
 
     # Compute plane emissions only for trips longer than 300km
     if transport_mean != "plane":
@@ -269,51 +595,140 @@ def compute_direct_trips_emissions(
             arrival_coordinates,
         )
         if bird_distance > PLANE_MIN_DISTANCE:
-            plane_result = compute_plane_trip(
-                departure_coordinates,
-                arrival_coordinates,
-                "DIRECT_TRIP",
+            direct_trips.append(
+                (
+                    compute_direct_plane_trip,
+                    (departure_coordinates, arrival_coordinates),
+                )
             )
-            trips.append(TripResult(name="PLANE", steps=[plane_result.step_data]))
-            geometries.extend(plane_result.geometries)
 
     # Compute direct alternatives for sea transport modes.
     if transport_mean in {"ferry", "sail"}:
-        if transport_mean != "ferry":
-            ferry_results = compute_ferry_trip(
-                departure_coordinates,
-                arrival_coordinates,
-                "DIRECT_TRIP",
-                precomputed_route_length_km=main_trip_path_length,
-            )
-            if ferry_results is not None:
-                trips.append(TripResult(name="FERRY", steps=[ferry_results.step_data]))
-
-        else:
-            sail_results = compute_sail_trip(
-                departure_coordinates,
-                arrival_coordinates,
-                "DIRECT_TRIP",
-                precomputed_route_length_km=main_trip_path_length,
+        direct_trips.append(
+            (
+                compute_direct_sea_trip,
+                (
+                    departure_coordinates,
+                    arrival_coordinates,
+                    transport_mean,
+                    main_trip_path_length,
+                ),
             )
-            if sail_results is not None:
-                trips.append(TripResult(name="SAIL", steps=[sail_results.step_data]))
-
-        return trips, geometries
+        )
+        return direct_trips
 
     # Compute direct alternatives for land transport modes.
     if transport_mean != "train":
-        try:
-            train_results = compute_train_trip(
+        direct_trips.append(
+            (
+                compute_direct_train_trip,
+                (departure_coordinates, arrival_coordinates),
+            )
+        )
+
+    direct_trips.append(
+        (
+            compute_direct_road_trips,
+            (
                 departure_coordinates,
                 arrival_coordinates,
-                "DIRECT_TRIP",
-            )
-            if train_results is not None:
-                trips.append(TripResult(name="TRAIN", steps=[train_results.step_data]))
-                geometries.extend(train_results.geometries)
-        except Exception:
-            logger.warning("Direct trip by train couldn't be computed")
+                transport_mean,
+                main_trip_path_length,
+            ),
+        )
+    )
+
+    return direct_trips
+
+
+@labelled_transport_mean("plane")
+def compute_direct_plane_trip(
+    departure_coordinates: tuple[float, float],
+    arrival_coordinates: tuple[float, float],
+) -> DirectTripsResult:
+    plane_result = compute_plane_trip(
+        departure_coordinates,
+        arrival_coordinates,
+        "DIRECT_TRIP",
+    )
+    return (
+        [TripResult(name="PLANE", steps=[plane_result.step_data])],
+        plane_result.geometries,
+    )
+
+
+def compute_direct_sea_trip(
+    departure_coordinates: tuple[float, float],
+    arrival_coordinates: tuple[float, float],
+    transport_mean: Literal["ferry", "sail"],
+    main_trip_path_length: float,
+) -> DirectTripsResult:
+    """Compute the sail alternative of a ferry trip, or the ferry alternative of a sail trip."""
+    if transport_mean != "ferry":
+        ferry_results = compute_ferry_trip(
+            departure_coordinates,
+            arrival_coordinates,
+            "DIRECT_TRIP",
+            precomputed_route_length_km=main_trip_path_length,
+        )
+        if ferry_results is not None:
+            return [TripResult(name="FERRY", steps=[ferry_results.step_data])], []
+
+    else:
+        sail_results = compute_sail_trip(
+            departure_coordinates,
+            arrival_coordinates,
+            "DIRECT_TRIP",
+            precomputed_route_length_km=main_trip_path_length,
+        )
+        if sail_results is not None:
+            return [TripResult(name="SAIL", steps=[sail_results.step_data])], []
+
+    return [], []
+
+
+@labelled_transport_mean("train")
+def compute_direct_train_trip(
+    departure_coordinates: tuple[float, float],
+    arrival_coordinates: tuple[float, float],
+    precomputed_route: RouteResult | None = None,
+) -> DirectTripsResult:
+    try:
+        train_results = compute_train_trip(
+            departure_coordinates,
+            arrival_coordinates,
+            "DIRECT_TRIP",
+            precomputed_route=precomputed_route,
+        )
+    except Exception:
+        logger.warning("Direct trip by train couldn't be computed")
+        return [], []
+
+    if train_results is None:
+        return [], []
+
+    return (
+        [TripResult(name="TRAIN", steps=[train_results.step_data])],
+        train_results.geometries,
+    )
+
+
+@labelled_transport_mean("bus")
+def compute_direct_road_trips(
+    departure_coordinates: tuple[float, float],
+    arrival_coordinates: tuple[float, float],
+    transport_mean: str,
+    main_trip_path_length: float,
+    precomputed_route: RouteResult | None = None,
+) -> DirectTripsResult:
+    """Compute the bus and car alternatives, which share the same road route.
+
+    The road route is only requested when the requested trip is not a road
+    trip, unless it is already provided with precomputed_route.
+
+    """
+    trips: list[TripResult] = []
+    geometries: list[TripStepGeometry] = []
 
     # Reuse the already computed road route length when possible
     # to avoid recomputing the same road itinerary multiple times.
@@ -330,6 +745,7 @@ def compute_direct_trips_emissions(
                 arrival_coordinates,
                 "DIRECT_TRIP",
                 precomputed_route_length_km=road_path_length,
+                precomputed_route=precomputed_route,
             )
             trips.append(TripResult(name="BUS", steps=[bus_results.step_data]))
 
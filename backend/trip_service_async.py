@@ -0,0 +1,362 @@
+# Lowtrip, a web interface to compute travel CO2eq for different means of transport worldwide.
+
+# Copyright (C) 2024  Bonnemaizon Xavier, Ni Clara, Gres Paola & Pellas Chiara
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Asyncio variant of trip_service, used by the ASGI app (see asgi.py).
+
+Routes are requested from the routing providers without blocking the event
+loop, so a single process can wait for many routes at the same time. The
+CPU-bound work (country split, maritime routing, emissions) reuses the
+synchronous functions of trip_service, run in the task pool with the routes
+already found.
+"""
+
+import asyncio
+from collections.abc import Callable
+import contextvars
+import functools
+import logging
+from typing import (
+    Literal,
+    ParamSpec,
+    TypeVar,
+)
+
+from metrics import transport_mean_context
+from models import (
+    ApiPayload,
+    RouteResult,
+    StepData,
+    Trip,
+    TripResult,
+    TripStep,
+    TripStepGeometry,
+    TripStepResult,
+)
+from task_pool import get_task_pool, REQUEST_DEADLINE
+from transport_bicycle import find_bicycle_route_async
+from transport_car import find_route_async
+from transport_train import find_train_route_async
+from trip_service import (
+    build_step_error_message,
+    compute_direct_road_trips,
+    compute_direct_train_trip,
+    compute_step_emissions,
+    DirectTripsResult,
+    list_direct_trips,
+    STEP_ERROR_TRANSPORT_MEANS,
+)
+
+
+logger = logging.getLogger(__name__)
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+ROUTE_FINDERS = {
+    "train": find_train_route_async,
+    "bus": find_route_async,
+    "car": find_route_async,
+    "hitchHiking": find_route_async,
+    "ecar": find_route_async,
+    "bicycle": find_bicycle_route_async,
+}
+"""Async route finder of each transport mean using a routing provider."""
+
+ROAD_TRANSPORT_MEANS = {"bus", "car", "ecar", "hitchHiking"}
+
+
+async def run_in_task_pool(
+    function: Callable[P, T],
+    *args: P.args,
+    **kwargs: P.kwargs,
+) -> T:
+    """Run a blocking function in the task pool without blocking the event loop.
+
+    The function runs in a copy of the current context, see task_pool.submit_task.
+
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        get_task_pool(),
+        functools.partial(contextvars.copy_context().run, function, *args, **kwargs),
+    )
+
+
+async def compute_emissions_async(payload: ApiPayload):
+    """Compute emissions and geometries for the requested trips.
+
+    See trip_service.compute_emissions, the results are the same.
+
+    """
+    deadline = asyncio.get_running_loop().time() + REQUEST_DEADLINE
+
+    # Steps of both trips are computed concurrently
+    main_trip_steps = create_trip_steps_tasks("MAIN_TRIP", payload.main_trip)
+    second_trip_steps = (
+        create_trip_steps_tasks("SECOND_TRIP", payload.second_trip)
+        if payload.second_trip
+        else []
+    )
+
+    try:
+        main_trip, geometries = await gather_trip_steps_async(
+            "MAIN_TRIP",
+            main_trip_steps,
+            deadline,
+        )
+    except Exception:
+        for task in second_trip_steps:
+            task.cancel()
+        raise
+
+    trips = [main_trip]
+
+    if payload.second_trip:
+        second_trip_result, second_trip_geometries = await gather_trip_steps_async(
+            "SECOND_TRIP",
+            second_trip_steps,
+            deadline,
+        )
+        trips.append(second_trip_result)
+        geometries.extend(second_trip_geometries)
+
+    elif len(payload.main_trip.steps) == 1:
+        (
+            direct_trips,
+            direct_trips_geometries,
+        ) = await compute_direct_trips_emissions_async(
+            payload.main_trip,
+            main_trip.steps[0].path_length,
+            deadline,
+        )
+        trips.extend(direct_trips)
+        geometries.extend(direct_trips_geometries)
+
+    return {
+        "trips": trips,
+        "geometries": geometries,
+    }
+
+
+def create_trip_steps_tasks(
+    trip_name: Literal["MAIN_TRIP", "SECOND_TRIP"],
+    trip: Trip,
+) -> list[asyncio.Task[TripStepResult]]:
+    """Start the computation of each step of a trip, in the order of the steps."""
+    departures = [trip.departure, *trip.steps[:-1]]
+
+    return [
+        asyncio.create_task(
+            compute_step_emissions_async(
+                trip_name,
+                trip,
+                idx,
+                (departure.lon, departure.lat),
+                arrival,
+            )
+        )
+        for idx, (departure, arrival) in enumerate(zip(departures, trip.steps))
+    ]
+
+
+async def gather_trip_steps_async(
+    trip_name: Literal["MAIN_TRIP", "SECOND_TRIP"],
+    tasks: list[asyncio.Task[TripStepResult]],
+    deadline: float,
+) -> tuple[TripResult, list[TripStepGeometry]]:
+    """Aggregate the steps of a trip, see trip_service.gather_trip_steps.
+
+    Raises:
+        ValueError:
+            If a route cannot be computed for one of the trip steps, or if a
+            step is not computed before the deadline.
+
+    """
+    emissions_data: list[StepData] = []
+    geometries: list[TripStepGeometry] = []
+
+    try:
+        for idx, task in enumerate(tasks):
+            try:
+                results = await asyncio.wait_for(
+                    task,
+                    timeout=max(deadline - asyncio.get_running_loop().time(), 0),
+                )
+            except TimeoutError as err:
+                logger.warning("step n°%s not computed before the deadline", idx + 1)
+                raise ValueError(
+                    f"step n°{idx + 1} took too long to compute, please try again later."
+                ) from err
+
+            emissions_data.append(results.step_data)
+            geometries.extend(results.geometries)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    return TripResult(name=trip_name, steps=emissions_data), geometries
+
+
+async def compute_step_emissions_async(
+    trip_name: Literal["MAIN_TRIP", "SECOND_TRIP"],
+    trip: Trip,
+    idx: int,
+    departure_coordinates: tuple[float, float],
+    arrival: TripStep,
+) -> TripStepResult:
+    """Compute emissions and geometries for a step of a custom trip.
+
+    The route of the step is requested asynchronously, then emissions are
+    computed in the task pool (see trip_service.compute_step_emissions).
+
+    Raises:
+        ValueError:
+            If a route cannot be computed for the step.
+
+    """
+    transport_mean = arrival.transport_mean
+    precomputed_route = None
+
+    if transport_mean in ROUTE_FINDERS:
+        try:
+            with transport_mean_context(transport_mean):
+                precomputed_route = await ROUTE_FINDERS[transport_mean](
+                    departure_coordinates,
+                    (arrival.lon, arrival.lat),
+                )
+        except Exception as err:
+            if transport_mean not in STEP_ERROR_TRANSPORT_MEANS:
+                raise
+            logger.warning("step n°%s failed, initial payload: %s", idx + 1, trip)
+            raise ValueError(build_step_error_message(idx, transport_mean)) from err
+
+    return await run_in_task_pool(
+        compute_step_emissions,
+        trip_name,
+        trip,
+        idx,
+        departure_coordinates,
+        arrival,
+        precomputed_route=precomputed_route,
+    )
+
+
+async def compute_direct_trips_emissions_async(
+    requested_trip: Trip,
+    main_trip_path_length: float,
+    deadline: float,
+) -> DirectTripsResult:
+    """Compute alternative direct trips for a simple trip.
+
+    See trip_service.compute_direct_trips_emissions, alternatives not computed
+    before the request deadline (comparable with the event loop time) are
+    skipped.
+
+    """
+    async_alternatives: dict[Callable, Callable] = {
+        compute_direct_train_trip: compute_direct_train_trip_async,
+        compute_direct_road_trips: compute_direct_road_trips_async,
+    }
+
+    tasks = [
+        asyncio.create_task(
+            async_alternatives[compute_alternative](*args)
+            if compute_alternative in async_alternatives
+            else run_in_task_pool(compute_alternative, *args)
+        )
+        for compute_alternative, args in list_direct_trips(
+            requested_trip,
+            main_trip_path_length,
+        )
+    ]
+    if not tasks:
+        return [], []
+
+    done, not_done = await asyncio.wait(
+        tasks,
+        timeout=max(deadline - asyncio.get_running_loop().time(), 0),
+    )
+    if not_done:
+        logger.warning("%s tasks not done before the request deadline", len(not_done))
+        for task in not_done:
+            task.cancel()
+
+    trips: list[TripResult] = []
+    geometries: list[TripStepGeometry] = []
+
+    # Results are gathered in creation order to keep a deterministic output
+    for task in tasks:
+        if task in done:
+            direct_trips, direct_trips_geometries = task.result()
+            trips.extend(direct_trips)
+            geometries.extend(direct_trips_geometries)
+
+    return trips, geometries
+
+
+async def compute_direct_train_trip_async(
+    departure_coordinates: tuple[float, float],
+    arrival_coordinates: tuple[float, float],
+) -> DirectTripsResult:
+    try:
+        with transport_mean_context("train"):
+            route = await find_train_route_async(
+                departure_coordinates,
+                arrival_coordinates,
+            )
+    except Exception:
+        logger.warning("Direct trip by train couldn't be computed")
+        return [], []
+
+    return await run_in_task_pool(
+        compute_direct_train_trip,
+        departure_coordinates,
+        arrival_coordinates,
+        precomputed_route=route,
+    )
+
+
+async def compute_direct_road_trips_async(
+    departure_coordinates: tuple[float, float],
+    arrival_coordinates: tuple[float, float],
+    transport_mean: str,
+    main_trip_path_length: float,
+) -> DirectTripsResult:
+    route: RouteResult | None = None
+
+    # The road route is only needed when the requested trip is not a road trip
+    if transport_mean not in ROAD_TRANSPORT_MEANS:
+        try:
+            with transport_mean_context("bus"):
+                route = await find_route_async(
+                    departure_coordinates,
+                    arrival_coordinates,
+                )
+        except Exception:
+            logger.warning(
+                "Direct trip by road couldn't be computed. Bus and car skipped.",
+            )
+            return [], []
+
+    return await run_in_task_pool(
+        compute_direct_road_trips,
+        departure_coordinates,
+        arrival_coordinates,
+        transport_mean,
+        main_trip_path_length,
+        precomputed_route=route,
+    )